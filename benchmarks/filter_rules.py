@@ -0,0 +1,118 @@
+"""
+Time taken to apply a large blacklist and whitelist to synthetic repodata.
+
+Compares matching every entry separately against all packages, as
+conda-mirror used to, with the compiled filter plan.
+
+    python benchmarks/filter_rules.py --num-packages 50000 --num-rules 300
+"""
+
+import argparse
+import fnmatch
+import os
+import random
+import sys
+import time
+
+from synthetic import make_repodata
+
+# import conda-mirror from this checkout, also when it is not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conda_mirror import conda_mirror  # noqa: E402
+
+
+def make_rules(num_rules, names, kind="mixed", seed=0):
+    """Return a blacklist of `num_rules` entries and a whitelist a tenth of
+    that size.
+
+    `kind` is 'names' for name and name prefix entries only, 'versions' for
+    entries with a name and a version range, or 'mixed' for a mix of those
+    and entries on other keys.
+    """
+    rng = random.Random(seed)
+    low, high = {"names": (0, 0.75), "versions": (0.75, 0.9)}.get(kind, (0, 1))
+
+    def rule():
+        choice = rng.uniform(low, high)
+        name = rng.choice(names)
+        if choice < 0.6:
+            return {"name": name}
+        if choice < 0.75:
+            return {"name": name[:-2] + "*"}
+        if choice < 0.9:
+            major = rng.randrange(4)
+            return {"name": name, "version": ">=%d.1,<%d.5" % (major, major)}
+        return {"license": "GPL*", "build": "py3%d*" % rng.randrange(7, 12)}
+
+    blacklist = [rule() for _ in range(num_rules)]
+    whitelist = [rule() for _ in range(max(1, num_rules // 10))]
+    return blacklist, whitelist
+
+
+def match_old(all_packages, key_pattern_dict):
+    """_match as it was before the filter plan."""
+    matchers = {}
+    for key, pattern in sorted(key_pattern_dict.items()):
+        key = key.lower()
+        pattern = pattern.lower()
+        if key == "version" and conda_mirror.VERSION_SPEC_CHARS.search(pattern):
+            if " " in pattern:
+                pattern, build_pattern = pattern.split(" ", maxsplit=1)
+                if "build" not in matchers:
+                    matchers["build"] = conda_mirror._build_matcher(build_pattern)
+            matcher = conda_mirror._version_matcher(pattern)
+        elif key == "build" and conda_mirror.VERSION_SPEC_CHARS.search(pattern):
+            matcher = conda_mirror._build_matcher(pattern)
+        else:
+            matcher = lambda v, p=pattern: fnmatch.fnmatch(v, p)  # noqa: E731
+        matchers[key] = matcher
+    return {
+        pkg_name: pkg_info
+        for pkg_name, pkg_info in all_packages.items()
+        if all(
+            matcher(str(pkg_info.get(key, "")).lower())
+            for key, matcher in matchers.items()
+        )
+    }
+
+
+def filter_per_rule(packages, blacklist, whitelist):
+    excluded, required = set(), set()
+    for blist in blacklist:
+        excluded.update(match_old(packages, blist))
+    for wlist in whitelist:
+        required.update(match_old(packages, wlist))
+    excluded.difference_update(required)
+    return excluded, required
+
+
+def filter_plan(packages, blacklist, whitelist):
+    return conda_mirror._FilterPlan(blacklist, whitelist).evaluate(packages)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--num-packages", type=int, default=50000)
+    ap.add_argument("--num-rules", type=int, default=300)
+    ap.add_argument("--rules", choices=["mixed", "names", "versions"], default="mixed")
+    args = ap.parse_args()
+
+    packages = make_repodata(args.num_packages)["packages"]
+    names = sorted({record["name"] for record in packages.values()})
+    blacklist, whitelist = make_rules(args.num_rules, names, args.rules)
+    print(
+        "%s packages, %s blacklist and %s whitelist entries"
+        % (len(packages), len(blacklist), len(whitelist))
+    )
+    results = []
+    for name, function in [("per-rule", filter_per_rule), ("plan", filter_plan)]:
+        start = time.perf_counter()
+        results.append(function(packages, blacklist, whitelist))
+        elapsed = time.perf_counter() - start
+        print("%-10s %8.3f s" % (name, elapsed))
+    assert results[0] == results[1]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Peak memory of loading a large repodata.json.
+
+Compares reading the whole file with json.load, as conda-mirror does for
+files up to REPODATA_STREAM_SIZE, with the streaming parser that stores
+compact package records, which it uses for larger files. Each loader runs in
+a fresh interpreter so that its peak resident set size can be measured.
+
+    python benchmarks/repodata_memory.py --num-packages 500000
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from synthetic import write_repodata
+
+
+def load_json(repodata_path, platform):
+    with open(repodata_path) as f:
+        repodata = json.load(f)
+    packages = repodata.get("packages", {})
+    for info in packages.values():
+        info.setdefault("subdir", platform)
+    return repodata.get("info", {}), packages
+
+
+def load_streaming(repodata_path, platform):
+    from conda_mirror import conda_mirror
+
+    conda_mirror.REPODATA_STREAM_SIZE = 0
+    return conda_mirror._load_repodata(repodata_path, platform)
+
+
+LOADERS = {"json": load_json, "streaming": load_streaming}
+
+
+def measure(loader, repodata_path):
+    """Load the repodata and print the time taken and the peak RSS in MB."""
+    start = time.perf_counter()
+    info, packages = LOADERS[loader](repodata_path, "linux-64")
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"packages": len(packages), "seconds": elapsed, "peak_mb": peak}))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--num-packages", type=int, default=500000)
+    ap.add_argument("--measure", choices=sorted(LOADERS), help=argparse.SUPPRESS)
+    ap.add_argument("--repodata", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.measure:
+        measure(args.measure, args.repodata)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        repodata_path = os.path.join(tmp_dir, "repodata.json")
+        write_repodata(repodata_path, args.num_packages)
+        size = os.path.getsize(repodata_path) / 1024 / 1024
+        print("repodata.json: %s packages, %.0f MB" % (args.num_packages, size))
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+        for loader in sorted(LOADERS):
+            out = subprocess.check_output(
+                [
+                    sys.executable,
+                    __file__,
+                    "--measure",
+                    loader,
+                    "--repodata",
+                    repodata_path,
+                ],
+                env=env,
+            )
+            result = json.loads(out)
+            print(
+                "%-10s peak RSS %7.0f MB  %6.1f s"
+                % (loader, result["peak_mb"], result["seconds"])
+            )
+
+
+if __name__ == "__main__":
+    main()
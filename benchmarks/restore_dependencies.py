@@ -0,0 +1,124 @@
+"""
+Time taken to restore the dependencies of a whitelist (`--include-depends`).
+
+Compares scanning every excluded package in each round, as conda-mirror used
+to, with the name and version index of the excluded packages.
+
+Like on conda-forge, packages depend on version ranges of lower level
+packages, and a few low level packages are depended upon by most others, so
+that the closure of a whitelist takes many rounds and is a fraction of the
+channel.
+
+    python benchmarks/restore_dependencies.py --num-packages 300000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+from synthetic import make_repodata
+
+# import conda-mirror from this checkout, also when it is not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conda_mirror import conda_mirror  # noqa: E402
+
+
+def restore_old(all_packages, excluded, required):
+    """_restore_required_dependencies as it was before the index."""
+    cur_required = set(required)
+    already_required = set(all_packages.get(r, {}).get("name") for r in required)
+    final_excluded = set(excluded)
+
+    while len(final_excluded) > 0 and len(cur_required) > 0:
+        required_depend_specs = {}
+        for req in cur_required:
+            info = all_packages.get(req, {})
+            for dep in info.get("depends", ()):
+                try:
+                    pkg_name, version_spec = dep.split(maxsplit=1)
+                except ValueError:
+                    pkg_name, version_spec = dep, ""
+                if pkg_name not in already_required:
+                    required_depend_specs.setdefault(pkg_name, set()).add(version_spec)
+
+        cur_required.clear()
+
+        for k in list(final_excluded):
+            info = all_packages.get(k, {})
+            pkg_name = info.get("name")
+            for version_spec in required_depend_specs.get(pkg_name, ()):
+                matcher = conda_mirror.DependsMatcher(version_spec)
+                if matcher(info):
+                    final_excluded.remove(k)
+                    cur_required.add(k)
+                    break
+
+    return final_excluded
+
+
+def layer_depends(packages, names, seed=0):
+    """Replace the dependencies of `packages` with a layered graph.
+
+    Each name only depends on names after it in `names`, mostly on those at
+    the end, which play the part of low level libraries.
+    """
+    rng = random.Random(seed)
+    depends = {}
+    for i, name in enumerate(names):
+        below = len(names) - i - 1
+        depends[name] = sorted(
+            {
+                names[-1 - int(below * rng.random() ** 2)]
+                for _ in range(rng.randrange(4))
+            }
+            if below
+            else ()
+        )
+    for record in packages.values():
+        record["depends"] = []
+        for dep in depends[record["name"]]:
+            minor = rng.randrange(20)
+            record["depends"].append("%s >=0.%d,<0.%d" % (dep, minor, minor + 3))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--num-packages", type=int, default=300000)
+    ap.add_argument("--num-names", type=int, default=20000)
+    ap.add_argument("--num-required", type=int, default=50)
+    ap.add_argument(
+        "--skip-old", action="store_true", help="Only time the indexed closure"
+    )
+    args = ap.parse_args()
+
+    packages = make_repodata(args.num_packages, num_names=args.num_names)["packages"]
+    names = sorted({record["name"] for record in packages.values()})
+    layer_depends(packages, names)
+    whitelist = set(random.Random(0).sample(names, args.num_required))
+    required = {k for k, record in packages.items() if record["name"] in whitelist}
+    excluded = set(packages).difference(required)
+    print(
+        "%s packages, %s whitelisted names (%s packages)"
+        % (len(packages), len(whitelist), len(required))
+    )
+
+    functions = [("indexed", conda_mirror._restore_required_dependencies)]
+    if not args.skip_old:
+        functions.insert(0, ("scan", restore_old))
+    results = []
+    for name, function in functions:
+        start = time.perf_counter()
+        results.append(function(packages, excluded, required))
+        elapsed = time.perf_counter() - start
+        print(
+            "%-10s %8.3f s, %s packages restored"
+            % (name, elapsed, len(excluded) - len(results[-1]))
+        )
+    assert all(result == results[0] for result in results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Synthetic repodata.json for the benchmarks.
+
+The records mimic the shape of a large channel like conda-forge: a few
+thousand package names with many versions and builds each, shared licenses
+and dependencies, and unique checksums.
+"""
+
+import json
+import random
+
+LICENSES = ["BSD-3-Clause", "MIT", "Apache-2.0", "GPL-3.0-or-later", "LGPL-2.1"]
+PYTHONS = ["py37", "py38", "py39", "py310", "py311"]
+
+
+def make_repodata(num_packages, subdir="linux-64", num_names=None, seed=0):
+    """Return a repodata dict with `num_packages` package records.
+
+    Parameters
+    ----------
+    num_packages : int
+        Number of records in the 'packages' section
+    subdir : str, optional
+        The subdir of the repodata
+    num_names : int, optional
+        Number of distinct package names. Defaults to one per 100 records.
+    seed : int, optional
+        Seed of the random generator, so the same repodata is made every time
+    """
+    rng = random.Random(seed)
+    num_names = num_names or max(1, num_packages // 100)
+    names = ["pkg%05d" % i for i in range(num_names)]
+    packages = {}
+    for i in range(num_packages):
+        name = names[i % num_names]
+        version = "%d.%d.%d" % (i // num_names // 25, i // num_names % 25, i % 3)
+        python = rng.choice(PYTHONS)
+        build = "%sh%08x_%d" % (python, rng.getrandbits(32), i % 2)
+        depends = ["python >=%s.%s" % (python[2], python[3:])]
+        depends += [
+            "%s >=%d" % (rng.choice(names), rng.randrange(3))
+            for _ in range(rng.randrange(6))
+        ]
+        packages["%s-%s-%s.tar.bz2" % (name, version, build)] = {
+            "arch": "x86_64",
+            "build": build,
+            "build_number": i % 2,
+            "depends": depends,
+            "license": rng.choice(LICENSES),
+            "license_family": "BSD",
+            "md5": "%032x" % rng.getrandbits(128),
+            "name": name,
+            "platform": "linux",
+            "sha256": "%064x" % rng.getrandbits(256),
+            "size": rng.randrange(10000, 10000000),
+            "subdir": subdir,
+            "timestamp": 1500000000000 + i,
+            "version": version,
+        }
+    return {"info": {"subdir": subdir}, "packages": packages}
+
+
+def write_repodata(path, num_packages, **kwargs):
+    """Write the synthetic repodata of `make_repodata` to `path`."""
+    with open(path, "w") as f:
+        json.dump(make_repodata(num_packages, **kwargs), f, indent=2, sort_keys=True)
@@ -0,0 +1,65 @@
+"""
+Time taken to write a large repodata.json and repodata.json.bz2.
+
+Compares the writer conda-mirror used to have, which built the whole document
+as a string, stripped it line by line and compressed it in one go, with the
+current streaming writer that compresses blocks in parallel.
+
+    python benchmarks/write_repodata.py --num-packages 200000
+"""
+
+import argparse
+import bz2
+import json
+import os
+import sys
+import tempfile
+import time
+
+from synthetic import make_repodata
+
+# import conda-mirror from this checkout, also when it is not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conda_mirror import conda_mirror  # noqa: E402
+
+
+def write_repodata_old(package_dir, repodata_dict):
+    data = json.dumps(repodata_dict, indent=2, sort_keys=True)
+    data = "\n".join(line.rstrip() for line in data.splitlines())
+    if not data.endswith("\n"):
+        data += "\n"
+    with open(os.path.join(package_dir, "repodata.json"), "w") as fo:
+        fo.write(data)
+    with open(os.path.join(package_dir, "repodata.json.bz2"), "wb") as fo:
+        fo.write(bz2.compress(data.encode("utf-8")))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--num-packages", type=int, default=200000)
+    ap.add_argument("--num-threads", type=int, default=None)
+    args = ap.parse_args()
+
+    repodata = make_repodata(args.num_packages)
+    writers = {
+        "old": write_repodata_old,
+        "streaming": lambda package_dir, repodata_dict: conda_mirror._write_repodata(
+            package_dir, repodata_dict, num_threads=args.num_threads
+        ),
+    }
+    print(
+        "%s packages, %s threads"
+        % (args.num_packages, args.num_threads or os.cpu_count())
+    )
+    for name, writer in writers.items():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            start = time.perf_counter()
+            writer(tmp_dir, repodata)
+            elapsed = time.perf_counter() - start
+            size = os.path.getsize(os.path.join(tmp_dir, "repodata.json.bz2"))
+        print("%-10s %6.1f s  bz2 %5.1f MB" % (name, elapsed, size / 1024 / 1024))
+
+
+if __name__ == "__main__":
+    main()
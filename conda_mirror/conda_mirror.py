@@ -1,44 +1,188 @@
 import argparse
+import asyncio
+import bisect
 import bz2
+import contextlib
 import fnmatch
+import functools
 import hashlib
 import json
 import logging
 import multiprocessing
+import multiprocessing.pool
 import os
 import pdb
 import re
 import shutil
+import ssl
 import sys
 import tarfile
 import tempfile
 import time
 import random
+import zipfile
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pprint import pformat
-from typing import Any, Callable, Dict, Set, Union
+from typing import Any, Callable, Dict, Set, Tuple, Union
+from urllib.parse import urlsplit
 
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
 
 from tqdm import tqdm
 
+from . import jlap
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 try:
-    from conda.models.version import BuildNumberMatch, VersionSpec
+    import zstandard
 except ImportError:
-    from .versionspec import BuildNumberMatch, VersionSpec
+    zstandard = None
+
+try:
+    from conda.models.version import BuildNumberMatch, VersionOrder, VersionSpec
+except ImportError:
+    from .versionspec import BuildNumberMatch, VersionOrder, VersionSpec
 
 logger = None
 
+
 DEFAULT_BAD_LICENSES = ["agpl", ""]
 
 DEFAULT_PLATFORMS = ["linux-64", "linux-32", "osx-64", "win-64", "win-32"]
 
 DEFAULT_CHUNK_SIZE = 16 * 1024
 
+# Size of the blocks that are read from disk to hash a package.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Number of connections kept per host by the shared download session. This
+# is raised to the number of concurrent downloads when that is larger.
+DEFAULT_POOL_SIZE = 10
+
+DOWNLOAD_BACKENDS = ["requests", "asyncio"]
+
+# Maximum number of threads that write and hash the chunks downloaded by the
+# asyncio backend.
+ASYNC_WRITER_THREADS = 8
+
+# Maximum number of chunks of a download of the asyncio backend that are
+# waiting to be written.
+ASYNC_WRITE_QUEUE_SIZE = 16
+
+VALIDATION_EXECUTORS = ["serial", "thread", "process"]
+
+# Settings of each channel in the `channels` list of the config file.
+CHANNEL_KEYS = frozenset(
+    [
+        "upstream_channel",
+        "target_directory",
+        "platform",
+        "blacklist",
+        "whitelist",
+        "include_depends",
+        "prefer_conda",
+    ]
+)
+
+# Suffix of files that are still being downloaded and verified.
+PARTIAL_SUFFIX = ".partial"
+
+# Directory in the temp directory that packages are downloaded to, with one
+# subdirectory per platform directory that is mirrored.
+STAGING_DIRNAME = "conda-mirror-staging"
+
+# Journal of the packages in a staging directory that were downloaded and
+# verified, one json object per line.
+STAGING_JOURNAL_FILENAME = "journal.jsonl"
+
+# Suffix of the file next to a partially downloaded package that records the
+# url and the ETag or Last-Modified of the response it came from, so that the
+# download can be resumed.
+RESUME_STATE_SUFFIX = ".json"
+
+# Directory in the temp directory that holds the state conda-mirror keeps
+# between runs, unless --state-directory is given, with one subdirectory per
+# target directory. It is kept out of the target directory, which is usually
+# published as is, because it holds e.g. the unfiltered upstream repodata. All
+# of it is a cache: without it, the next run just does all the work again.
+STATE_DIRNAME = "conda-mirror-state"
+
+VALIDATION_CACHE_FILENAME = "validation.json"
+
+UPSTREAM_REPODATA_FILENAME = "upstream-repodata.json"
+
+UPSTREAM_REPODATA_STATE_FILENAME = "upstream-repodata.state.json"
+
+UPSTREAM_JLAP_STATE_FILENAME = "upstream-repodata.jlap.json"
+
+LAST_SYNC_FILENAME = "last-sync.json"
+
+INDEX_STATE_FILENAME = "index.json"
+
+# Prefix of the noarch packages when they are resolved together with the
+# packages of a platform, whose file names may be the same.
+NOARCH_PREFIX = "noarch/"
+
+# Size of the blocks repodata.json is parsed in.
+REPODATA_CHUNK_SIZE = 256 * 1024
+
+# repodata.json files up to this size are read in one go by json.load, which
+# is about three times faster. Larger ones are parsed incrementally into
+# compact records, which takes a quarter to a third less memory.
+REPODATA_STREAM_SIZE = 64 * 1024 * 1024
+
+# Sections of repodata.json that map package file names to their records.
+PACKAGE_SECTIONS = ("packages", "packages.conda")
+
+# File extensions of the legacy and of the newer conda package format. The
+# records of the .conda packages are listed under 'packages.conda'.
+TAR_BZ2_EXTENSION = ".tar.bz2"
+CONDA_EXTENSION = ".conda"
+
+# Fields of package records whose values are (nearly) unique to each package
+# and are therefore not worth sharing between records.
+UNIQUE_RECORD_FIELDS = frozenset(
+    ["md5", "sha256", "legacy_bz2_md5", "legacy_bz2_size", "size", "timestamp"]
+)
+
+# Size of the blocks of repodata.json that are compressed independently into
+# repodata.json.bz2. This is the block size of bz2 at its highest level.
+BZ2_BLOCK_SIZE = 900 * 1000
+
+# Compression level of the repodata.json.zst that is written.
+ZSTD_LEVEL = 16
+
+# Compressed variants of repodata.json, from most to least preferred.
+REPODATA_COMPRESSIONS = [".zst", ".bz2"]
+
+# Client error statuses of a download that are worth retrying.
+RETRY_STATUSES = frozenset([408, 425, 429])
+
 # Pattern matching special characters in version/build string matchers.
 VERSION_SPEC_CHARS = re.compile(r"[<>=^$!]")
 
 
+class RejectedDownloadError(ValueError):
+    """A package download that is given up on without retrying it, as another
+    attempt would get the same answer."""
+
+
+class ChecksumMismatchError(RejectedDownloadError):
+    """A downloaded package does not match its repodata entry."""
+
+
+class PackageUnavailableError(RejectedDownloadError):
+    """Upstream answers the download of a package with a client error, e.g.
+    because it still lists a package it no longer serves."""
+
+
 def _maybe_split_channel(channel):
     """Split channel if it is fully qualified.
 
@@ -99,7 +243,27 @@ def _match(all_packages: Dict[str, Dict[str, Any]], key_pattern_dict: Dict[str,
 
     """
 
-    matched = dict()
+    matched, _ = _FilterPlan([key_pattern_dict]).evaluate(all_packages)
+    return {
+        pkg_name: pkg_info
+        for pkg_name, pkg_info in all_packages.items()
+        if pkg_name in matched
+    }
+
+
+def _compile_rule(key_pattern_dict: Dict[str, str]) -> Dict[str, Callable[[Any], bool]]:
+    """Compile the matchers of a blacklist or whitelist entry.
+
+    Parameters
+    ----------
+    key_pattern_dict : Dictionary mapping keys to patterns, see `_match`
+
+    Returns
+    -------
+    matchers : dict
+        Maps lowercase package metadata keys to functions matching the
+        lowercase string value of that key
+    """
     matchers: Dict[str, Callable[[Any], bool]] = {}
     for key, pattern in sorted(key_pattern_dict.items()):
         key = key.lower()
@@ -118,25 +282,326 @@ def _match(all_packages: Dict[str, Dict[str, Any]], key_pattern_dict: Dict[str,
         else:
             matcher = _glob_matcher(pattern)
         matchers[key] = matcher
+    return matchers
+
+
+class _NameIndex:
+    """Index of package file names by lowercase package name.
+
+    Parameters
+    ----------
+    all_packages : Dictionary mapping package file names to metadata
+        dictionary for that instance.
+    lowercase : bool, optional
+        Index the lowercase names, as the blacklist and whitelist are
+        matched. If False, names are indexed as they are, as dependencies
+        are matched.
+    """
+
+    def __init__(self, all_packages: Dict[str, Dict[str, Any]], lowercase=True):
+        self._all_packages = all_packages
+        self._filenames: Dict[str, list] = {}
+        for pkg_name, pkg_info in all_packages.items():
+            name = str(pkg_info.get("name", ""))
+            if lowercase:
+                name = name.lower()
+            self._filenames.setdefault(name, []).append(pkg_name)
+        self._names = sorted(self._filenames)
+        self._versions: Dict[str, _VersionIndex] = {}
+
+    def lookup(self, name: str) -> list:
+        """File names of the packages called `name`."""
+        return self._filenames.get(name, [])
+
+    def versions(self, name: str) -> "_VersionIndex":
+        """The packages called `name`, sorted by version."""
+        try:
+            return self._versions[name]
+        except KeyError:
+            versions = _VersionIndex(self._all_packages, self.lookup(name))
+            self._versions[name] = versions
+            return versions
+
+    def prefix(self, prefix: str):
+        """Iterate over the file names of the packages whose name starts with
+        `prefix`."""
+        names = self._names
+        i = bisect.bisect_left(names, prefix)
+        while i < len(names) and names[i].startswith(prefix):
+            yield from self._filenames[names[i]]
+            i += 1
 
-    for pkg_name, pkg_info in all_packages.items():
-        # normalize the strings so that comparisons are easier
-        if all(
-            matcher(str(pkg_info.get(key, "")).lower())
-            for key, matcher in matchers.items()
-        ):
-            matched.update({pkg_name: pkg_info})
 
-    return matched
+class _VersionIndex:
+    """Packages of the same name, sorted by `VersionOrder`.
+
+    Version specs made of ranges and exact versions, like '>=3.7,<3.8|==4.0',
+    are resolved with a binary search for each range. Other specs are tested
+    against every package.
+
+    Parameters
+    ----------
+    all_packages : Dictionary mapping package file names to metadata
+        dictionary for that instance.
+    filenames : list
+        File names of the packages to index
+    """
+
+    def __init__(self, all_packages: Dict[str, Dict[str, Any]], filenames):
+        self.all_packages = all_packages
+        self._filenames = filenames
+        entries = []
+        for pkg_name in filenames:
+            try:
+                version = VersionOrder(str(all_packages[pkg_name].get("version", "")))
+            except ValueError:
+                continue
+            entries.append((version, pkg_name))
+        entries.sort(key=lambda entry: entry[0])
+        self._sorted_versions = [version for version, _ in entries]
+        self._sorted_filenames = [pkg_name for _, pkg_name in entries]
+        # packages whose version cannot be ordered, like '1.0_abc@1'
+        self._unordered = set(filenames).difference(self._sorted_filenames)
+
+    def match(self, version_spec: str, ranges=None) -> list:
+        """File names of the packages whose version matches `version_spec`.
+
+        `ranges` may be given if `version_spec` was parsed with
+        `_version_ranges` already.
+        """
+        if ranges is None:
+            ranges = _version_ranges(version_spec)
+        if ranges is None:
+            matcher = _version_matcher(version_spec)
+            return [
+                pkg_name
+                for pkg_name in self._filenames
+                if _safe_match(matcher, self.all_packages[pkg_name].get("version", ""))
+            ]
+
+        versions = self._sorted_versions
+        matched = []
+        for terms in ranges:
+            lo, hi = 0, len(versions)
+            for operator, version in terms:
+                if operator in (">=", "=="):
+                    lo = max(lo, bisect.bisect_left(versions, version))
+                if operator == ">":
+                    lo = max(lo, bisect.bisect_right(versions, version))
+                if operator in ("<=", "=="):
+                    hi = min(hi, bisect.bisect_right(versions, version))
+                if operator == "<":
+                    hi = min(hi, bisect.bisect_left(versions, version))
+            matched.extend(self._sorted_filenames[lo:hi])
+        if len(ranges) > 1:
+            matched = list(dict.fromkeys(matched))
+        if self._unordered and not any(ranges):
+            # '*' matches any version, even those that cannot be ordered
+            matched.extend(sorted(self._unordered))
+        return matched
+
+
+def _safe_match(matcher: Callable[[Any], bool], version: str) -> bool:
+    """Match a version that may not be valid, which never matches."""
+    try:
+        return bool(matcher(version))
+    except ValueError:
+        return False
+
+
+# A term of a version spec that is a range or exact version.
+VERSION_RANGE_TERM = re.compile(r"(>=|<=|==|>|<)?([^*^$!~=<>|,()@\s]+)$")
+
+
+def _version_ranges(version_spec: str):
+    """Parse a version spec made of ranges and exact versions.
+
+    Returns
+    -------
+    ranges : list or None
+        The alternatives ('|') of the spec, each a list of (operator,
+        VersionOrder) terms that must all hold (','). None if the spec has
+        other kinds of terms, like globs, regular expressions or parentheses.
+    """
+    version_spec = version_spec.strip()
+    if version_spec in ("", "*"):
+        return [[]]
+    ranges = []
+    for alternative in version_spec.split("|"):
+        terms = []
+        for term in alternative.split(","):
+            match = VERSION_RANGE_TERM.match(term)
+            if match is None:
+                return None
+            operator, version = match.groups()
+            try:
+                terms.append((operator or "==", VersionOrder(version)))
+            except ValueError:
+                return None
+        ranges.append(terms)
+    return ranges
+
+
+# Special characters of glob patterns.
+GLOB_CHARS = re.compile(r"[*?[]")
+
+
+class _RuleSet:
+    """A blacklist or whitelist, compiled to find the packages any of its
+    entries matches.
+
+    Entries whose name pattern is a literal name or a prefix followed by '*'
+    only need to look at the packages with that name, found through a
+    `_NameIndex`. Entries consisting of a single other glob are combined into
+    a single regular expression per key. The remaining entries are compiled
+    with `_compile_rule`. Only these last two kinds need a scan of all
+    packages.
+    """
+
+    def __init__(self, rules):
+        globs: Dict[str, list] = {}
+        self.indexed = []
+        self.rules = []
+        unique = {json.dumps(rule, sort_keys=True).lower(): rule for rule in rules}
+        for rule in unique.values():
+            name = {k.lower(): v for k, v in rule.items()}.get("name")
+            if name is not None:
+                name = name.lower()
+                literal = not GLOB_CHARS.search(name)
+                if literal or (name.endswith("*") and not GLOB_CHARS.search(name[:-1])):
+                    others = _compile_rule(rule)
+                    del others["name"]
+                    version_spec = None
+                    version = {k.lower(): v for k, v in rule.items()}.get("version", "")
+                    if literal and VERSION_SPEC_CHARS.search(version):
+                        # resolved with the version index of the name
+                        version_spec = version.lower().split(" ")[0]
+                        del others["version"]
+                    if literal:
+                        self.indexed.append((name, None, version_spec, others))
+                    else:
+                        self.indexed.append((None, name[:-1], None, others))
+                    continue
+            if len(rule) == 1:
+                ((key, pattern),) = rule.items()
+                key, pattern = key.lower(), pattern.lower()
+                if key not in ("version", "build") or not VERSION_SPEC_CHARS.search(
+                    pattern
+                ):
+                    globs.setdefault(key, []).append(fnmatch.translate(pattern))
+                    continue
+            self.rules.append(_compile_rule(rule))
+        self.globs = {
+            key: re.compile("|".join(patterns)).match for key, patterns in globs.items()
+        }
+        self.keys = set(self.globs).union(*self.rules)
+
+    @property
+    def needs_scan(self) -> bool:
+        """Whether some entries have to be tested against every package."""
+        return bool(self.globs or self.rules)
+
+    def lookup(self, index: _NameIndex, all_packages: Dict[str, Dict[str, Any]]):
+        """The file names of the packages matched by the indexed entries."""
+        matched: Set[str] = set()
+        for name, prefix, version_spec, others in self.indexed:
+            if version_spec is not None:
+                candidates = index.versions(name).match(version_spec)
+            elif prefix is None:
+                candidates = index.lookup(name)
+            else:
+                candidates = index.prefix(prefix)
+            if not others:
+                matched.update(candidates)
+                continue
+            for pkg_name in candidates:
+                pkg_info = all_packages[pkg_name]
+                if all(
+                    matcher(str(pkg_info.get(key, "")).lower())
+                    for key, matcher in others.items()
+                ):
+                    matched.add(pkg_name)
+        return matched
+
+    def matches(self, values: Dict[str, str]) -> bool:
+        """Whether any of the entries that are not indexed matches the package
+        with the lowercase metadata `values`."""
+        for key, match in self.globs.items():
+            if match(values[key]):
+                return True
+        return any(
+            all(matcher(values[key]) for key, matcher in matchers.items())
+            for matchers in self.rules
+        )
+
+
+class _FilterPlan:
+    """The blacklist and whitelist, compiled once to be evaluated in a single
+    pass over the packages.
+
+    Parameters
+    ----------
+    blacklist : list of dicts, optional
+        Entries mapping keys to patterns, see `_match`
+    whitelist : list of dicts, optional
+        Entries mapping keys to patterns, see `_match`
+    """
+
+    def __init__(self, blacklist=None, whitelist=None):
+        self._blacklist = _RuleSet(blacklist or [])
+        self._whitelist = _RuleSet(whitelist or [])
+        self._keys = sorted(self._blacklist.keys | self._whitelist.keys)
+
+    def evaluate(self, all_packages: Dict[str, Dict[str, Any]], index=None):
+        """Split the packages into excluded and required ones.
+
+        Parameters
+        ----------
+        all_packages : Dictionary mapping package file names to metadata
+            dictionary for that instance.
+        index : _NameIndex, optional
+            Index of `all_packages`. Built when needed if not given.
+
+        Returns
+        -------
+        excluded : set
+            File names of the packages that match the blacklist but not the
+            whitelist
+        required : set
+            File names of the packages that match the whitelist
+        """
+        excluded: Set[str] = set()
+        required: Set[str] = set()
+        if self._blacklist.indexed or self._whitelist.indexed:
+            index = index or _NameIndex(all_packages)
+            excluded = self._blacklist.lookup(index, all_packages)
+            required = self._whitelist.lookup(index, all_packages)
+
+        if self._blacklist.needs_scan or self._whitelist.needs_scan:
+            keys = self._keys
+            for pkg_name, pkg_info in all_packages.items():
+                if pkg_name in required:
+                    continue
+                # normalize the strings once so that comparisons are easier
+                values = {key: str(pkg_info.get(key, "")).lower() for key in keys}
+                if self._whitelist.needs_scan and self._whitelist.matches(values):
+                    required.add(pkg_name)
+                elif (
+                    self._blacklist.needs_scan
+                    and pkg_name not in excluded
+                    and self._blacklist.matches(values)
+                ):
+                    excluded.add(pkg_name)
+        excluded.difference_update(required)
+        return excluded, required
 
 
 def _glob_matcher(pattern: str) -> Callable[[Any], bool]:
     """Returns a function that will match against given glob expression."""
 
-    def _globmatch(v, p=pattern):
-        return fnmatch.fnmatch(v, p)
-
-    return _globmatch
+    # the values and patterns are lowercase already, so there is no need for
+    # fnmatch.fnmatch to normalize their case for every comparison
+    return re.compile(fnmatch.translate(pattern)).match
 
 
 def _version_matcher(pattern: str) -> Callable[[Any], bool]:
@@ -157,6 +622,8 @@ class DependsMatcher:
         if not pattern:
             pattern = "*"
         parts = pattern.split(" ", maxsplit=1)
+        self._version_spec = parts[0]
+        self._version_ranges = _version_ranges(parts[0])
         self._version_matcher = _version_matcher(parts[0])
         if len(parts) > 1:
             self._build_matcher = _build_matcher(parts[1])
@@ -168,6 +635,15 @@ class DependsMatcher:
             pkg_info.get("version", "")
         ) and self._build_matcher(pkg_info.get("build", ""))
 
+    def select(self, versions: _VersionIndex) -> list:
+        """File names of the packages in `versions` that match, found with a
+        binary search where possible."""
+        return [
+            pkg_name
+            for pkg_name in versions.match(self._version_spec, self._version_ranges)
+            if self._build_matcher(versions.all_packages[pkg_name].get("build", ""))
+        ]
+
 
 def _restore_required_dependencies(
     all_packages: Dict[str, Dict[str, Any]],
@@ -184,7 +660,8 @@ def _restore_required_dependencies(
     ----------
     all_packages:
         Dictionary mapping package filename to metadata dictionary representing
-        contents of repodata.json.
+        contents of repodata.json. To resolve dependencies across subdirs, merge
+        their packages under keys that are unique, like 'noarch/<filename>'.
     excluded:
         Initial set of package filenames to be excluded from download.
     required:
@@ -197,16 +674,23 @@ def _restore_required_dependencies(
 
     cur_required = set(required)
 
-    # TODO - support platform-specific + noarch
-
     already_required = set(all_packages.get(r, {}).get("name") for r in required)
 
     final_excluded: Set[str] = set(excluded)
+    # only excluded packages can be restored, so only those are indexed.
+    # Dependencies are matched on the exact package name.
+    index = _NameIndex(
+        {k: all_packages[k] for k in final_excluded if k in all_packages},
+        lowercase=False,
+    )
+    matchers: Dict[str, DependsMatcher] = {}
+    # (name, version spec) pairs whose matches have been restored already
+    resolved: Set[Tuple[str, str]] = set()
 
     while len(final_excluded) > 0 and len(cur_required) > 0:
-        required_depend_specs: Dict[str, Set[str]] = {}
+        required_depend_specs: Set[Tuple[str, str]] = set()
 
-        # collate version specs of dependencies package by package name
+        # collate the dependencies that have not been resolved yet
         for req in cur_required:
             info = all_packages.get(req, {})
             for dep in info.get("depends", ()):
@@ -215,19 +699,21 @@ def _restore_required_dependencies(
                 except ValueError:
                     pkg_name, version_spec = dep, ""
                 if pkg_name not in already_required:
-                    required_depend_specs.setdefault(pkg_name, set()).add(version_spec)
+                    required_depend_specs.add((pkg_name, version_spec))
 
+        required_depend_specs.difference_update(resolved)
+        resolved.update(required_depend_specs)
         cur_required.clear()
 
-        for k in list(final_excluded):
-            info = all_packages.get(k, {})
-            pkg_name = info.get("name")
-            for version_spec in required_depend_specs.get(pkg_name, ()):
-                matcher = DependsMatcher(version_spec)
-                if matcher(info):
+        for pkg_name, version_spec in required_depend_specs:
+            try:
+                matcher = matchers[version_spec]
+            except KeyError:
+                matcher = matchers[version_spec] = DependsMatcher(version_spec)
+            for k in matcher.select(index.versions(pkg_name)):
+                if k in final_excluded:
                     final_excluded.remove(k)
                     cur_required.add(k)
-                    break
 
     return final_excluded
 
@@ -271,22 +757,47 @@ def _make_arg_parser():
             "Temporary download location for the packages. Defaults to a "
             "randomly selected temporary directory. Note that you might need "
             "to specify a different location if your default temp directory "
-            "has less available space than your mirroring target"
+            "has less available space than your mirroring target. Packages "
+            "downloaded by an interrupted run are kept there for the next run"
         ),
         default=tempfile.gettempdir(),
     )
+    ap.add_argument(
+        "--state-directory",
+        help=(
+            "Where the state kept between runs (cached upstream repodata, "
+            "validation cache) is stored. Defaults to a directory per target "
+            "directory in '%s' in the temp directory. It should not be inside "
+            "the target directory, which is published" % STATE_DIRNAME
+        ),
+    )
     ap.add_argument(
         "--platform",
+        nargs="+",
         help=(
-            "The OS platform(s) to mirror. one of: {'linux-64', 'linux-32',"
-            "'osx-64', 'win-32', 'win-64'}"
+            "The OS platform(s) to mirror. one or more of: {'linux-64', 'linux-32',"
+            "'osx-64', 'win-32', 'win-64', 'noarch'}. Several platforms are "
+            "mirrored together, sharing one pool of downloads"
         ),
     )
     ap.add_argument(
         "-D",
         "--include-depends",
         action="store_true",
-        help=("Include packages matching any dependencies of packages in whitelist."),
+        help=(
+            "Include packages matching any dependencies of packages in whitelist. "
+            "Dependencies in noarch are mirrored into the noarch directory."
+        ),
+    )
+    ap.add_argument(
+        "--prefer-conda",
+        action="store_true",
+        help=(
+            "Only mirror the .conda package of a build that upstream also "
+            "publishes as .tar.bz2. .conda packages are smaller and much faster "
+            "to extract"
+        ),
+        default=False,
     )
     ap.add_argument(
         "-v",
@@ -316,6 +827,47 @@ def _make_arg_parser():
         type=int,
         help="Num of threads for validation. 1: Serial mode. 0: All available.",
     )
+    ap.add_argument(
+        "--validation-executor",
+        choices=VALIDATION_EXECUTORS,
+        default=None,
+        help=(
+            "Run validation serially, in a pool of --num-threads threads or in "
+            "a pool of --num-threads processes. Defaults to serial if "
+            "--num-threads is 1 and to process otherwise."
+        ),
+    )
+    ap.add_argument(
+        "--num-downloads",
+        action="store",
+        default=1,
+        type=int,
+        help=(
+            "Num of packages to download concurrently, at least 1. 1: Serial "
+            "mode. Independent of --num-threads."
+        ),
+    )
+    ap.add_argument(
+        "--download-backend",
+        choices=DOWNLOAD_BACKENDS,
+        default="requests",
+        help=(
+            "How concurrent downloads are driven. 'requests': a thread per "
+            "download. 'asyncio': a single event loop, which scales to many "
+            "more downloads in flight (requires aiohttp)."
+        ),
+    )
+    ap.add_argument(
+        "--jlap",
+        action="store_true",
+        dest="use_jlap",
+        help=(
+            "Update the repodata kept from the previous run by applying the "
+            "patches in the upstream repodata.jlap, instead of downloading "
+            "all of repodata.json again"
+        ),
+        default=False,
+    )
     ap.add_argument(
         "--version",
         action="store_true",
@@ -331,12 +883,48 @@ def _make_arg_parser():
         ),
         default=False,
     )
+    ap.add_argument(
+        "--repodata-zst",
+        action="store_true",
+        help=(
+            "Also write repodata.json.zst, which conda clients decompress much "
+            "faster than repodata.json.bz2 (requires zstandard)"
+        ),
+        default=False,
+    )
+    ap.add_argument(
+        "--current-repodata",
+        action="store_true",
+        help=(
+            "Also write current_repodata.json, which only lists the latest "
+            "version of each package"
+        ),
+        default=False,
+    )
     ap.add_argument(
         "--no-validate-target",
         action="store_true",
         help="Skip validation of files already present in target-directory",
         default=False,
     )
+    ap.add_argument(
+        "--no-validation-cache",
+        action="store_false",
+        dest="validation_cache",
+        help=(
+            "Validate every file in target-directory instead of only the ones "
+            "that changed since they were last validated"
+        ),
+    )
+    ap.add_argument(
+        "--validation-cache-max-age",
+        type=float,
+        default=None,
+        help=(
+            "Validate files in target-directory again once their last "
+            "validation is older than this many days"
+        ),
+    )
     ap.add_argument(
         "--minimum-free-space",
         help=("Threshold for free diskspace. Given in megabytes."),
@@ -456,8 +1044,19 @@ def _parse_and_format_args():
 
     blacklist = config_dict.get("blacklist")
     whitelist = config_dict.get("whitelist")
+    channels = config_dict.get("channels")
 
-    for required in ("target_directory", "platform", "upstream_channel"):
+    if channels is None:
+        required_args = ("target_directory", "platform", "upstream_channel")
+    else:
+        # the platform of each channel defaults to --platform
+        required_args = ("target_directory",)
+        if args.upstream_channel:
+            raise ValueError(
+                "Give either upstream_channel or a list of channels in the "
+                "config file, not both"
+            )
+    for required in required_args:
         if not getattr(args, required):
             raise ValueError("Missing command line argument: %s", required)
 
@@ -483,28 +1082,47 @@ def _parse_and_format_args():
         else:
             url = "{}:{}".format(scheme, url[0])
         proxies = {scheme: url}
-    return {
+    kwargs = {
         "upstream_channel": args.upstream_channel,
         "target_directory": args.target_directory,
         "temp_directory": args.temp_directory,
+        "state_directory": args.state_directory,
         "platform": args.platform,
         "num_threads": args.num_threads,
+        "validation_executor": args.validation_executor,
+        "num_downloads": args.num_downloads,
+        "download_backend": args.download_backend,
+        "use_jlap": args.use_jlap,
         "blacklist": blacklist,
         "whitelist": whitelist,
         "include_depends": args.include_depends,
+        "prefer_conda": args.prefer_conda,
         "dry_run": args.dry_run,
+        "repodata_zst": args.repodata_zst,
+        "current_repodata": args.current_repodata,
         "no_validate_target": args.no_validate_target,
+        "validation_cache": args.validation_cache,
+        "validation_cache_max_age": args.validation_cache_max_age,
         "minimum_free_space": args.minimum_free_space,
         "proxies": proxies,
         "ssl_verify": args.ssl_verify,
         "max_retries": args.max_retries,
         "show_progress": args.show_progress,
     }
+    if channels is not None:
+        del kwargs["upstream_channel"]
+        kwargs["channels"] = channels
+    return kwargs
 
 
 def cli():
-    """Thin wrapper around parsing the cli args and calling main with them"""
-    main(**_parse_and_format_args())
+    """Thin wrapper around parsing the cli args and calling main (or
+    mirror_channels, if the config file lists channels) with them"""
+    kwargs = _parse_and_format_args()
+    if "channels" in kwargs:
+        mirror_channels(**kwargs)
+    else:
+        main(**kwargs)
 
 
 def _remove_package(pkg_path, reason):
@@ -534,10 +1152,50 @@ def _remove_package(pkg_path, reason):
     return pkg_path, msg
 
 
+def _hash_file(filename, algorithm="md5", chunk_size=HASH_CHUNK_SIZE):
+    """Return the hex digest of the file at `filename`, reading it in chunks of
+    `chunk_size` bytes so that memory use does not depend on the file size."""
+    h = hashlib.new(algorithm)
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _read_conda_index(filename):
+    """Read info/index.json from the .conda package at `filename`.
+
+    Only the info-*.tar.zst member of the zip archive is decompressed, and
+    only up to info/index.json; the package contents are not extracted.
+    Without zstandard, the compressed member is read and checked against its
+    CRC instead, and None is returned.
+    """
+    with zipfile.ZipFile(filename) as z:
+        info_names = [
+            name
+            for name in z.namelist()
+            if name.startswith("info-") and name.endswith(".tar.zst")
+        ]
+        if len(info_names) != 1:
+            raise zipfile.BadZipFile("No info-*.tar.zst in %s" % filename)
+        with z.open(info_names[0]) as f:
+            if zstandard is None:
+                while f.read(HASH_CHUNK_SIZE):
+                    pass
+                return None
+            reader = zstandard.ZstdDecompressor().stream_reader(f)
+            with tarfile.open(fileobj=reader, mode="r|") as t:
+                for member in t:
+                    if member.name == "info/index.json":
+                        return t.extractfile(member).read().decode("utf-8")
+    raise KeyError("info/index.json is not in %s" % filename)
+
+
 def _validate(filename, md5=None, size=None):
-    """Validate the conda package tarfile located at `filename` with any of the
+    """Validate the conda package located at `filename` with any of the
     passed in options `md5` or `size. Also implicitly validate that
-    the conda package is a valid tarfile.
+    the conda package is a valid tarfile, or for .conda packages a valid zip
+    archive with an info-*.tar.zst.
 
     NOTE: Removes packages that fail validation
 
@@ -559,7 +1217,7 @@ def _validate(filename, md5=None, size=None):
         The reason why the package is being removed
     """
     if md5:
-        calc = hashlib.md5(open(filename, "rb").read()).hexdigest()
+        calc = _hash_file(filename, "md5")
         if calc == md5:
             # If the MD5 matches, skip the other checks
             return filename, None
@@ -567,12 +1225,25 @@ def _validate(filename, md5=None, size=None):
             return _remove_package(
                 filename,
                 reason="Failed md5 validation. Expected: %s. Computed: %s"
-                % (calc, md5),
+                % (md5, calc),
             )
 
     if size and size != os.stat(filename).st_size:
         return _remove_package(filename, reason="Failed size test")
 
+    if filename.endswith(CONDA_EXTENSION):
+        errors = (zipfile.BadZipFile, tarfile.TarError, KeyError, EOFError)
+        if zstandard is not None:
+            errors += (zstandard.ZstdError,)
+        try:
+            _read_conda_index(filename)
+        except errors:
+            logger.info(
+                "Validation failed because conda package is corrupted.", exc_info=True
+            )
+            return _remove_package(filename, reason="Zipfile read failure")
+        return filename, None
+
     try:
         with tarfile.open(filename) as t:
             t.extractfile("info/index.json").read().decode("utf-8")
@@ -585,7 +1256,9 @@ def _validate(filename, md5=None, size=None):
     return filename, None
 
 
-def get_repodata(channel, platform, proxies=None, ssl_verify=None):
+def get_repodata(
+    channel, platform, proxies=None, ssl_verify=None, session=None, cache_dir=None
+):
     """Get the repodata.json file for a channel/platform combo on anaconda.org
 
     Parameters
@@ -598,156 +1271,1384 @@ def get_repodata(channel, platform, proxies=None, ssl_verify=None):
         Proxys for connecting internet
     ssl_verify : str or bool
         Path to a CA_BUNDLE file or directory with certificates of trusted CAs
+    session : requests.Session, optional
+        HTTP session instance.
+    cache_dir : str, optional
+        Directory to keep a copy of the repodata in. A cached copy is only
+        downloaded again if it changed upstream.
 
     Returns
     -------
     info : dict
     packages : dict
-        keyed on package name (e.g., twisted-16.0.0-py35_0.tar.bz2)
+        keyed on package name (e.g., twisted-16.0.0-py35_0.tar.bz2 or
+        twisted-16.0.0-py35_0.conda)
     """
     url_template, channel = _maybe_split_channel(channel)
     url = url_template.format(
         channel=channel, platform=platform, file_name="repodata.json"
     )
-
-    resp = requests.get(url, proxies=proxies, verify=ssl_verify).json()
-    info = resp.get("info", {})
-    packages = resp.get("packages", {})
-    # Patch the repodata.json so that all package info dicts contain a "subdir"
-    # key.  Apparently some channels on anaconda.org do not contain the
-    # 'subdir' field. I think this this might be relegated to the
-    # Continuum-provided channels only, actually.
-    for pkg_name, pkg_info in packages.items():
-        pkg_info.setdefault("subdir", platform)
-    return info, packages
+    session = session or requests.Session()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        repodata_path, _, _ = _fetch_repodata(
+            url, session, cache_dir or tmp_dir, proxies=proxies, ssl_verify=ssl_verify
+        )
+        return _load_repodata(repodata_path, platform)
 
 
-def _download(
-    url,
-    target_directory,
-    session: requests.Session,
-    *,
-    proxies=None,
-    ssl_verify=None,
-    chunk_size: int = DEFAULT_CHUNK_SIZE,
-    show_progress=False,
+def _fetch_repodata(
+    url, session, cache_dir, *, use_jlap=False, proxies=None, ssl_verify=None
 ):
-    """Download `url` to `target_directory`
+    """Download the repodata.json at `url` into `cache_dir`.
+
+    The compressed variants that channels publish next to repodata.json are
+    preferred: `url` + '.zst' (if zstandard is installed), then `url` +
+    '.bz2' and finally `url` itself, which is requested with gzip transfer
+    encoding. The first variant that exists is decompressed on the fly.
+
+    If `cache_dir` already holds a copy of the repodata, the variant it came
+    from is requested first, conditional on the ETag and Last-Modified headers
+    that were sent with that copy, and the body is only downloaded if it
+    changed upstream.
+
+    With `use_jlap`, a cached copy is instead brought up to date by applying
+    the patches published in repodata.jlap next to `url`, see
+    `_update_repodata_jlap`. The full repodata is only downloaded if that
+    fails.
 
     Parameters
     ----------
     url : str
-        The url to download
-    target_directory : str
-        The path to a directory where `url` should be downloaded
-    session: requests.Session
+        The url of repodata.json
+    session : requests.Session
         HTTP session instance.
+    cache_dir : str
+        Directory to keep the repodata and its response headers in
+    use_jlap : bool, optional
+        Try to update the cached copy from repodata.jlap first
     proxies : dict
         Proxys for connecting internet
     ssl_verify : str or bool
         Path to a CA_BUNDLE file or directory with certificates of trusted CAs
-    show_progress: bool
-        Whether to display progress bars.
 
     Returns
     -------
-    file_size: int
-        The size in bytes of the file that was downloaded
+    repodata_path : str
+        Path to the up to date, uncompressed copy of repodata.json
+    cache_state : dict
+        The url, the validators (ETag, Last-Modified) and the BLAKE2b-256
+        hash of that copy
+    not_modified : bool
+        True if upstream did not change since the copy was downloaded
     """
-    file_size = 0
-    logger.info("download_url=%s", url)
-    # create a temporary file
-    target_filename = url.split("/")[-1]
-    download_filename = os.path.join(target_directory, target_filename)
-    logger.debug("downloading to %s", download_filename)
-    with open(download_filename, "w+b") as tf:
-        ret = session.get(url, stream=True, proxies=proxies, verify=ssl_verify)
-        size = int(ret.headers.get("Content-Length", 0))
-        progress = tqdm(
-            desc=target_filename,
-            disable=(size < 1024) or not show_progress,
-            total=size,
-            leave=False,
-            unit="byte",
-            unit_scale=True,
+    os.makedirs(cache_dir, exist_ok=True)
+    repodata_path = os.path.join(cache_dir, UPSTREAM_REPODATA_FILENAME)
+    state_path = os.path.join(cache_dir, UPSTREAM_REPODATA_STATE_FILENAME)
+    cache_state = _load_json(state_path)
+    if not os.path.exists(repodata_path):
+        cache_state = {}
+
+    if use_jlap and cache_state.get("blake2_256"):
+        try:
+            return _update_repodata_jlap(
+                url,
+                session,
+                cache_dir,
+                cache_state,
+                proxies=proxies,
+                ssl_verify=ssl_verify,
+            )
+        except (jlap.JlapError, requests.RequestException, OSError) as ex:
+            logger.info("Cannot update repodata from jlap, fetching it: %s", ex)
+
+    candidates = [url + ext for ext in REPODATA_COMPRESSIONS if ext in DECOMPRESSORS]
+    candidates.append(url)
+    if cache_state.get("url") in candidates:
+        candidates.remove(cache_state["url"])
+        candidates.insert(0, cache_state["url"])
+
+    for candidate in candidates:
+        headers = {"Accept-Encoding": "gzip"}
+        if candidate == cache_state.get("url"):
+            if cache_state.get("etag"):
+                headers["If-None-Match"] = cache_state["etag"]
+            if cache_state.get("last_modified"):
+                headers["If-Modified-Since"] = cache_state["last_modified"]
+        logger.info("Fetching repodata from %s", candidate)
+        resp = session.get(
+            candidate, headers=headers, stream=True, proxies=proxies, verify=ssl_verify
         )
-        for data in ret.iter_content(chunk_size):
-            tf.write(data)
-            progress.update(len(data))
-        progress.close()
-        file_size = os.path.getsize(download_filename)
-    return file_size
+        if resp.status_code == 304:
+            logger.info(
+                "Upstream repodata not modified, using cached %s", repodata_path
+            )
+            return repodata_path, cache_state, True
+        if candidate != url and 400 <= resp.status_code < 500:
+            logger.debug("%s is not available: %s", candidate, resp.status_code)
+            resp.close()
+            continue
+        resp.raise_for_status()
+        break
+
+    extension = os.path.splitext(candidate)[1]
+    decompressor = DECOMPRESSORS[extension]() if extension in DECOMPRESSORS else None
+    repodata_size = 0
+    repodata_hash = jlap.new_hash()
+    with open(repodata_path + PARTIAL_SUFFIX, "wb") as f:
+        for data in resp.iter_content(DEFAULT_CHUNK_SIZE):
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            f.write(data)
+            repodata_hash.update(data)
+            repodata_size += len(data)
+    os.replace(repodata_path + PARTIAL_SUFFIX, repodata_path)
+    # number of bytes that came over the wire, before any decoding
+    transferred = resp.raw.tell()
+    logger.info(
+        "Fetched %s bytes of repodata in %s bytes from %s, saving %s bytes",
+        repodata_size,
+        transferred,
+        candidate,
+        repodata_size - transferred,
+    )
+    cache_state = {
+        "url": candidate,
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "blake2_256": repodata_hash.hexdigest(),
+    }
+    _write_json(state_path, cache_state)
+    # the position in repodata.jlap belongs to the replaced copy
+    jlap_state_path = os.path.join(cache_dir, UPSTREAM_JLAP_STATE_FILENAME)
+    if os.path.exists(jlap_state_path):
+        os.remove(jlap_state_path)
+    return repodata_path, cache_state, False
 
 
-def _download_backoff_retry(
-    url,
-    target_directory,
-    session: requests.Session,
-    *,
-    proxies=None,
-    ssl_verify=None,
-    chunk_size: int = DEFAULT_CHUNK_SIZE,
-    max_retries: int = 100,
-    show_progress=True,
+def _update_repodata_jlap(
+    url, session, cache_dir, cache_state, *, proxies=None, ssl_verify=None
 ):
-    """Download `url` to `target_directory` with exponential backoff in the
-    event of failure.
+    """Bring the cached copy of the repodata.json at `url` up to date with the
+    patches in the repodata.jlap next to it.
+
+    The first time, the whole repodata.jlap is downloaded. Afterwards only
+    the lines appended since then are requested, using an HTTP Range request
+    that starts at the offset of the footer that was last seen.
 
     Parameters
     ----------
     url : str
-        The url to download
-    target_directory : str
-        The path to a directory where `url` should be downloaded
-    session: requests.Session
+        The url of repodata.json
+    session : requests.Session
         HTTP session instance.
+    cache_dir : str
+        Directory holding the cached repodata, as used by `_fetch_repodata`
+    cache_state : dict
+        The state of the cached repodata, including its BLAKE2b-256 hash
     proxies : dict
         Proxys for connecting internet
     ssl_verify : str or bool
         Path to a CA_BUNDLE file or directory with certificates of trusted CAs
-    chunk_size: int
-        Size of contiguous chunk to download in bytes.
-    max_retries : int, optional
-        The maximum number of times to retry before the download error is reraised,
-        default 100.
-    show_progress: bool
-        Whether to display progress bars.
 
     Returns
     -------
-    file_size: int
-        The size in bytes of the file that was downloaded
+    The same as `_fetch_repodata`.
+
+    Raises
+    ------
+    jlap.JlapError
+        If repodata.jlap is invalid or has no patches from the cached copy to
+        the latest repodata
+    requests.RequestException
+        If repodata.jlap cannot be downloaded
     """
-    c = 0
-    two_c = 1
-    delay = 5.12e-5  # 51.2 us
-    while c < max_retries:
-        c += 1
-        two_c *= 2
+    repodata_path = os.path.join(cache_dir, UPSTREAM_REPODATA_FILENAME)
+    jlap_state_path = os.path.join(cache_dir, UPSTREAM_JLAP_STATE_FILENAME)
+    jlap_state = _load_json(jlap_state_path)
+    jlap_url = url.rsplit("/", 1)[0] + "/repodata.jlap"
+
+    headers = {"Accept-Encoding": "identity"}
+    if jlap_state.get("pos"):
+        headers["Range"] = "bytes=%d-" % jlap_state["pos"]
+    logger.info("Fetching repodata patches from %s", jlap_url)
+    resp = session.get(jlap_url, headers=headers, proxies=proxies, verify=ssl_verify)
+    if resp.status_code == 416:
+        # repodata.jlap was rewritten and is shorter than it used to be
+        del headers["Range"]
+        resp = session.get(
+            jlap_url, headers=headers, proxies=proxies, verify=ssl_verify
+        )
+    resp.raise_for_status()
+    if resp.status_code == 206:
+        offset, iv = jlap_state["pos"], bytes.fromhex(jlap_state["iv"])
+    else:
+        offset, iv = 0, None
+    patches, footer, pos, iv = jlap.parse(resp.content, iv)
+
+    have, latest = cache_state["blake2_256"], footer["latest"]
+    if have != latest:
+        steps = jlap.find_patches(patches, have, latest)
+        with open(repodata_path) as f:
+            repodata = json.load(f)
+        for step in steps:
+            repodata = jlap.apply_patch(repodata, step["patch"])
+        _write_json(repodata_path, repodata)
+        logger.info(
+            "Applied %s repodata patches from %s bytes of %s",
+            len(steps),
+            len(resp.content),
+            jlap_url,
+        )
+        # the validators of the downloaded copy no longer apply
+        cache_state = dict(
+            cache_state, etag=None, last_modified=None, blake2_256=latest
+        )
+        _write_json(
+            os.path.join(cache_dir, UPSTREAM_REPODATA_STATE_FILENAME), cache_state
+        )
+    else:
+        logger.info("Upstream repodata not modified according to %s", jlap_url)
+    _write_json(jlap_state_path, {"pos": offset + pos, "iv": iv.hex()})
+    return repodata_path, cache_state, have == latest
+
+
+class _MultiStreamBZ2Decompressor:
+    """Incremental bz2 decompressor that also handles files made of several
+    concatenated bz2 streams, as produced by parallel compressors."""
+
+    def __init__(self):
+        self._decompressor = bz2.BZ2Decompressor()
+
+    def decompress(self, data):
+        result = []
+        while data:
+            if self._decompressor.eof:
+                self._decompressor = bz2.BZ2Decompressor()
+            result.append(self._decompressor.decompress(data))
+            data = self._decompressor.unused_data if self._decompressor.eof else b""
+        return b"".join(result)
+
+
+# Factories for incremental decompressors, keyed on file extension.
+DECOMPRESSORS = {".bz2": _MultiStreamBZ2Decompressor}
+if zstandard is not None:
+    DECOMPRESSORS[".zst"] = lambda: zstandard.ZstdDecompressor().decompressobj()
+
+
+def _load_repodata(repodata_path, platform):
+    """Read a repodata.json file.
+
+    Parameters
+    ----------
+    repodata_path : str
+        Path to the repodata.json
+    platform : str
+        The platform the repodata belongs to
+
+    Returns
+    -------
+    info : dict
+    packages : dict
+        keyed on package name (e.g., twisted-16.0.0-py35_0.tar.bz2). The
+        .conda packages listed under 'packages.conda' are included, keyed on
+        their file name (e.g., twisted-16.0.0-py35_0.conda).
+    """
+    # Patch the repodata.json so that all package info dicts contain a
+    # "subdir" key.  Apparently some channels on anaconda.org do not
+    # contain the 'subdir' field. I think this this might be relegated
+    # to the Continuum-provided channels only, actually.
+    if os.path.getsize(repodata_path) <= REPODATA_STREAM_SIZE:
+        with open(repodata_path, "r", encoding="utf-8") as f:
+            repodata = json.load(f)
+        packages = {}
+        for section in PACKAGE_SECTIONS:
+            packages.update(repodata.get(section, {}))
+        for value in packages.values():
+            value.setdefault("subdir", platform)
+        return repodata.get("info", {}), packages
+
+    info = {}
+    packages = {}
+    strings = {}
+    for section, key, value in _iter_repodata(repodata_path):
+        if section in PACKAGE_SECTIONS:
+            value.setdefault("subdir", platform)
+            packages[key] = _compact_record(value, strings)
+        elif section is None and key == "info":
+            info = value
+    return info, packages
+
+
+def _compact_record(record, strings):
+    """Shrink a package record by sharing its keys and repeated values.
+
+    Keys and string values (also inside lists, like `depends`) are replaced
+    by the equal string already in `strings`, so that e.g. the keys,
+    license, subdir and common dependencies of many thousands of packages are
+    kept in memory only once.
+
+    Parameters
+    ----------
+    record : dict
+        A package record from repodata.json
+    strings : dict
+        The strings seen so far, mapping each to itself. Updated in place.
+
+    Returns
+    -------
+    dict
+        The compacted record
+    """
+    share = strings.setdefault
+    compact = {}
+    for key, value in record.items():
+        key = share(key, key)
+        if type(value) is str:
+            if key not in UNIQUE_RECORD_FIELDS:
+                value = share(value, value)
+        elif type(value) is list:
+            value = [share(v, v) if type(v) is str else v for v in value]
+        compact[key] = value
+    return compact
+
+
+class _JSONStream:
+    """Incremental reader for a json document in a text file.
+
+    Values are decoded one at a time with the C accelerated json decoder while
+    only a small window of the file is held in memory.
+    """
+
+    _decoder = json.JSONDecoder()
+    _whitespace = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, f, chunk_size=REPODATA_CHUNK_SIZE):
+        self._file = f
+        self._chunk_size = chunk_size
+        self._buffer = ""
+        self._pos = 0
+
+    def _fill(self):
+        data = self._file.read(self._chunk_size)
+        if not data:
+            return False
+        pos = self._pos
+        self._buffer = self._buffer[pos:] + data
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            self._pos = self._whitespace.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(
+                "Expected %r in json document, found %r" % (char, self._peek())
+            )
+        self._pos += 1
+
+    def value(self):
+        """Decode the next value."""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the file
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def members(self):
+        """Iterate over the keys of the next value, which must be an object.
+
+        The value of each key has to be consumed, with `value` or `members`,
+        before the iteration continues.
+        """
+        self._expect("{")
+        if self._peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(":")
+            yield key
+            separator = self._peek()
+            self._pos += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError("Expected ',' or '}' in json document")
+
+
+def _iter_repodata(repodata_path, chunk_size=REPODATA_CHUNK_SIZE):
+    """Iterate over a repodata.json file without reading it into memory.
+
+    Parameters
+    ----------
+    repodata_path : str
+        Path to the repodata.json
+    chunk_size : int, optional
+        Size of the blocks the file is read in
+
+    Yields
+    ------
+    section : str or None
+        The package section ('packages' or 'packages.conda') the entry is
+        part of, or None for the other top level entries
+    key : str
+        The package file name, or the name of the top level entry
+    value
+        The package record, or the value of the top level entry
+    """
+    with open(repodata_path, "r", encoding="utf-8") as f:
+        stream = _JSONStream(f, chunk_size)
+        for key in stream.members():
+            if key in PACKAGE_SECTIONS:
+                for filename in stream.members():
+                    yield key, filename, stream.value()
+            else:
+                yield None, key, stream.value()
+
+
+def _load_json(path):
+    """Load the json state file at `path`, or an empty dict if there is none."""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        logger.warning("Ignoring unreadable state file %s", path, exc_info=True)
+        return {}
+
+
+def _write_json(path, data):
+    """Atomically write `data` as json to the state file at `path`."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + PARTIAL_SUFFIX, "w") as f:
+        json.dump(data, f, sort_keys=True)
+    os.replace(path + PARTIAL_SUFFIX, path)
+
+
+def _config_fingerprint(**config):
+    """Hash the settings that determine which packages end up in the mirror."""
+    data = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _new_hashers(md5=None, sha256=None):
+    """Return the hash objects needed to verify a download against the
+    expected `md5` and `sha256` hex digests, keyed on algorithm name."""
+    expected = {"md5": md5, "sha256": sha256}
+    return {algo: hashlib.new(algo) for algo, digest in expected.items() if digest}
+
+
+def _check_download(filename, file_size, hashers, md5=None, sha256=None, size=None):
+    """Verify a streamed download against the repodata entry of the package.
+
+    NOTE: Removes `filename` if it fails verification
+
+    Parameters
+    ----------
+    filename : str
+        The path to the downloaded file
+    file_size : int
+        Number of bytes that were written to `filename`
+    hashers : dict
+        Hash objects from `_new_hashers` fed with the downloaded bytes
+    md5, sha256 : str, optional
+        Expected hex digests
+    size : int, optional
+        Expected size in bytes
+
+    Raises
+    ------
+    ChecksumMismatchError
+        If the size or any of the digests does not match
+    """
+    expected = {"md5": md5, "sha256": sha256}
+    if size and size != file_size:
+        reason = "Failed size test. Expected: %s. Downloaded: %s" % (size, file_size)
+    else:
+        reason = None
+        for algo, h in hashers.items():
+            calc = h.hexdigest()
+            if calc != expected[algo]:
+                reason = "Failed %s validation. Expected: %s. Computed: %s" % (
+                    algo,
+                    expected[algo],
+                    calc,
+                )
+                break
+    if reason is not None:
+        os.remove(filename)
+        raise ChecksumMismatchError(reason)
+
+
+def _resume_download(url, partial_filename, hashers):
+    """Prepare to resume the download of `url` into `partial_filename`.
+
+    The bytes that were downloaded already are fed to `hashers`. A partial
+    download that cannot be resumed, because the response it came from had
+    neither a strong ETag nor a Last-Modified header, is discarded.
+
+    Returns
+    -------
+    offset : int
+        Number of bytes downloaded already
+    headers : dict
+        Headers to request the rest of `url`, or all of it if it changed
+        upstream since
+    """
+    state = _load_json(partial_filename + RESUME_STATE_SUFFIX)
+    validator = state.get("etag") or state.get("last_modified")
+    if state.get("url") != url or not validator:
+        _discard_partial_download(partial_filename)
+        return 0, {}
+    offset = 0
+    try:
+        with open(partial_filename, "rb") as f:
+            for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                for h in hashers.values():
+                    h.update(block)
+                offset += len(block)
+    except FileNotFoundError:
+        pass
+    if not offset:
+        return 0, {}
+    logger.info("resuming download of %s at byte %s", url, offset)
+    return offset, {"Range": "bytes=%d-" % offset, "If-Range": validator}
+
+
+def _check_download_status(url, status, offset=0):
+    """Raise if `status` is not a successful answer to the download of `url`.
+
+    This is checked before anything is written, so that a partial download
+    of `offset` bytes is kept for the next attempt. A 416 answer to a resumed
+    download is left to `_start_download`.
+
+    Raises
+    ------
+    PackageUnavailableError
+        For client errors, which retrying does not help with
+    requests.HTTPError
+        For the other errors, e.g. when upstream is temporarily unavailable
+    """
+    if offset and status == 416:
+        return
+    if 400 <= status < 500 and status not in RETRY_STATUSES:
+        raise PackageUnavailableError("%s: HTTP status %s" % (url, status))
+    if not 200 <= status < 300:
+        raise requests.HTTPError("%s: HTTP status %s" % (url, status))
+
+
+def _start_download(url, partial_filename, offset, status, headers, hashers):
+    """Check whether the response to a download request continues the
+    partial download of `offset` bytes.
+
+    If it is a complete (200) response instead, `hashers` are reset and the
+    state needed to resume the new download later is saved. Any other
+    response leaves the partial download and its state untouched.
+
+    Returns
+    -------
+    offset : int
+        Byte offset in `partial_filename` the response body starts at
+
+    Raises
+    ------
+    requests.HTTPError
+        If the partial download is not a prefix of the file upstream, or the
+        response neither continues it nor is complete
+    """
+    content_range = headers.get("Content-Range", "")
+    if offset and status == 206 and content_range.startswith("bytes %d-" % offset):
+        return offset
+    if offset and status == 416:
+        _discard_partial_download(partial_filename)
+        raise requests.HTTPError("%s: cannot resume at byte %s" % (url, offset))
+    if status != 200:
+        raise requests.HTTPError(
+            "%s: unexpected HTTP status %s for a download from byte %s"
+            % (url, status, offset)
+        )
+    for algo in hashers:
+        hashers[algo] = hashlib.new(algo)
+    etag = headers.get("ETag", "")
+    state = {
+        "url": url,
+        # weak ETags cannot be used in If-Range
+        "etag": None if etag.startswith("W/") else etag or None,
+        "last_modified": headers.get("Last-Modified"),
+    }
+    state_path = partial_filename + RESUME_STATE_SUFFIX
+    if state["etag"] or state["last_modified"]:
+        _write_json(state_path, state)
+    elif os.path.exists(state_path):
+        os.remove(state_path)
+    return 0
+
+
+def _write_chunk(f, data, hashers):
+    """Append a downloaded chunk to `f` and feed it to `hashers`."""
+    f.write(data)
+    for h in hashers.values():
+        h.update(data)
+
+
+def _finish_download(partial_filename, download_filename, file_size, hashers, **kw):
+    """Verify a finished download with `_check_download` and move it to
+    `download_filename`. The partial download is removed either way."""
+    try:
+        _check_download(partial_filename, file_size, hashers, **kw)
+        os.replace(partial_filename, download_filename)
+    finally:
+        _discard_partial_download(partial_filename)
+
+
+def _discard_partial_download(partial_filename):
+    """Remove a partial download and its resume state."""
+    for path in (partial_filename, partial_filename + RESUME_STATE_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _download(
+    url,
+    target_directory,
+    session: requests.Session,
+    *,
+    proxies=None,
+    ssl_verify=None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    show_progress=False,
+    md5=None,
+    sha256=None,
+    size=None,
+):
+    """Download `url` to `target_directory`
+
+    The file is hashed while it is being downloaded and only moved to its
+    final name in `target_directory` once it matches `md5`, `sha256` and
+    `size` (when given). If a previous attempt was interrupted, the download
+    is resumed with a Range request, unless the file changed upstream since.
+
+    Parameters
+    ----------
+    url : str
+        The url to download
+    target_directory : str
+        The path to a directory where `url` should be downloaded
+    session: requests.Session
+        HTTP session instance.
+    proxies : dict
+        Proxys for connecting internet
+    ssl_verify : str or bool
+        Path to a CA_BUNDLE file or directory with certificates of trusted CAs
+    show_progress: bool
+        Whether to display progress bars.
+    md5 : str, optional
+        Expected md5 hex digest of the file
+    sha256 : str, optional
+        Expected sha256 hex digest of the file
+    size : int, optional
+        Expected size of the file in bytes
+
+    Returns
+    -------
+    file_size: int
+        The size in bytes of the file that was downloaded
+
+    Raises
+    ------
+    ChecksumMismatchError
+        If the downloaded file does not match `md5`, `sha256` or `size`
+    PackageUnavailableError
+        If upstream answers with a client error
+    requests.HTTPError
+        If upstream answers with another error
+    """
+    file_size = 0
+    logger.info("download_url=%s", url)
+    # create a temporary file
+    target_filename = url.split("/")[-1]
+    download_filename = os.path.join(target_directory, target_filename)
+    partial_filename = download_filename + PARTIAL_SUFFIX
+    logger.debug("downloading to %s", download_filename)
+    hashers = _new_hashers(md5, sha256)
+    file_size, headers = _resume_download(url, partial_filename, hashers)
+    # an attempt that was interrupted after the last byte has all of it
+    if not (size and file_size >= size):
+        ret = session.get(
+            url, stream=True, headers=headers, proxies=proxies, verify=ssl_verify
+        )
+        _check_download_status(url, ret.status_code, file_size)
+        file_size = _start_download(
+            url, partial_filename, file_size, ret.status_code, ret.headers, hashers
+        )
+        content_length = int(ret.headers.get("Content-Length", 0))
+        progress = tqdm(
+            desc=target_filename,
+            disable=(content_length < 1024) or not show_progress,
+            initial=file_size,
+            total=file_size + content_length,
+            leave=False,
+            unit="byte",
+            unit_scale=True,
+        )
+        with open(partial_filename, "ab" if file_size else "wb") as tf:
+            for data in ret.iter_content(chunk_size):
+                _write_chunk(tf, data, hashers)
+                file_size += len(data)
+                progress.update(len(data))
+        progress.close()
+    _finish_download(
+        partial_filename,
+        download_filename,
+        file_size,
+        hashers,
+        md5=md5,
+        sha256=sha256,
+        size=size,
+    )
+    return file_size
+
+
+def _download_backoff_retry(
+    url,
+    target_directory,
+    session: requests.Session,
+    *,
+    proxies=None,
+    ssl_verify=None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_retries: int = 100,
+    show_progress=True,
+    md5=None,
+    sha256=None,
+    size=None,
+):
+    """Download `url` to `target_directory` with exponential backoff in the
+    event of failure.
+
+    Each retry continues the download where the attempt before it stopped,
+    see `_download`. A `RejectedDownloadError` is raised right away.
+
+    Parameters
+    ----------
+    url : str
+        The url to download
+    target_directory : str
+        The path to a directory where `url` should be downloaded
+    session: requests.Session
+        HTTP session instance.
+    proxies : dict
+        Proxys for connecting internet
+    ssl_verify : str or bool
+        Path to a CA_BUNDLE file or directory with certificates of trusted CAs
+    chunk_size: int
+        Size of contiguous chunk to download in bytes.
+    max_retries : int, optional
+        The maximum number of times to retry before the download error is reraised,
+        default 100.
+    show_progress: bool
+        Whether to display progress bars.
+    md5, sha256, size : optional
+        Expected digests and size of the file, see `_download`.
+
+    Returns
+    -------
+    file_size: int
+        The size in bytes of the file that was downloaded
+    """
+    c = 0
+    two_c = 1
+    delay = 5.12e-5  # 51.2 us
+    while c < max_retries:
+        c += 1
+        two_c *= 2
+        try:
+            rtn = _download(
+                url,
+                target_directory,
+                session,
+                proxies=proxies,
+                ssl_verify=ssl_verify,
+                chunk_size=chunk_size,
+                show_progress=show_progress,
+                md5=md5,
+                sha256=sha256,
+                size=size,
+            )
+            break
+        except RejectedDownloadError:
+            raise
+        except Exception:
+            if c < max_retries:
+                logger.debug(
+                    "downloading failed, retrying {0}/{1}".format(c, max_retries)
+                )
+                time.sleep(delay * random.randint(0, two_c - 1))
+            else:
+                raise
+    return rtn
+
+
+def _make_session(num_downloads=1, num_hosts=1):
+    """Create the HTTP session shared by all download workers.
+
+    Parameters
+    ----------
+    num_downloads : int
+        Number of downloads that will be in flight at the same time. The
+        connection pool is sized so that no worker has to wait for, or throw
+        away, a connection.
+    num_hosts : int
+        Number of upstream hosts that will be downloaded from. The pool of
+        each is kept, instead of being replaced by the pool of another.
+
+    Returns
+    -------
+    session : requests.Session
+    """
+    pool_size = max(num_downloads, DEFAULT_POOL_SIZE)
+    adapter = HTTPAdapter(
+        pool_connections=max(num_hosts, DEFAULT_POOL_SIZE), pool_maxsize=pool_size
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Where a package is downloaded to, where it is moved to afterwards, and the
+# repodata packages it is verified against.
+_DownloadTarget = namedtuple(
+    "_DownloadTarget", ["download_dir", "local_directory", "package_repodata"]
+)
+
+
+def _expected_digests(package_repodata, url):
+    """Look up the md5, sha256 and size the repodata lists for `url`."""
+    info = (package_repodata or {}).get(url.split("/")[-1], {})
+    return {key: info.get(key) for key in ("md5", "sha256", "size")}
+
+
+def _download_packages(
+    urls,
+    download_dir,
+    local_directory,
+    session: requests.Session,
+    *,
+    package_repodata=None,
+    num_downloads: int = 1,
+    minimum_free_space: int = 0,
+    proxies=None,
+    ssl_verify=None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_retries: int = 100,
+    show_progress: bool = True,
+    desc=None,
+    on_download=None,
+    targets=None,
+):
+    """Download `urls` to `download_dir` keeping up to `num_downloads`
+    transfers in flight.
+
+    Each url is retried independently with `_download_backoff_retry`. No new
+    downloads are started once a download finally fails or either
+    `download_dir` or `local_directory` drops below `minimum_free_space`;
+    downloads that are already in flight are allowed to finish. A package
+    that does not match its entry in `package_repodata` is rejected without
+    aborting the other downloads, as is one that upstream answers with a
+    client error.
+
+    Parameters
+    ----------
+    urls : list
+        The urls to download
+    download_dir : str
+        The path to a directory where the urls should be downloaded
+    local_directory : str
+        The directory the downloads will be moved to afterwards
+    session: requests.Session
+        HTTP session instance shared by all workers.
+    package_repodata : dict, optional
+        The 'packages' of repodata.json, used to verify each download while
+        it is streamed.
+    num_downloads : int
+        Maximum number of concurrent downloads.
+    minimum_free_space : int
+        Threshold for free disk space in megabytes.
+    proxies : dict
+        Proxys for connecting internet
+    ssl_verify : str or bool
+        Path to a CA_BUNDLE file or directory with certificates of trusted CAs
+    chunk_size: int
+        Size of contiguous chunk to download in bytes.
+    max_retries : int, optional
+        The maximum number of times to retry before the download error is reraised,
+        default 100.
+    show_progress: bool
+        Whether to display progress bars.
+    desc : str, optional
+        Label of the overall progress bar.
+    on_download : callable, optional
+        Called with each url as soon as it was downloaded and verified.
+    targets : dict, optional
+        Maps urls to the `_DownloadTarget` they are downloaded for, to
+        download packages of several platforms in one go. `download_dir`,
+        `local_directory` and `package_repodata` are the target of the other
+        urls.
+
+    Returns
+    -------
+    downloaded : list
+        The urls that were downloaded successfully
+    rejected : list
+        Twoples of (pkg_path, reason) for the downloads that failed
+        verification and were removed, or that upstream did not serve
+    """
+    default_target = _DownloadTarget(download_dir, local_directory, package_repodata)
+    targets = targets or {}
+    downloaded = []
+    rejected = []
+    total_bytes = 0
+    minimum_free_space_kb = minimum_free_space * 1024 * 1024
+    remaining = iter(urls)
+    pending = {}
+    aborted = False
+    progress = tqdm(
+        total=len(urls),
+        desc=desc,
+        unit="package",
+        leave=False,
+        disable=not show_progress,
+    )
+    with ThreadPoolExecutor(max_workers=max(num_downloads, 1)) as executor:
+        while True:
+            while not aborted and len(pending) < num_downloads:
+                url = next(remaining, None)
+                if url is None:
+                    break
+                target = targets.get(url, default_target)
+                # make sure we have enough free disk space in the temp folder to
+                # meet threshold
+                if shutil.disk_usage(target.download_dir).free < minimum_free_space_kb:
+                    logger.error(
+                        "Disk space below threshold in %s. Aborting download.",
+                        target.download_dir,
+                    )
+                    aborted = True
+                    break
+                future = executor.submit(
+                    _download_backoff_retry,
+                    url,
+                    target.download_dir,
+                    session,
+                    proxies=proxies,
+                    ssl_verify=ssl_verify,
+                    chunk_size=chunk_size,
+                    max_retries=max_retries,
+                    show_progress=show_progress,
+                    **_expected_digests(target.package_repodata, url),
+                )
+                pending[future] = url
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                url = pending.pop(future)
+                target = targets.get(url, default_target)
+                progress.update(1)
+                try:
+                    total_bytes += future.result()
+                except RejectedDownloadError as ex:
+                    pkg_path = os.path.join(target.download_dir, url.split("/")[-1])
+                    logger.error("Removing: %s. Reason: %s", pkg_path, ex)
+                    rejected.append((pkg_path, str(ex)))
+                    continue
+                except Exception as ex:
+                    logger.exception("Unexpected error: %s. Aborting download.", ex)
+                    aborted = True
+                    continue
+                if on_download is not None:
+                    on_download(url)
+                # make sure we have enough free disk space in the target folder to
+                # meet threshold while also being able to fit the packages we have
+                # already downloaded
+                if (
+                    shutil.disk_usage(target.local_directory).free - total_bytes
+                ) < minimum_free_space_kb:
+                    logger.error(
+                        "Disk space below threshold in %s. Aborting download",
+                        target.local_directory,
+                    )
+                    aborted = True
+                    continue
+                downloaded.append(url)
+    progress.close()
+    return downloaded, rejected
+
+
+def _aiohttp_ssl(ssl_verify):
+    """Translate a requests style `ssl_verify` into aiohttp's `ssl` argument."""
+    if ssl_verify is None or ssl_verify is True:
+        return None
+    if ssl_verify is False:
+        return False
+    if os.path.isdir(ssl_verify):
+        return ssl.create_default_context(capath=ssl_verify)
+    return ssl.create_default_context(cafile=ssl_verify)
+
+
+async def _download_async(
+    url,
+    target_directory,
+    session,
+    *,
+    proxies=None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    md5=None,
+    sha256=None,
+    size=None,
+    executor=None,
+):
+    """Download `url` to `target_directory` with an aiohttp session.
+
+    This is the asyncio counterpart of `_download`. Writing and hashing the
+    chunks, like every other file operation, is done in `executor`, so that
+    the event loop keeps serving the other downloads in the meantime.
+
+    Parameters
+    ----------
+    url : str
+        The url to download
+    target_directory : str
+        The path to a directory where `url` should be downloaded
+    session: aiohttp.ClientSession
+        HTTP session instance.
+    proxies : dict
+        Proxys for connecting internet
+    chunk_size: int
+        Size of contiguous chunk to download in bytes.
+    md5, sha256, size : optional
+        Expected digests and size of the file, see `_download`.
+    executor : concurrent.futures.Executor, optional
+        Where the file operations are run. Defaults to the default executor
+        of the event loop.
+
+    Returns
+    -------
+    file_size: int
+        The size in bytes of the file that was downloaded
+    """
+    loop = asyncio.get_running_loop()
+
+    def run(function, *args, **kwargs):
+        return loop.run_in_executor(
+            executor, functools.partial(function, *args, **kwargs)
+        )
+
+    logger.info("download_url=%s", url)
+    target_filename = url.split("/")[-1]
+    download_filename = os.path.join(target_directory, target_filename)
+    partial_filename = download_filename + PARTIAL_SUFFIX
+    logger.debug("downloading to %s", download_filename)
+    proxy = (proxies or {}).get(url.split(":", 1)[0])
+    hashers = _new_hashers(md5, sha256)
+    file_size, headers = await run(_resume_download, url, partial_filename, hashers)
+    if not (size and file_size >= size):
+        async with session.get(url, headers=headers, proxy=proxy) as ret:
+            _check_download_status(url, ret.status, file_size)
+            # the response is read as fast as it arrives, as aiohttp drops
+            # what it buffered when the connection breaks, and written to
+            # disk by a separate task
+            chunks = asyncio.Queue(maxsize=ASYNC_WRITE_QUEUE_SIZE)
+
+            async def write(offset):
+                error = tf = None
+                try:
+                    offset = await run(
+                        _start_download,
+                        url,
+                        partial_filename,
+                        offset,
+                        ret.status,
+                        ret.headers,
+                        hashers,
+                    )
+                    tf = await run(open, partial_filename, "ab" if offset else "wb")
+                except Exception as ex:
+                    error = ex
+                while True:
+                    data = await chunks.get()
+                    if data is None:
+                        break
+                    if error is None:
+                        try:
+                            await run(_write_chunk, tf, data, hashers)
+                        except Exception as ex:
+                            error = ex
+                    # after an error, keep taking chunks so the reader is not
+                    # stuck
+                if tf is not None:
+                    await run(tf.close)
+                if error is not None:
+                    raise error
+                return offset
+
+            writer = asyncio.ensure_future(write(file_size))
+            received = 0
+            try:
+                async for data in ret.content.iter_chunked(chunk_size):
+                    await chunks.put(data)
+                    received += len(data)
+            finally:
+                # the chunks received before an error are still written, so
+                # that a retry resumes after them
+                await chunks.put(None)
+                file_size = await writer + received
+    await run(
+        _finish_download,
+        partial_filename,
+        download_filename,
+        file_size,
+        hashers,
+        md5=md5,
+        sha256=sha256,
+        size=size,
+    )
+    return file_size
+
+
+async def _download_backoff_retry_async(
+    url,
+    target_directory,
+    session,
+    *,
+    proxies=None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_retries: int = 100,
+    md5=None,
+    sha256=None,
+    size=None,
+    executor=None,
+):
+    """Download `url` to `target_directory` with exponential backoff in the
+    event of failure.
+
+    This is the asyncio counterpart of `_download_backoff_retry`.
+
+    Returns
+    -------
+    file_size: int
+        The size in bytes of the file that was downloaded
+    """
+    c = 0
+    two_c = 1
+    delay = 5.12e-5  # 51.2 us
+    while c < max_retries:
+        c += 1
+        two_c *= 2
         try:
-            rtn = _download(
+            rtn = await _download_async(
                 url,
                 target_directory,
                 session,
                 proxies=proxies,
-                ssl_verify=ssl_verify,
                 chunk_size=chunk_size,
-                show_progress=show_progress,
+                md5=md5,
+                sha256=sha256,
+                size=size,
+                executor=executor,
             )
             break
+        except RejectedDownloadError:
+            raise
         except Exception:
             if c < max_retries:
                 logger.debug(
                     "downloading failed, retrying {0}/{1}".format(c, max_retries)
                 )
-                time.sleep(delay * random.randint(0, two_c - 1))
+                await asyncio.sleep(delay * random.randint(0, two_c - 1))
             else:
                 raise
     return rtn
 
 
+def _download_packages_async(
+    urls,
+    download_dir,
+    local_directory,
+    *,
+    package_repodata=None,
+    num_downloads: int = 1,
+    minimum_free_space: int = 0,
+    proxies=None,
+    ssl_verify=None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_retries: int = 100,
+    show_progress: bool = True,
+    desc=None,
+    on_download=None,
+    targets=None,
+):
+    """Download `urls` to `download_dir` from a single asyncio event loop.
+
+    Same contract as `_download_packages`, but `num_downloads` requests are
+    kept in flight by coroutines sharing one aiohttp connection pool instead
+    of by threads. The chunks are written to disk and hashed by a small pool
+    of writer threads, off the event loop. Requires the optional `aiohttp`
+    dependency.
+
+    Returns
+    -------
+    downloaded : list
+        The urls that were downloaded successfully
+    rejected : list
+        Twoples of (pkg_path, reason) for the downloads that failed
+        verification and were removed
+    """
+    if aiohttp is None:
+        raise ImportError("The asyncio download backend requires aiohttp")
+    return asyncio.run(
+        _download_all_async(
+            urls,
+            download_dir,
+            local_directory,
+            package_repodata=package_repodata,
+            num_downloads=max(num_downloads, 1),
+            minimum_free_space=minimum_free_space,
+            proxies=proxies,
+            ssl_verify=ssl_verify,
+            chunk_size=chunk_size,
+            max_retries=max_retries,
+            show_progress=show_progress,
+            desc=desc,
+            on_download=on_download,
+            targets=targets or {},
+        )
+    )
+
+
+async def _download_all_async(
+    urls,
+    download_dir,
+    local_directory,
+    *,
+    package_repodata,
+    num_downloads,
+    minimum_free_space,
+    proxies,
+    ssl_verify,
+    chunk_size,
+    max_retries,
+    show_progress,
+    desc,
+    on_download,
+    targets,
+):
+    default_target = _DownloadTarget(download_dir, local_directory, package_repodata)
+    downloaded = []
+    rejected = []
+    state = {"total_bytes": 0, "aborted": False}
+    minimum_free_space_kb = minimum_free_space * 1024 * 1024
+    remaining = iter(urls)
+    progress = tqdm(
+        total=len(urls),
+        desc=desc,
+        unit="package",
+        leave=False,
+        disable=not show_progress,
+    )
+    connector = aiohttp.TCPConnector(limit=num_downloads, ssl=_aiohttp_ssl(ssl_verify))
+
+    async def worker(session):
+        # the workers share one iterator, so at most `num_downloads`
+        # transfers are in flight at any time
+        for url in remaining:
+            if state["aborted"]:
+                return
+            target = targets.get(url, default_target)
+            # make sure we have enough free disk space in the temp folder to
+            # meet threshold
+            if shutil.disk_usage(target.download_dir).free < minimum_free_space_kb:
+                logger.error(
+                    "Disk space below threshold in %s. Aborting download.",
+                    target.download_dir,
+                )
+                state["aborted"] = True
+                return
+            try:
+                state["total_bytes"] += await _download_backoff_retry_async(
+                    url,
+                    target.download_dir,
+                    session,
+                    proxies=proxies,
+                    chunk_size=chunk_size,
+                    max_retries=max_retries,
+                    executor=writers,
+                    **_expected_digests(target.package_repodata, url),
+                )
+            except RejectedDownloadError as ex:
+                pkg_path = os.path.join(target.download_dir, url.split("/")[-1])
+                logger.error("Removing: %s. Reason: %s", pkg_path, ex)
+                rejected.append((pkg_path, str(ex)))
+                continue
+            except Exception as ex:
+                logger.exception("Unexpected error: %s. Aborting download.", ex)
+                state["aborted"] = True
+                return
+            finally:
+                progress.update(1)
+            if on_download is not None:
+                # e.g. the journal of the staging directory, which is synced
+                await asyncio.get_running_loop().run_in_executor(
+                    writers, on_download, url
+                )
+            # make sure we have enough free disk space in the target folder to
+            # meet threshold while also being able to fit the packages we have
+            # already downloaded
+            if (
+                shutil.disk_usage(target.local_directory).free - state["total_bytes"]
+            ) < minimum_free_space_kb:
+                logger.error(
+                    "Disk space below threshold in %s. Aborting download",
+                    target.local_directory,
+                )
+                state["aborted"] = True
+                return
+            downloaded.append(url)
+
+    # like requests, do not put an upper bound on the duration of a download
+    timeout = aiohttp.ClientTimeout(total=None)
+    # hashlib releases the GIL while hashing, so a few threads keep up with
+    # many transfers
+    writers = ThreadPoolExecutor(max_workers=min(num_downloads, ASYNC_WRITER_THREADS))
+    try:
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout
+        ) as session:
+            await asyncio.gather(*(worker(session) for _ in range(num_downloads)))
+    finally:
+        writers.shutdown()
+    progress.close()
+    return downloaded, rejected
+
+
 def _list_conda_packages(local_dir):
-    """List the conda packages (*.tar.bz2 files) in `local_dir`
+    """List the conda packages (*.tar.bz2 and *.conda files) in `local_dir`
 
     Parameters
     ----------
@@ -759,125 +2660,1084 @@ def _list_conda_packages(local_dir):
     list
         List of conda packages in `local_dir`
     """
-    contents = os.listdir(local_dir)
-    return fnmatch.filter(contents, "*.tar.bz2")
+    contents = os.listdir(local_dir)
+    return [
+        filename
+        for filename in contents
+        if filename.endswith((TAR_BZ2_EXTENSION, CONDA_EXTENSION))
+    ]
+
+
+def _load_validation_cache(cache_directory):
+    """Load the validation cache kept in `cache_directory`.
+
+    Parameters
+    ----------
+    cache_directory : str
+        The state directory of the local repo that contains conda packages
+
+    Returns
+    -------
+    dict
+        Maps package file names to the stat information and md5 they were
+        last validated with. Empty if there is no usable cache.
+    """
+    path = os.path.join(cache_directory, VALIDATION_CACHE_FILENAME)
+    return _load_json(path).get("packages", {})
+
+
+def _save_validation_cache(cache_directory, cache):
+    """Atomically write the validation cache into `cache_directory`."""
+    _write_json(
+        os.path.join(cache_directory, VALIDATION_CACHE_FILENAME), {"packages": cache}
+    )
+
+
+def _validation_cache_entry(package_path, md5):
+    """Describe the file at `package_path` as validated against `md5`."""
+    st = os.stat(package_path)
+    return {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "inode": st.st_ino,
+        "md5": md5,
+        "validated": time.time(),
+    }
+
+
+def _is_cached_valid(entry, package_path, md5, max_age=None):
+    """Check whether `package_path` still is what the cache `entry` says was
+    validated against `md5`, and that validation is not older than `max_age`
+    seconds."""
+    if not entry or entry.get("md5") != md5:
+        return False
+    if max_age is not None and time.time() - entry.get("validated", 0) > max_age:
+        return False
+    try:
+        st = os.stat(package_path)
+    except OSError:
+        return False
+    return (st.st_size, st.st_mtime_ns, st.st_ino) == (
+        entry.get("size"),
+        entry.get("mtime_ns"),
+        entry.get("inode"),
+    )
+
+
+def _update_validation_cache(
+    package_directory, package_repodata, package_names, cache_directory
+):
+    """Record `package_names` in `package_directory` as validated in the cache
+    in `cache_directory`, e.g. after they were verified while downloading
+    and moved into the repo."""
+    cache = _load_validation_cache(cache_directory)
+    for package in package_names:
+        package_path = os.path.join(package_directory, package)
+        md5 = package_repodata.get(package, {}).get("md5")
+        cache[package] = _validation_cache_entry(package_path, md5)
+    _save_validation_cache(cache_directory, cache)
+
+
+def _validate_packages(
+    package_repodata,
+    package_directory,
+    num_threads=1,
+    verified=None,
+    cache_directory=None,
+    cache_max_age=None,
+    validation_executor=None,
+    pool=None,
+):
+    """Validate local conda packages.
+
+    NOTE1: This will remove any packages that are in `package_directory` that
+           are not in `repodata` and also any packages that fail the package
+           validation
+    NOTE2: In process mode this might be hard to kill using CTRL-C.
+
+    Parameters
+    ----------
+    package_repodata : dict
+        The contents of repodata.json
+    package_directory : str
+        Path to the local repo that contains conda packages
+    num_threads : int
+        Number of concurrent threads or processes to use. Set to `0` to use a
+        number equal to the number of cores in the system. Defaults to `1`
+        (i.e. serial package validation).
+    verified : set, optional
+        Names of packages that were already checked against `package_repodata`
+        while they were downloaded. These are not hashed again.
+    cache_directory : str, optional
+        Skip packages whose size, mtime, inode and expected md5 are unchanged
+        since they were last validated, and remember the packages that pass
+        validation in a cache file in this directory. By default, no cache
+        is used.
+    cache_max_age : float, optional
+        Validate cached packages again once their last validation is older
+        than this many seconds. By default cache entries never expire.
+    validation_executor : {'serial', 'thread', 'process'}, optional
+        How packages are validated concurrently. Defaults to 'serial' when
+        `num_threads` is 1 and to 'process' otherwise.
+    pool : multiprocessing.pool.Pool, optional
+        Validate the packages in this pool, see `_validation_pool`, instead
+        of one made for this call according to `validation_executor`.
+
+    Returns
+    -------
+    list
+        Iterable of twoples of (pkg_path, reason) where
+        pkg_path : str
+            The full path to the package that is being removed
+        reason : str
+            The reason why the package is being removed
+    """
+    # validate local conda packages
+    local_packages = _list_conda_packages(package_directory)
+    verified_results = []
+    if verified:
+        verified_results = [
+            (os.path.join(package_directory, package), None)
+            for package in local_packages
+            if package in verified
+        ]
+        local_packages = [
+            package for package in local_packages if package not in verified
+        ]
+    if cache_directory is not None:
+        cache = _load_validation_cache(cache_directory)
+        unchanged = [
+            package
+            for package in local_packages
+            if package in package_repodata
+            and _is_cached_valid(
+                cache.get(package),
+                os.path.join(package_directory, package),
+                package_repodata[package].get("md5"),
+                cache_max_age,
+            )
+        ]
+        logger.info(
+            "Skipping validation of %s unchanged packages in %s",
+            len(unchanged),
+            package_directory,
+        )
+        verified_results.extend(
+            (os.path.join(package_directory, package), None) for package in unchanged
+        )
+        unchanged = set(unchanged)
+        local_packages = [
+            package for package in local_packages if package not in unchanged
+        ]
+
+    # packages that are not in the upstream index are removed right away, so
+    # the workers only need the name, md5 and size of the packages to hash
+    validation_results = []
+    to_validate = []
+    for package in sorted(local_packages):
+        package_path = os.path.join(package_directory, package)
+        try:
+            package_metadata = package_repodata[package]
+        except KeyError:
+            logger.warning("%s is not in the upstream index. Removing...", package)
+            reason = "Package is not in the repodata index"
+            validation_results.append(_remove_package(package_path, reason=reason))
+            continue
+        to_validate.append(
+            (package_path, package_metadata.get("md5"), package_metadata.get("size"))
+        )
+
+    # create argument list (necessary because multiprocessing.Pool does not
+    # accept additional args to be passed to the mapped function)
+    num_packages = len(to_validate)
+    val_func_args = (
+        (package_path, md5, size, num, num_packages)
+        for num, (package_path, md5, size) in enumerate(to_validate)
+    )
+
+    own_pool = pool is None
+    if own_pool:
+        pool = _validation_pool(validation_executor, num_threads)
+    if pool is None:
+        # Do serial package validation (Takes a long time for large repos)
+        validation_results.extend(map(_validate_or_remove_package, val_func_args))
+    else:
+        # hand out the packages in batches to keep the IPC overhead low while
+        # still spreading the work evenly over the workers
+        num_workers = num_threads or os.cpu_count()
+        chunksize = max(1, min(64, num_packages // (num_workers * 4)))
+        validation_results.extend(
+            pool.imap_unordered(_validate_or_remove_package, val_func_args, chunksize)
+        )
+        if own_pool:
+            pool.close()
+            pool.join()
+
+    if cache_directory is not None:
+        present = set(_list_conda_packages(package_directory))
+        cache = {k: v for k, v in cache.items() if k in present}
+        for package_path, reason in validation_results:
+            if reason is None:
+                package = os.path.basename(package_path)
+                cache[package] = _validation_cache_entry(
+                    package_path, package_repodata[package].get("md5")
+                )
+        _save_validation_cache(cache_directory, cache)
+
+    return verified_results + validation_results
+
+
+def _validation_pool(validation_executor=None, num_threads=1):
+    """Create the pool of workers that validates packages.
+
+    Parameters
+    ----------
+    validation_executor : {'serial', 'thread', 'process'}, optional
+        Defaults to 'serial' when `num_threads` is 1 and to 'process'
+        otherwise.
+    num_threads : int
+        Number of workers. `0` is the number of cores in the system.
+
+    Returns
+    -------
+    multiprocessing.pool.Pool or None
+        None if packages are validated serially
+    """
+    if validation_executor is None:
+        validation_executor = "serial" if num_threads in (1, None) else "process"
+    if validation_executor == "serial":
+        return None
+    if num_threads == 0:
+        num_threads = os.cpu_count()
+        logger.debug(
+            "num_threads=0 so it will be replaced by all available "
+            "cores: %s" % num_threads
+        )
+    logger.info(
+        "Will use {} {}s for package validation."
+        "".format(num_threads, validation_executor)
+    )
+    if validation_executor == "thread":
+        # hashlib releases the GIL while hashing, so threads validate in
+        # parallel without pickling anything or losing the logger
+        return multiprocessing.pool.ThreadPool(num_threads)
+    return multiprocessing.Pool(num_threads)
+
+
+def _validate_or_remove_package(args):
+    """Validata or remove package.
+
+    Parameters
+    ----------
+    args : tuple
+        - `args[0]` is the full path to the package.
+        - `args[1]` is the md5 of the package in the upstream index.
+        - `args[2]` is the size of the package in the upstream index.
+        - `args[3]` is the number of the package in the list of all packages.
+        - `args[4]` is the number of all packages.
+
+    Returns
+    -------
+    pkg_path : str
+        The full path to the package that is being removed
+    reason : str
+        The reason why the package is being removed
+    """
+    # unpack arg tuple tuple
+    package_path, md5, size, num, num_packages = args
+
+    # validate the integrity of the package, the size of the package and
+    # its hashes
+    log_msg = "Validating {:4d} of {:4d}: {}.".format(
+        num + 1, num_packages, os.path.basename(package_path)
+    )
+    if logger:
+        logger.info(log_msg)
+    else:
+        # Windows does not handle multiprocessing logging well
+        # TODO: Fix this properly with a logging Queue
+        sys.stdout.write("Info: " + log_msg)
+    return _validate(package_path, md5=md5, size=size)
+
+
+def _directory_key(directory):
+    """A name for `directory` that is unique to its absolute path."""
+    directory = os.path.abspath(directory)
+    digest = hashlib.sha256(directory.encode("utf-8")).hexdigest()
+    return "%s-%s" % (os.path.basename(directory), digest[:12])
+
+
+def _staging_directory(temp_directory, local_directory):
+    """The directory in `temp_directory` that packages for `local_directory`
+    are downloaded to. It is kept when a run is interrupted, so that the next
+    run can pick up where it left off."""
+    return os.path.join(
+        temp_directory, STAGING_DIRNAME, _directory_key(local_directory)
+    )
+
+
+def _default_state_directory(temp_directory, target_directory):
+    """The directory in `temp_directory` that the state of `target_directory`
+    is kept in between runs when no state directory is given. Like the
+    staging directories, it is out of the published tree and in a place that
+    has to be writable anyway."""
+    return os.path.join(temp_directory, STATE_DIRNAME, _directory_key(target_directory))
+
+
+def _journal_entry(package_name, package_info):
+    return dict(
+        package=package_name,
+        **{key: package_info.get(key) for key in ("md5", "sha256", "size")},
+    )
+
+
+def _resume_staging(staging_dir, package_repodata, package_names):
+    """Find the packages that a previous run downloaded and verified into
+    `staging_dir`, according to its journal.
+
+    Staged packages that are not among `package_names`, that are not in the
+    journal or whose entry in `package_repodata` changed since are removed,
+    as are partial downloads of packages that are no longer wanted and resume
+    states left without their partial download.
+
+    Returns
+    -------
+    set
+        Names of the packages in `staging_dir` that do not need to be
+        downloaded again
+    """
+    journal = {}
+    try:
+        with open(os.path.join(staging_dir, STAGING_JOURNAL_FILENAME)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of a run that was killed
+                    continue
+                journal[entry["package"]] = entry
+    except FileNotFoundError:
+        pass
+
+    package_names = set(package_names)
+    staged = set()
+    for package_name in _list_conda_packages(staging_dir):
+        path = os.path.join(staging_dir, package_name)
+        entry = journal.get(package_name)
+        if (
+            package_name in package_names
+            and entry == _journal_entry(package_name, package_repodata[package_name])
+            and (entry["size"] is None or entry["size"] == os.path.getsize(path))
+        ):
+            staged.add(package_name)
+        else:
+            logger.info("Removing stale staged package %s", path)
+            os.remove(path)
+    for filename in os.listdir(staging_dir):
+        if (
+            filename.endswith(PARTIAL_SUFFIX)
+            and filename[: -len(PARTIAL_SUFFIX)] not in package_names
+        ):
+            _discard_partial_download(os.path.join(staging_dir, filename))
+    # resume states whose partial download is gone, e.g. because the run was
+    # killed between removing the one and the other
+    for filename in os.listdir(staging_dir):
+        path = os.path.join(staging_dir, filename)
+        if filename.endswith(PARTIAL_SUFFIX + RESUME_STATE_SUFFIX) and not (
+            os.path.exists(path[: -len(RESUME_STATE_SUFFIX)])
+        ):
+            logger.info("Removing orphan resume state %s", path)
+            os.remove(path)
+    return staged
+
+
+def _mirror_packages(
+    targets,
+    temp_directory,
+    session,
+    summary,
+    *,
+    download_backend="requests",
+    num_threads=1,
+    validation_executor=None,
+    validation_pool=None,
+    validation_cache=True,
+    **download_kwargs,
+):
+    """Download packages, validate them and move them into their platform
+    directories.
+
+    The packages of all `targets` are downloaded by one pool of workers.
+    They are downloaded into a staging directory per target in
+    `temp_directory`, and only the valid ones are moved. Each package that
+    was downloaded and verified is recorded in a journal in the staging
+    directory, so that if the run is interrupted, the next one only downloads
+    what is missing (and resumes partial downloads). The downloads and
+    validation results are added to `summary`.
+
+    Parameters
+    ----------
+    targets : list
+        (urls, package_repodata, local_directory, state_directory) of each
+        platform directory to download `urls` for
+
+    Returns
+    -------
+    list
+        (downloaded, rejected) of each target: the urls that were downloaded,
+        now or by an interrupted run, and (path, reason) of the downloads that
+        did not match `package_repodata`
+    """
+    staging = []
+    destinations = {}
+    with contextlib.ExitStack() as stack:
+        journals = {}
+        for urls, package_repodata, local_directory, _ in targets:
+            download_dir = _staging_directory(temp_directory, local_directory)
+            os.makedirs(download_dir, exist_ok=True)
+            package_names = [url.split("/")[-1] for url in urls]
+            staged = _resume_staging(download_dir, package_repodata, package_names)
+            if staged:
+                logger.info(
+                    "%s packages were downloaded to %s by an interrupted run",
+                    len(staged),
+                    download_dir,
+                )
+            journal_path = os.path.join(download_dir, STAGING_JOURNAL_FILENAME)
+            journal = stack.enter_context(open(journal_path, "a"))
+            target = _DownloadTarget(download_dir, local_directory, package_repodata)
+            for url in urls:
+                if url.split("/")[-1] not in staged:
+                    destinations[url] = target
+                    journals[url] = journal
+            staging.append((target, journal_path, staged))
+            logger.info("downloading to the staging directory %s", download_dir)
+
+        def record(url):
+            package_name = url.split("/")[-1]
+            entry = _journal_entry(
+                package_name, destinations[url].package_repodata[package_name]
+            )
+            journal = journals[url]
+            journal.write(json.dumps(entry, sort_keys=True) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        download_kwargs["on_download"] = record
+        download_kwargs["targets"] = destinations
+        if download_backend == "asyncio":
+            downloaded, rejected = _download_packages_async(
+                list(destinations), None, None, **download_kwargs
+            )
+        else:
+            downloaded, rejected = _download_packages(
+                list(destinations), None, None, session, **download_kwargs
+            )
+    downloaded = set(downloaded)
+
+    results = []
+    for (urls, _, _, state_directory), (target, journal_path, staged) in zip(
+        targets, staging
+    ):
+        download_dir, local_directory, package_repodata = target
+        target_downloaded = [
+            url for url in urls if url in downloaded or url.split("/")[-1] in staged
+        ]
+        target_rejected = [
+            (path, reason)
+            for path, reason in rejected
+            if os.path.dirname(path) == download_dir
+        ]
+        summary["downloaded"].update((url, download_dir) for url in target_downloaded)
+        summary["validating-new"].update(target_rejected)
+
+        # validate all packages in the download directory. Packages with a
+        # checksum in the repodata were already verified while downloading.
+        verified = {
+            package_name
+            for package_name in (url.split("/")[-1] for url in urls)
+            if package_repodata[package_name].get("md5")
+            or package_repodata[package_name].get("sha256")
+        }
+        validation_results = _validate_packages(
+            package_repodata,
+            download_dir,
+            num_threads=num_threads,
+            verified=verified,
+            validation_executor=validation_executor,
+            pool=validation_pool,
+        )
+        summary["validating-new"].update(validation_results)
+        logger.debug(
+            "Newly downloaded files at %s are %s",
+            download_dir,
+            pformat(os.listdir(download_dir)),
+        )
+
+        # move new conda packages
+        new_packages = _list_conda_packages(download_dir)
+        for f in new_packages:
+            old_path = os.path.join(download_dir, f)
+            new_path = os.path.join(local_directory, f)
+            logger.info("moving %s to %s", old_path, new_path)
+            shutil.move(old_path, new_path)
+        if validation_cache:
+            _update_validation_cache(
+                local_directory, package_repodata, new_packages, state_directory
+            )
+
+        # everything in the journal has been moved. Partial downloads are kept
+        # for the next run.
+        os.remove(journal_path)
+        if not os.listdir(download_dir):
+            os.rmdir(download_dir)
+        results.append((target_downloaded, target_rejected))
+    return results
+
+
+class _ChannelSync:
+    """Mirror one upstream channel into `target_directory`.
+
+    Mirroring is split into steps, so that several channels can share one
+    session, one pool of downloads and one pool of validation workers:
+    `fetch` gets the repodata of each of `subdirs`, `plan` works out which
+    packages to download and `finish` writes the repodata of each platform
+    once `_mirror_packages` downloaded them. See `main` for the parameters.
+
+    Parameters
+    ----------
+    state_directory : str
+        Where the state of the platforms is kept between runs, one directory
+        per platform.
+    prefix : str, optional
+        Prefix of the package names in the summary, usually the directory
+        of the channel in the mirrored tree. If not given, package names are
+        only prefixed with their platform when there are several platforms.
+    """
 
+    def __init__(
+        self,
+        upstream_channel,
+        target_directory,
+        state_directory,
+        platform,
+        blacklist=None,
+        whitelist=None,
+        include_depends=False,
+        prefer_conda=False,
+        prefix=None,
+    ):
+        self.upstream_channel = upstream_channel
+        self.target_directory = target_directory
+        self.state_directory = state_directory
+        self.platforms = [platform] if isinstance(platform, str) else list(platform)
+        self.blacklist = blacklist
+        self.whitelist = whitelist
+        self.include_depends = include_depends
+        self.prefer_conda = prefer_conda
+        self.prefix = prefix
+        self.download_url, self.channel = _maybe_split_channel(upstream_channel)
+
+        # dependencies of packages in a platform subdir may be noarch packages
+        self.noarch_directory = os.path.join(target_directory, "noarch")
+        self.resolve_noarch = include_depends and any(
+            p != "noarch" for p in self.platforms
+        )
+        subdirs = self.platforms + ["noarch"] if self.resolve_noarch else self.platforms
+        self.subdirs = list(dict.fromkeys(subdirs))
+        self.plans = []
+
+    def label(self, subdir, package_name):
+        """The name of `package_name` in `subdir` in the summary."""
+        if self.prefix is not None:
+            return "/".join([self.prefix, subdir, package_name])
+        # with several platforms, the package names in the summary are
+        # prefixed with their platform
+        if len(self.platforms) > 1 or subdir not in self.platforms:
+            return subdir + "/" + package_name
+        return package_name
+
+    def state_dir(self, subdir):
+        """The directory the state of `subdir` is kept in between runs."""
+        return os.path.join(self.state_directory, subdir)
+
+    def subdir_url(self, subdir, file_name):
+        return self.download_url.format(
+            channel=self.channel, platform=subdir, file_name=file_name
+        )
 
-def _validate_packages(package_repodata, package_directory, num_threads=1):
-    """Validate local conda packages.
+    def fetch(self, subdir, session, **kwargs):
+        """Fetch the repodata of `subdir` into its state directory, see
+        `_fetch_repodata`."""
+        local_directory = os.path.join(self.target_directory, subdir)
+        os.makedirs(local_directory, exist_ok=True)
+        return _fetch_repodata(
+            self.subdir_url(subdir, "repodata.json"),
+            session,
+            self.state_dir(subdir),
+            **kwargs,
+        )
 
-    NOTE1: This will remove any packages that are in `package_directory` that
-           are not in `repodata` and also any packages that fail the package
-           validation
-    NOTE2: In concurrent mode (num_threads is not 1) this might be hard to kill
-           using CTRL-C.
+    def plan(
+        self,
+        fetched,
+        summary,
+        *,
+        dry_run=False,
+        no_validate_target=False,
+        validation_cache=True,
+        validation_cache_max_age=None,
+        num_threads=1,
+        validation_executor=None,
+        validation_pool=None,
+    ):
+        """Filter the repodata, validate the local packages and work out
+        which packages to download.
+
+        Parameters
+        ----------
+        fetched : dict
+            The result of `fetch` for each of `subdirs`
+        summary : dict
+            The summary to add the blacklisted, validated and to be mirrored
+            packages to
+
+        Returns
+        -------
+        list
+            (urls, package_repodata, local_directory, state_directory) of
+            each platform directory to download packages for, see
+            `_mirror_packages`
+        """
+        blacklist = self.blacklist
+        whitelist = self.whitelist
+        include_depends = self.include_depends
+        label = self.label
+
+        # nothing to do for a platform if neither the upstream repodata nor the
+        # configuration changed since the last run that mirrored everything it
+        # should have
+        self.sync_states = {}
+        unchanged = {}
+        for subdir in self.platforms:
+            _, upstream_state, not_modified = fetched[subdir]
+            sync_state = {
+                "config": _config_fingerprint(
+                    upstream_channel=self.upstream_channel,
+                    platform=subdir,
+                    blacklist=blacklist,
+                    whitelist=whitelist,
+                    include_depends=include_depends,
+                    prefer_conda=self.prefer_conda,
+                ),
+                "upstream": upstream_state,
+            }
+            if include_depends and subdir != "noarch":
+                sync_state["upstream-noarch"] = fetched["noarch"][1]
+                not_modified = not_modified and fetched["noarch"][2]
+            local_directory = os.path.join(self.target_directory, subdir)
+            self.sync_states[subdir] = sync_state
+            unchanged[subdir] = (
+                not_modified
+                and not dry_run
+                and _load_json(os.path.join(self.state_dir(subdir), LAST_SYNC_FILENAME))
+                == sync_state
+                and os.path.exists(os.path.join(local_directory, "repodata.json"))
+            )
+        if (
+            self.resolve_noarch
+            and "noarch" in self.platforms
+            and not unchanged["noarch"]
+        ):
+            # the noarch platform keeps the noarch dependencies of the others
+            unchanged = dict.fromkeys(self.platforms, False)
+
+        self.plans = []
+        self.noarch_packages = None
+        noarch_wanted = set()
+        # noarch last, so that it knows the noarch dependencies of the others
+        for subdir in sorted(self.platforms, key=lambda p: p == "noarch"):
+            local_directory = os.path.join(self.target_directory, subdir)
+            if unchanged[subdir]:
+                logger.info(
+                    "Upstream repodata and configuration of %s are unchanged since "
+                    "the last run. Nothing to do.",
+                    local_directory,
+                )
+                continue
 
-    Parameters
-    ----------
-    package_repodata : dict
-        The contents of repodata.json
-    package_directory : str
-        Path to the local repo that contains conda packages
-    num_threads : int
-        Number of concurrent processes to use. Set to `0` to use a number of
-        processes equal to the number of cores in the system. Defaults to `1`
-        (i.e. serial package validation).
+            info, packages = _load_repodata(fetched[subdir][0], subdir)
 
-    Returns
-    -------
-    list
-        Iterable of twoples of (pkg_path, reason) where
-        pkg_path : str
-            The full path to the package that is being removed
-        reason : str
-            The reason why the package is being removed
-    """
-    # validate local conda packages
-    local_packages = _list_conda_packages(package_directory)
+            # 1. validate local repo
+            # validating all packages is taking many hours.
+            # _validate_packages(repodata=repodata,
+            #                    package_directory=local_directory,
+            #                    num_threads=num_threads)
 
-    # create argument list (necessary because multiprocessing.Pool.map does not
-    # accept additional args to be passed to the mapped function)
-    num_packages = len(local_packages)
-    val_func_arg_list = [
-        (package, num, num_packages, package_repodata, package_directory)
-        for num, package in enumerate(sorted(local_packages))
-    ]
+            # 2. figure out excluded packages
+            # 3. un-blacklist packages that are actually whitelisted
+            plan = _FilterPlan(blacklist, whitelist)
+            excluded_packages, required_packages = plan.evaluate(packages)
 
-    if num_threads == 1 or num_threads is None:
-        # Do serial package validation (Takes a long time for large repos)
-        validation_results = map(_validate_or_remove_package, val_func_arg_list)
-    else:
-        if num_threads == 0:
-            num_threads = os.cpu_count()
-            logger.debug(
-                "num_threads=0 so it will be replaced by all available "
-                "cores: %s" % num_threads
+            if include_depends and subdir != "noarch":
+                if self.noarch_packages is None:
+                    self.noarch_info, self.noarch_packages = _load_repodata(
+                        fetched["noarch"][0], "noarch"
+                    )
+                noarch_packages = self.noarch_packages
+                # resolve the dependencies over both subdirs. Only the
+                # whitelisted noarch packages and the dependencies are
+                # mirrored from noarch.
+                noarch_keys = {NOARCH_PREFIX + name: name for name in noarch_packages}
+                _, noarch_required = plan.evaluate(noarch_packages)
+                noarch_required = {NOARCH_PREFIX + name for name in noarch_required}
+                merged_packages = dict(packages)
+                merged_packages.update(
+                    (key, noarch_packages[name]) for key, name in noarch_keys.items()
+                )
+                excluded_packages = _restore_required_dependencies(
+                    merged_packages,
+                    excluded_packages.union(noarch_keys).difference(noarch_required),
+                    required_packages.union(noarch_required),
+                )
+                noarch_wanted.update(
+                    name
+                    for key, name in noarch_keys.items()
+                    if key not in excluded_packages
+                )
+                excluded_packages.difference_update(noarch_keys)
+            elif include_depends:
+                excluded_packages = _restore_required_dependencies(
+                    packages, excluded_packages, required_packages
+                )
+                excluded_packages.difference_update(noarch_wanted)
+
+            if self.prefer_conda:
+                # leave out the .tar.bz2 packages that are mirrored as .conda
+                excluded_packages.update(
+                    _superseded_packages(set(packages).difference(excluded_packages))
+                )
+
+            # make final mirror list of not-blacklist + whitelist
+            summary["blacklisted"].update(label(subdir, k) for k in excluded_packages)
+
+            logger.info("BLACKLISTED PACKAGES")
+            logger.info(pformat(sorted(excluded_packages)))
+
+            # Get a list of all packages in the local mirror
+            if dry_run:
+                local_packages = _list_conda_packages(local_directory)
+                packages_slated_for_removal = [
+                    pkg_name
+                    for pkg_name in local_packages
+                    if pkg_name in excluded_packages
+                ]
+                logger.info("PACKAGES TO BE REMOVED")
+                logger.info(pformat(sorted(packages_slated_for_removal)))
+
+            possible_packages_to_mirror = set(packages.keys()) - excluded_packages
+
+            # 4. Validate all local packages
+            # construct the desired package repodata
+            desired_repodata = {
+                pkgname: packages[pkgname] for pkgname in possible_packages_to_mirror
+            }
+            if not (dry_run or no_validate_target):
+                # Only validate if we're not doing a dry-run
+                validation_results = _validate_packages(
+                    desired_repodata,
+                    local_directory,
+                    num_threads,
+                    cache_directory=(
+                        self.state_dir(subdir) if validation_cache else None
+                    ),
+                    validation_executor=validation_executor,
+                    cache_max_age=(
+                        None
+                        if validation_cache_max_age is None
+                        else validation_cache_max_age * 24 * 60 * 60
+                    ),
+                    pool=validation_pool,
+                )
+                summary["validating-existing"].update(validation_results)
+            # 5. figure out final list of packages to mirror
+            # do the set difference of what is local and what is in the final
+            # mirror list
+            local_packages = _list_conda_packages(local_directory)
+            to_mirror = possible_packages_to_mirror - set(local_packages)
+            logger.info("PACKAGES TO MIRROR")
+            logger.info(pformat(sorted(to_mirror)))
+            summary["to-mirror"].update(label(subdir, k) for k in to_mirror)
+            self.plans.append((subdir, info, packages, to_mirror))
+
+        targets = [
+            (
+                [self.subdir_url(subdir, name) for name in sorted(to_mirror)],
+                packages,
+                os.path.join(self.target_directory, subdir),
+                self.state_dir(subdir),
             )
-        logger.info(
-            "Will use {} threads for package validation." "".format(num_threads)
+            for subdir, _, packages, to_mirror in self.plans
+        ]
+
+        # noarch dependencies of platforms are added to what is already
+        # mirrored in noarch, unless the noarch platform itself was mirrored
+        # above
+        self.noarch_dependencies = self.noarch_packages is not None and not any(
+            subdir == "noarch" for subdir, *_ in self.plans
         )
-        p = multiprocessing.Pool(num_threads)
-        validation_results = p.map(_validate_or_remove_package, val_func_arg_list)
-        p.close()
-        p.join()
+        if self.noarch_dependencies:
+            if self.prefer_conda:
+                noarch_wanted.difference_update(_superseded_packages(noarch_wanted))
+            noarch_local = _list_conda_packages(self.noarch_directory)
+            noarch_to_mirror = noarch_wanted.difference(noarch_local)
+            logger.info("NOARCH DEPENDENCIES TO MIRROR")
+            logger.info(pformat(sorted(noarch_to_mirror)))
+            summary["to-mirror"].update(label("noarch", k) for k in noarch_to_mirror)
+            targets.append(
+                (
+                    [
+                        self.subdir_url("noarch", name)
+                        for name in sorted(noarch_to_mirror)
+                    ],
+                    self.noarch_packages,
+                    self.noarch_directory,
+                    self.state_dir("noarch"),
+                )
+            )
+        return targets
+
+    def finish(self, targets, results, *, repodata_zst=False, current_repodata=False):
+        """Write the repodata of each platform, listing the packages that are
+        now in the platform directory.
+
+        Parameters
+        ----------
+        targets : list
+            The targets returned by `plan`
+        results : list
+            The result of `_mirror_packages` for each of `targets`
+        """
+        complete = [
+            len(downloaded) == len(urls) and not rejected
+            for (urls, *_), (downloaded, rejected) in zip(targets, results)
+        ]
 
-    return validation_results
+        noarch_directory = self.noarch_directory
+        if self.noarch_dependencies:
+            noarch_complete = complete.pop()
+            noarch_we_have = set(_list_conda_packages(noarch_directory))
+            _write_repodata_if_changed(
+                noarch_directory,
+                _make_repodata(
+                    self.noarch_info,
+                    {
+                        name: info
+                        for name, info in self.noarch_packages.items()
+                        if name in noarch_we_have
+                    },
+                ),
+                self.state_dir("noarch"),
+                zst=repodata_zst,
+                current=current_repodata,
+            )
+        else:
+            noarch_complete = True
+
+        for (subdir, info, packages, _), platform_complete in zip(self.plans, complete):
+            local_directory = os.path.join(self.target_directory, subdir)
+            state_dir = self.state_dir(subdir)
+
+            # 8. Use already downloaded repodata.json contents but prune it of
+            # packages we don't want
+            # compute the packages that we have locally
+            packages_we_have = set(_list_conda_packages(local_directory))
+            # remake the packages dictionary with only the packages we have
+            # locally
+            repodata = _make_repodata(
+                info,
+                {
+                    name: info
+                    for name, info in packages.items()
+                    if name in packages_we_have
+                },
+            )
 
+            # 9. write the new repodata.json and repodata.json.bz2 into the
+            # repo, once all the packages it lists are in place
+            _write_repodata_if_changed(
+                local_directory,
+                repodata,
+                state_dir,
+                zst=repodata_zst,
+                current=current_repodata,
+            )
 
-def _validate_or_remove_package(args):
-    """Validata or remove package.
+            if platform_complete and (noarch_complete or subdir == "noarch"):
+                _write_json(
+                    os.path.join(state_dir, LAST_SYNC_FILENAME),
+                    self.sync_states[subdir],
+                )
 
-    Parameters
-    ----------
-    args : tuple
-        - `args[0]` is `package`.
-        - `args[1]` is the number of the package in the list of all packages.
-        - `args[2]` is the number of all packages.
-        - `args[3]` is `package_repodata`.
-        - `args[4]` is `package_directory`.
+        # Also need to make a "noarch" channel or conda gets mad
+        if not os.path.exists(os.path.join(noarch_directory, "repodata.json")):
+            os.makedirs(noarch_directory, exist_ok=True)
+            noarch_repodata = _make_repodata({}, {})
+            _write_repodata(
+                noarch_directory,
+                noarch_repodata,
+                zst=repodata_zst,
+                current=current_repodata,
+            )
+
+
+def _sync_channels(
+    syncs,
+    temp_directory,
+    *,
+    num_threads=1,
+    validation_executor=None,
+    num_downloads=1,
+    download_backend="requests",
+    use_jlap=False,
+    dry_run=False,
+    repodata_zst=False,
+    current_repodata=False,
+    no_validate_target=False,
+    validation_cache=True,
+    validation_cache_max_age=None,
+    minimum_free_space=0,
+    proxies=None,
+    ssl_verify=None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_retries=100,
+    show_progress: bool = True,
+):
+    """Mirror the channels of `syncs`, a list of `_ChannelSync`.
+
+    All channels share one session, whose connection pools are kept for
+    every upstream host, one pool of `num_downloads` downloads and one pool
+    of validation workers. See `main` for the other parameters.
 
     Returns
     -------
-    pkg_path : str
-        The full path to the package that is being removed
-    reason : str
-        The reason why the package is being removed
+    dict
+        The summary of all channels, see `main`
     """
-    # unpack arg tuple tuple
-    package = args[0]
-    num = args[1]
-    num_packages = args[2]
-    package_repodata = args[3]
-    package_directory = args[4]
-
-    # ensure the packages in this directory are in the upstream
-    # repodata.json
-    try:
-        package_metadata = package_repodata[package]
-    except KeyError:
-        log_msg = f"{package} is not in the upstream index. Removing..."
-        if logger:
-            logger.warning(log_msg)
-        else:
-            # Windows does not handle multiprocessing logging well
-            # TODO: Fix this properly with a logging Queue
-            sys.stdout.write("Warning: " + log_msg)
-        reason = "Package is not in the repodata index"
-        package_path = os.path.join(package_directory, package)
-        return _remove_package(package_path, reason=reason)
-    # validate the integrity of the package, the size of the package and
-    # its hashes
-    log_msg = "Validating {:4d} of {:4d}: {}.".format(num + 1, num_packages, package)
-    if logger:
-        logger.info(log_msg)
-    else:
-        # Windows does not handle multiprocessing logging well
-        # TODO: Fix this properly with a logging Queue
-        sys.stdout.write("Info: " + log_msg)
-    package_path = os.path.join(package_directory, package)
-    return _validate(
-        package_path, md5=package_metadata.get("md5"), size=package_metadata.get("size")
+    # Steps:
+    # 1. figure out blacklisted packages
+    # 2. un-blacklist packages that are actually whitelisted
+    # 3. remove blacklisted packages
+    # 4. figure out final list of packages to mirror
+    # 5. mirror new packages to temp dir
+    # 6. validate new packages
+    # 7. copy new packages to repo directory
+    # 8. download repodata.json and repodata.json.bz2
+    # 9. write new repodata.json and repodata.json.bz2 into the repo
+    summary = {
+        "validating-existing": set(),
+        "validating-new": set(),
+        "downloaded": set(),
+        "blacklisted": set(),
+        "to-mirror": set(),
+    }
+    if num_downloads < 1:
+        # a pool of no downloads would never fetch anything and the run
+        # would still look successful
+        raise ValueError("num_downloads must be at least 1, got %s" % num_downloads)
+    for sync in syncs:
+        try:
+            os.makedirs(sync.state_directory, exist_ok=True)
+        except OSError as ex:
+            raise OSError(
+                "Cannot create the state directory %s, choose another one with "
+                "--state-directory: %s" % (sync.state_directory, ex)
+            ) from ex
+    hosts = {urlsplit(sync.download_url).netloc for sync in syncs}
+    session = _make_session(num_downloads, len(hosts))
+
+    # 0. fetch the repodata of all subdirs of all channels at once
+    def fetch(job):
+        sync, subdir = job
+        return sync.fetch(
+            subdir, session, use_jlap=use_jlap, proxies=proxies, ssl_verify=ssl_verify
+        )
+
+    jobs = [(sync, subdir) for sync in syncs for subdir in sync.subdirs]
+    # an executor needs at least one worker, even with nothing to fetch
+    max_workers = max(1, min(len(jobs), max(num_downloads, DEFAULT_POOL_SIZE)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fetched = {sync: {} for sync in syncs}
+        for (sync, subdir), result in zip(jobs, executor.map(fetch, jobs)):
+            fetched[sync][subdir] = result
+
+    with contextlib.ExitStack() as stack:
+        validation_pool = None
+        if not dry_run:
+            validation_pool = _validation_pool(validation_executor, num_threads)
+        if validation_pool is not None:
+            stack.enter_context(validation_pool)
+
+        targets = [
+            sync.plan(
+                fetched[sync],
+                summary,
+                dry_run=dry_run,
+                no_validate_target=no_validate_target,
+                validation_cache=validation_cache,
+                validation_cache_max_age=validation_cache_max_age,
+                num_threads=num_threads,
+                validation_executor=validation_executor,
+                validation_pool=validation_pool,
+            )
+            for sync in syncs
+        ]
+        if dry_run:
+            logger.info("Dry run complete. Exiting")
+            return summary
+
+        # 6. for each download:
+        # a. download to temp file
+        # b. validate contents of temp file
+        # c. move to local repo
+        # mirror all new packages of all channels with one pool of downloads
+        results = _mirror_packages(
+            [target for sync_targets in targets for target in sync_targets],
+            temp_directory,
+            session,
+            summary,
+            download_backend=download_backend,
+            num_threads=num_threads,
+            validation_executor=validation_executor,
+            validation_pool=validation_pool,
+            validation_cache=validation_cache,
+            num_downloads=num_downloads,
+            minimum_free_space=minimum_free_space,
+            proxies=proxies,
+            ssl_verify=ssl_verify,
+            chunk_size=chunk_size,
+            max_retries=max_retries,
+            show_progress=show_progress,
+            desc=", ".join(
+                subdir if sync.prefix is None else sync.prefix + "/" + subdir
+                for sync in syncs
+                for subdir, *_ in sync.plans
+            ),
+        )
+
+    results = iter(results)
+    for sync, sync_targets in zip(syncs, targets):
+        sync.finish(
+            sync_targets,
+            [next(results) for _ in sync_targets],
+            repodata_zst=repodata_zst,
+            current_repodata=current_repodata,
+        )
+    logger.info(
+        "Summary: %s",
+        ", ".join("%s %s" % (len(value), key) for key, value in summary.items()),
     )
+    return summary
 
 
 def main(
@@ -888,15 +3748,25 @@ def main(
     blacklist=None,
     whitelist=None,
     include_depends=False,
+    prefer_conda=False,
     num_threads=1,
+    validation_executor=None,
+    num_downloads=1,
+    download_backend="requests",
+    use_jlap=False,
     dry_run=False,
+    repodata_zst=False,
+    current_repodata=False,
     no_validate_target=False,
+    validation_cache=True,
+    validation_cache_max_age=None,
     minimum_free_space=0,
     proxies=None,
     ssl_verify=None,
     chunk_size: int = DEFAULT_CHUNK_SIZE,
     max_retries=100,
     show_progress: bool = True,
+    state_directory=None,
 ):
     """
 
@@ -913,11 +3783,14 @@ def main(
     temp_directory : str
         The path on disk to an existing and writable directory to temporarily
         store the packages before moving them to the target_directory to
-        apply checks
-    platform : str
-        The platform that you wish to mirror for. Common options are
+        apply checks. The packages are staged in a subdirectory that is kept
+        if the run is interrupted, so that the next run resumes from there.
+    platform : str or list of str
+        The platform(s) that you wish to mirror for. Common options are
         'linux-64', 'osx-64', 'win-64' and 'win-32'. Any platform is valid as
-        long as the url resolves.
+        long as the url resolves. The repodata of several platforms is
+        fetched concurrently and their packages are downloaded by one pool of
+        `num_downloads` downloads.
     blacklist : iterable of tuples, optional
         The values of blacklist should be (key, glob) where key is one of the
         keys in the repodata['packages'] dicts and glob is a thing to match
@@ -928,18 +3801,56 @@ def main(
         on.  Note that all comparisons will be laundered through lowercasing.
     include_depends: bool
         If true, then include packages matching dependencies of whitelisted
-        packages as well.
+        packages as well. The dependencies are resolved over `platform` and
+        noarch together, and the noarch packages that are needed are added to
+        the noarch directory.
+    prefer_conda : bool, optional
+        Defaults to False.
+        If True, leave out the .tar.bz2 packages that upstream also publishes
+        in the .conda format, which is smaller and faster to extract. Only
+        the .conda packages are then mirrored.
     num_threads : int, optional
         Number of threads to be used for concurrent validation.  Defaults to
         `num_threads=1` for non-concurrent mode.  To use all available cores,
         set `num_threads=0`.
+    validation_executor : {'serial', 'thread', 'process'}, optional
+        Validate packages serially or in a pool of `num_threads` threads or
+        processes. Defaults to 'serial' when `num_threads` is 1 and to
+        'process' otherwise.
+    num_downloads : int, optional
+        Number of packages to download concurrently over a shared connection
+        pool. Defaults to `num_downloads=1` for serial downloads. Must be at
+        least 1.
+    download_backend : {'requests', 'asyncio'}, optional
+        Drive the downloads from a thread pool using requests (the default)
+        or from a single asyncio event loop using aiohttp.
+    use_jlap : bool, optional
+        Defaults to False.
+        If True, bring the upstream repodata kept from the previous run up to
+        date with the patches published in repodata.jlap, falling back to
+        downloading repodata.json when that is not possible.
     dry_run : bool, optional
         Defaults to False.
         If True, skip validation and exit after determining what needs to be
         downloaded and what needs to be removed.
+    repodata_zst : bool, optional
+        Defaults to False.
+        If True, also write repodata.json.zst.
+    current_repodata : bool, optional
+        Defaults to False.
+        If True, also write current_repodata.json with only the latest version
+        of each package.
     no_validate_target : bool, optional
         Defaults to False.
         If True, skip validation of files already present in target_directory.
+    validation_cache : bool, optional
+        Defaults to True.
+        If True, only validate packages in target_directory that changed on
+        disk, or whose md5 in the upstream index changed, since they were last
+        validated.
+    validation_cache_max_age : float, optional
+        Validate all packages in target_directory again once their last
+        validation is older than this many days. Defaults to never.
     minimum_free_space : int, optional
         Stop downloading when free space target_directory or temp_directory reach this threshold.
     proxies : dict
@@ -953,6 +3864,12 @@ def main(
         default 100.
     show_progress: bool
         Show progress bar while downloading. True by default.
+    state_directory : str, optional
+        The path on disk where the state kept between runs is stored, e.g.
+        the cached upstream repodata and the validation cache, one directory
+        per platform. Defaults to a directory for `target_directory` in
+        `temp_directory`. Keep it out of `target_directory`, which is usually
+        published.
 
     Returns
     -------
@@ -963,6 +3880,8 @@ def main(
                        packages where reason=None is a sentinel for a successful validation
         - download : set of (url, download_path) for each package that
                      was downloaded
+        With several platforms, package names are given as
+        '<platform>/<filename>'.
 
     Notes
     -----
@@ -992,226 +3911,398 @@ def main(
      'size': 1960193,
      'version': '8.5.18'}
     """
-    # Steps:
-    # 1. figure out blacklisted packages
-    # 2. un-blacklist packages that are actually whitelisted
-    # 3. remove blacklisted packages
-    # 4. figure out final list of packages to mirror
-    # 5. mirror new packages to temp dir
-    # 6. validate new packages
-    # 7. copy new packages to repo directory
-    # 8. download repodata.json and repodata.json.bz2
-    # 9. copy new repodata.json and repodata.json.bz2 into the repo
-    summary = {
-        "validating-existing": set(),
-        "validating-new": set(),
-        "downloaded": set(),
-        "blacklisted": set(),
-        "to-mirror": set(),
+    if state_directory is None:
+        state_directory = _default_state_directory(temp_directory, target_directory)
+    sync = _ChannelSync(
+        upstream_channel,
+        target_directory,
+        state_directory,
+        platform,
+        blacklist=blacklist,
+        whitelist=whitelist,
+        include_depends=include_depends,
+        prefer_conda=prefer_conda,
+    )
+    return _sync_channels(
+        [sync],
+        temp_directory,
+        num_threads=num_threads,
+        validation_executor=validation_executor,
+        num_downloads=num_downloads,
+        download_backend=download_backend,
+        use_jlap=use_jlap,
+        dry_run=dry_run,
+        repodata_zst=repodata_zst,
+        current_repodata=current_repodata,
+        no_validate_target=no_validate_target,
+        validation_cache=validation_cache,
+        validation_cache_max_age=validation_cache_max_age,
+        minimum_free_space=minimum_free_space,
+        proxies=proxies,
+        ssl_verify=ssl_verify,
+        chunk_size=chunk_size,
+        max_retries=max_retries,
+        show_progress=show_progress,
+    )
+
+
+def mirror_channels(
+    channels,
+    target_directory,
+    temp_directory,
+    platform=None,
+    blacklist=None,
+    whitelist=None,
+    include_depends=False,
+    prefer_conda=False,
+    state_directory=None,
+    **kwargs,
+):
+    """Mirror several upstream channels into one tree in a single run.
+
+    The channels share one HTTP session, one pool of `num_downloads`
+    downloads and one pool of validation workers, and a single summary is
+    returned for all of them.
+
+    Parameters
+    ----------
+    channels : list of dict
+        The channels to mirror. Each has an 'upstream_channel' and may set
+        'target_directory', 'platform', 'blacklist', 'whitelist',
+        'include_depends' and 'prefer_conda'.
+    target_directory : str
+        The root of the tree. Each channel is mirrored into its
+        'target_directory' relative to it, which defaults to the name of the
+        channel, e.g. 'conda-forge'.
+    temp_directory : str
+        See `main`
+    platform, blacklist, whitelist, include_depends, prefer_conda : optional
+        The values for the channels that do not set them, see `main`
+    state_directory : str, optional
+        The root of the state kept between runs, which holds a directory per
+        channel like `target_directory`. Defaults to a directory for
+        `target_directory` in `temp_directory`.
+    **kwargs
+        The other options of `main`, which apply to all channels
+
+    Returns
+    -------
+    dict
+        The summary of `main` for all channels. Package names are given as
+        '<channel directory>/<platform>/<filename>'.
+    """
+    if state_directory is None:
+        state_directory = _default_state_directory(temp_directory, target_directory)
+    syncs = []
+    directories = set()
+    for channel in channels:
+        unknown = set(channel).difference(CHANNEL_KEYS)
+        if unknown:
+            raise ValueError(
+                "Unknown keys %s in channel %s" % (sorted(unknown), channel)
+            )
+        upstream_channel = channel.get("upstream_channel")
+        if not upstream_channel:
+            raise ValueError("Missing upstream_channel in channel %s" % channel)
+        directory = channel.get("target_directory")
+        if not directory:
+            directory = _maybe_split_channel(upstream_channel)[1]
+        directory = os.path.normpath(directory)
+        if directory in directories:
+            raise ValueError(
+                "Several channels are mirrored into %s. Give them different "
+                "target_directory values." % directory
+            )
+        directories.add(directory)
+        channel_platform = channel.get("platform", platform)
+        if not channel_platform:
+            raise ValueError("Missing platform of channel %s" % upstream_channel)
+        syncs.append(
+            _ChannelSync(
+                upstream_channel,
+                os.path.join(target_directory, directory),
+                os.path.join(state_directory, directory),
+                channel_platform,
+                blacklist=channel.get("blacklist", blacklist),
+                whitelist=channel.get("whitelist", whitelist),
+                include_depends=channel.get("include_depends", include_depends),
+                prefer_conda=channel.get("prefer_conda", prefer_conda),
+                prefix=directory,
+            )
+        )
+    return _sync_channels(syncs, temp_directory, **kwargs)
+
+
+def _make_repodata(info, packages):
+    """Build the repodata of `packages`, keyed on file name, listing the
+    .conda packages under 'packages.conda' and the others under
+    'packages'."""
+    repodata = {"info": info, "packages": {}, "packages.conda": {}}
+    for filename, record in packages.items():
+        section = "packages.conda" if filename.endswith(CONDA_EXTENSION) else "packages"
+        repodata[section][filename] = record
+    return repodata
+
+
+def _superseded_packages(package_names):
+    """The .tar.bz2 packages among `package_names` that are also among them
+    in the .conda format."""
+    package_names = set(package_names)
+    return {
+        name
+        for name in package_names
+        if name.endswith(TAR_BZ2_EXTENSION)
+        and name[: -len(TAR_BZ2_EXTENSION)] + CONDA_EXTENSION in package_names
     }
-    # Implementation:
-    if not os.path.exists(os.path.join(target_directory, platform)):
-        os.makedirs(os.path.join(target_directory, platform))
 
-    info, packages = get_repodata(
-        upstream_channel, platform, proxies=proxies, ssl_verify=ssl_verify
+
+def _write_repodata(
+    package_dir, repodata_dict, num_threads=None, zst=False, current=False
+):
+    """Write repodata.json and repodata.json.bz2 into `package_dir`.
+
+    All files are written under a temporary name and renamed into place, so
+    that clients never see a partially written index. The optional indexes
+    are removed when they are not requested, so that they do not go stale.
+
+    Parameters
+    ----------
+    package_dir : str
+        The directory to write the repodata to
+    repodata_dict : dict
+        The repodata
+    num_threads : int, optional
+        Number of threads used for compression. Defaults to the number of
+        cpus.
+    zst : bool, optional
+        Also write repodata.json.zst
+    current : bool, optional
+        Also write current_repodata.json, see `_current_repodata`
+    """
+    if zst and zstandard is None:
+        raise ImportError("Writing repodata.json.zst requires zstandard")
+    num_threads = num_threads or os.cpu_count() or 1
+    json_path = os.path.join(package_dir, "repodata.json")
+    current_path = os.path.join(package_dir, "current_repodata.json")
+    # compress repodata.json into the bz2 format. some conda commands still
+    # need it
+    _write_json_index(
+        json_path, repodata_dict, num_threads, compress_bz2=True, compress_zst=zst
     )
-    local_directory = os.path.join(target_directory, platform)
-
-    # 1. validate local repo
-    # validating all packages is taking many hours.
-    # _validate_packages(repodata=repodata,
-    #                    package_directory=local_directory,
-    #                    num_threads=num_threads)
-
-    # 2. figure out excluded packages
-    excluded_packages: Set[str] = set()
-    required_packages: Set[str] = set()
-    # match blacklist conditions
-    if blacklist:
-        for blist in blacklist:
-            logger.debug("exclude item: %s", blist)
-            matched_packages = list(_match(packages, blist))
-            logger.debug(pformat(matched_packages))
-            excluded_packages.update(matched_packages)
-
-    # 3. un-blacklist packages that are actually whitelisted
-    # match whitelist on blacklist
-    if whitelist:
-        for wlist in whitelist:
-            matched_packages = list(_match(packages, wlist))
-            required_packages.update(matched_packages)
-        excluded_packages.difference_update(required_packages)
-
-    if include_depends:
-        excluded_packages = _restore_required_dependencies(
-            packages, excluded_packages, required_packages
-        )
+    if current:
+        _write_json_index(current_path, _current_repodata(repodata_dict), num_threads)
 
-    # make final mirror list of not-blacklist + whitelist
-    summary["blacklisted"].update(excluded_packages)
+    stale = ([] if zst else [json_path + ".zst"]) + ([] if current else [current_path])
+    for path in stale:
+        if os.path.exists(path):
+            logger.info("Removing %s", path)
+            os.remove(path)
 
-    logger.info("BLACKLISTED PACKAGES")
-    logger.info(pformat(sorted(excluded_packages)))
 
-    # Get a list of all packages in the local mirror
-    if dry_run:
-        local_packages = _list_conda_packages(local_directory)
-        packages_slated_for_removal = [
-            pkg_name
-            for pkg_name in local_packages
-            if pkg_name in summary["blacklisted"]
-        ]
-        logger.info("PACKAGES TO BE REMOVED")
-        logger.info(pformat(sorted(packages_slated_for_removal)))
+def _write_repodata_if_changed(
+    package_dir, repodata_dict, state_dir, zst=False, current=False
+):
+    """Write the repodata with `_write_repodata`, unless the index files in
+    `package_dir` already have the content that would be written.
 
-    possible_packages_to_mirror = set(packages.keys()) - excluded_packages
+    A fingerprint of the repodata and the writer options is kept in
+    `state_dir`, together with the size and modification time of the index
+    files it was written to, so that files changed by others are rewritten.
 
-    # 4. Validate all local packages
-    # construct the desired package repodata
-    desired_repodata = {
-        pkgname: packages[pkgname] for pkgname in possible_packages_to_mirror
-    }
-    if not (dry_run or no_validate_target):
-        # Only validate if we're not doing a dry-run
-        validation_results = _validate_packages(
-            desired_repodata, local_directory, num_threads
-        )
-        summary["validating-existing"].update(validation_results)
-    # 5. figure out final list of packages to mirror
-    # do the set difference of what is local and what is in the final
-    # mirror list
-    local_packages = _list_conda_packages(local_directory)
-    to_mirror = possible_packages_to_mirror - set(local_packages)
-    logger.info("PACKAGES TO MIRROR")
-    logger.info(pformat(sorted(to_mirror)))
-    summary["to-mirror"].update(to_mirror)
-    if dry_run:
-        logger.info("Dry run complete. Exiting")
-        return summary
-
-    # 6. for each download:
-    # a. download to temp file
-    # b. validate contents of temp file
-    # c. move to local repo
-    # mirror all new packages
-    total_bytes = 0
-    minimum_free_space_kb = minimum_free_space * 1024 * 1024
-    download_url, channel = _maybe_split_channel(upstream_channel)
-    session = requests.Session()
-    with tempfile.TemporaryDirectory(dir=temp_directory) as download_dir:
-        logger.info("downloading to the tempdir %s", download_dir)
-        for package_name in tqdm(
-            sorted(to_mirror),
-            desc=platform,
-            unit="package",
-            leave=False,
-            disable=not show_progress,
-        ):
-            url = download_url.format(
-                channel=channel, platform=platform, file_name=package_name
-            )
-            try:
-                # make sure we have enough free disk space in the temp folder to meet threshold
-                if shutil.disk_usage(download_dir).free < minimum_free_space_kb:
-                    logger.error(
-                        "Disk space below threshold in %s. Aborting download.",
-                        download_dir,
-                    )
-                    break
+    Parameters
+    ----------
+    package_dir : str
+        The directory to write the repodata to
+    repodata_dict : dict
+        The repodata
+    state_dir : str
+        The directory to keep the fingerprint in
+    zst : bool, optional
+        Also write repodata.json.zst
+    current : bool, optional
+        Also write current_repodata.json
 
-                # download package
-                total_bytes += _download_backoff_retry(
-                    url,
-                    download_dir,
-                    session,
-                    proxies=proxies,
-                    ssl_verify=ssl_verify,
-                    chunk_size=chunk_size,
-                    max_retries=max_retries,
-                    show_progress=show_progress,
-                )
+    Returns
+    -------
+    bool
+        True if the repodata was written
+    """
+    filenames = ["repodata.json", "repodata.json.bz2"]
+    if zst:
+        filenames.append("repodata.json.zst")
+    if current:
+        filenames.append("current_repodata.json")
+    fingerprint = _repodata_fingerprint(
+        repodata_dict, zst_level=ZSTD_LEVEL if zst else None, current=current
+    )
+    state_path = os.path.join(state_dir, INDEX_STATE_FILENAME)
+    state = _load_json(state_path)
+    if state == {
+        "fingerprint": fingerprint,
+        "files": _stat_files(package_dir, filenames),
+    }:
+        logger.info("Repodata in %s is unchanged, not writing it", package_dir)
+        return False
+
+    _write_repodata(package_dir, repodata_dict, zst=zst, current=current)
+    _write_json(
+        state_path,
+        {"fingerprint": fingerprint, "files": _stat_files(package_dir, filenames)},
+    )
+    return True
 
-                # make sure we have enough free disk space in the target folder to meet threshold
-                # while also being able to fit the packages we have already downloaded
-                if (
-                    shutil.disk_usage(local_directory).free - total_bytes
-                ) < minimum_free_space_kb:
-                    logger.error(
-                        "Disk space below threshold in %s. Aborting download",
-                        local_directory,
-                    )
-                    break
 
-                summary["downloaded"].add((url, download_dir))
-            except Exception as ex:
-                logger.exception("Unexpected error: %s. Aborting download.", ex)
-                break
+def _repodata_fingerprint(repodata_dict, **options):
+    """Hash the repodata and the `options` it is written with.
 
-        # validate all packages in the download directory
-        validation_results = _validate_packages(
-            packages, download_dir, num_threads=num_threads
-        )
-        summary["validating-new"].update(validation_results)
-        logger.debug(
-            "Newly downloaded files at %s are %s",
-            download_dir,
-            pformat(os.listdir(download_dir)),
-        )
+    The package records are hashed one at a time, in the order of their file
+    names, so that the whole document never has to be encoded at once.
+    """
+    fingerprint = hashlib.sha256()
+    fingerprint.update(json.dumps(options, sort_keys=True).encode("utf-8"))
+    for key, value in sorted(repodata_dict.items()):
+        if key in PACKAGE_SECTIONS:
+            fingerprint.update(json.dumps(key).encode("utf-8"))
+            for filename in sorted(value):
+                entry = json.dumps([filename, value[filename]], sort_keys=True)
+                fingerprint.update(entry.encode("utf-8"))
+        else:
+            entry = json.dumps([key, value], sort_keys=True)
+            fingerprint.update(entry.encode("utf-8"))
+    return fingerprint.hexdigest()
 
-        # 8. Use already downloaded repodata.json contents but prune it of
-        # packages we don't want
-        repodata = {"info": info, "packages": packages}
-
-        # compute the packages that we have locally
-        packages_we_have = set(local_packages + _list_conda_packages(download_dir))
-        # remake the packages dictionary with only the packages we have
-        # locally
-        repodata["packages"] = {
-            name: info
-            for name, info in repodata["packages"].items()
-            if name in packages_we_have
-        }
-        _write_repodata(download_dir, repodata)
 
-        # move new conda packages
-        for f in _list_conda_packages(download_dir):
-            old_path = os.path.join(download_dir, f)
-            new_path = os.path.join(local_directory, f)
-            logger.info("moving %s to %s", old_path, new_path)
-            shutil.move(old_path, new_path)
+def _stat_files(directory, filenames):
+    """Return the size and modification time of each of `filenames` in
+    `directory`, or None for those that do not exist."""
+    stats = {}
+    for filename in filenames:
+        try:
+            st = os.stat(os.path.join(directory, filename))
+        except FileNotFoundError:
+            stats[filename] = None
+        else:
+            stats[filename] = [st.st_size, st.st_mtime_ns]
+    return stats
 
-        for f in ("repodata.json", "repodata.json.bz2"):
-            download_path = os.path.join(download_dir, f)
-            move_path = os.path.join(local_directory, f)
-            shutil.move(download_path, move_path)
 
-    # Also need to make a "noarch" channel or conda gets mad
-    noarch_path = os.path.join(target_directory, "noarch")
-    if not os.path.exists(noarch_path):
-        os.makedirs(noarch_path, exist_ok=True)
-        noarch_repodata = {"info": {}, "packages": {}}
-        _write_repodata(noarch_path, noarch_repodata)
+def _write_json_index(
+    path, data, num_threads=1, compress_bz2=False, compress_zst=False
+):
+    """Write `data` as indented json with sorted keys to `path`.
 
-    return summary
+    The json is encoded in blocks that are written to `path` as they are
+    produced. With `compress_bz2`, the blocks are also compressed in parallel
+    into independent bz2 streams that are concatenated into `path` + '.bz2'.
+    With `compress_zst`, they are fed to a (multi-threaded) zstd compressor
+    writing `path` + '.zst'.
 
+    Parameters
+    ----------
+    path : str
+        The path of the json file
+    data : dict
+        The data to write
+    num_threads : int, optional
+        Number of threads used for compression
+    compress_bz2 : bool, optional
+        Also write `path` + '.bz2'
+    compress_zst : bool, optional
+        Also write `path` + '.zst'
+    """
+    paths = [path]
+    with contextlib.ExitStack() as stack:
+        json_file = stack.enter_context(open(path + PARTIAL_SUFFIX, "wb"))
+        bz2_file = zst_writer = None
+        if compress_bz2:
+            paths.append(path + ".bz2")
+            bz2_file = stack.enter_context(open(paths[-1] + PARTIAL_SUFFIX, "wb"))
+            pool = stack.enter_context(ThreadPoolExecutor(num_threads))
+        if compress_zst:
+            paths.append(path + ".zst")
+            compressor = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL, threads=num_threads if num_threads > 1 else 0
+            )
+            zst_writer = stack.enter_context(
+                compressor.stream_writer(open(paths[-1] + PARTIAL_SUFFIX, "wb"))
+            )
 
-def _write_repodata(package_dir, repodata_dict):
-    data = json.dumps(repodata_dict, indent=2, sort_keys=True)
-    # strip trailing whitespace
-    data = "\n".join(line.rstrip() for line in data.splitlines())
-    # make sure we have newline at the end
-    if not data.endswith("\n"):
-        data += "\n"
+        # bz2 releases the GIL, so the blocks are compressed concurrently
+        # while the next ones are encoded
+        pending = deque()
+        for block in _iter_json_blocks(data, BZ2_BLOCK_SIZE):
+            json_file.write(block)
+            if zst_writer is not None:
+                zst_writer.write(block)
+            if bz2_file is not None:
+                pending.append(pool.submit(bz2.compress, block))
+                while pending and (len(pending) > num_threads or pending[0].done()):
+                    bz2_file.write(pending.popleft().result())
+        while pending:
+            bz2_file.write(pending.popleft().result())
+    for path in paths:
+        os.replace(path + PARTIAL_SUFFIX, path)
+
+
+def _current_repodata(repodata_dict):
+    """Trim repodata down to the latest version of each package.
+
+    All the builds of the latest version of a package name, according to
+    `VersionOrder`, are kept, in both package formats. Packages with an
+    invalid version are left out.
 
-    with open(os.path.join(package_dir, "repodata.json"), "w") as fo:
-        fo.write(data)
+    Parameters
+    ----------
+    repodata_dict : dict
+        The repodata
 
-    # compress repodata.json into the bz2 format. some conda commands still
-    # need it
-    bz2_path = os.path.join(package_dir, "repodata.json.bz2")
-    with open(bz2_path, "wb") as fo:
-        fo.write(bz2.compress(data.encode("utf-8")))
+    Returns
+    -------
+    dict
+        The repodata for current_repodata.json
+    """
+    latest = {}
+    for section in PACKAGE_SECTIONS:
+        for filename, record in repodata_dict.get(section, {}).items():
+            try:
+                version = VersionOrder(record["version"])
+            except (KeyError, ValueError):
+                continue
+            best = latest.get(record.get("name"))
+            if best is None or best[0] < version:
+                latest[record.get("name")] = (version, [(section, filename)])
+            elif best[0] == version:
+                best[1].append((section, filename))
+
+    current = {
+        key: value
+        for key, value in repodata_dict.items()
+        if key not in PACKAGE_SECTIONS
+    }
+    current["packages"] = {}
+    if "packages.conda" in repodata_dict:
+        current["packages.conda"] = {}
+    for _, filenames in latest.values():
+        for section, filename in filenames:
+            current[section][filename] = repodata_dict[section][filename]
+    return current
+
+
+def _iter_json_blocks(data, block_size):
+    """Encode `data` as indented json, with keys sorted and a trailing newline,
+    in blocks of at least `block_size` bytes (except for the last one)."""
+    encoder = json.JSONEncoder(indent=2, sort_keys=True)
+    chunks = []
+    size = 0
+    for chunk in encoder.iterencode(data):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= block_size:
+            yield "".join(chunks).encode("utf-8")
+            chunks = []
+            size = 0
+    chunks.append("\n")
+    yield "".join(chunks).encode("utf-8")
 
 
 if __name__ == "__main__":
@@ -49,12 +49,14 @@ def all_repodata(mirror_dir):
     """
     Given the path to a directory, return a dictionary mapping all repository
     sub-directories to the conda package list as respresented by
-    the 'packages' field in repodata.json.
+    the 'packages' and 'packages.conda' fields in repodata.json.
     """
     d = {}
     for repo_path in find_repos(mirror_dir):
         with open(join(repo_path, "repodata.json")) as fi:
-            index = json.load(fi)["packages"]
+            repodata = json.load(fi)
+        index = repodata["packages"]
+        index.update(repodata.get("packages.conda", {}))
         d[repo_path] = index
     return d
 
@@ -0,0 +1,180 @@
+"""
+Support for the repodata.jlap incremental repodata format.
+
+A ``repodata.jlap`` file is a series of newline separated lines that sits next
+to ``repodata.json`` on a channel. The first line is a hex encoded 256 bit
+initial value, the following lines are JSON objects of the form::
+
+    {"from": "<hash>", "to": "<hash>", "patch": [<RFC 6902 operations>]}
+
+describing how to turn the repodata.json with BLAKE2b-256 hash ``from`` into
+the one with hash ``to``. The second to last line is a footer of the form
+``{"url": "repodata.json", "latest": "<hash>"}`` and the last line is the hex
+encoded checksum of the whole file: each line is hashed with BLAKE2b-256,
+keyed with the checksum of the line before it, starting from the initial
+value.
+
+Because lines are only ever appended (and the footer rewritten), a client that
+remembers the byte offset and running checksum of the last patch line it has
+seen can fetch just the new lines with an HTTP Range request.
+"""
+
+import copy
+import hashlib
+import json
+
+DIGEST_SIZE = 32  # 256 bits
+
+
+class JlapError(ValueError):
+    pass
+
+
+def keyed_hash(data, key):
+    """
+    Return the BLAKE2b-256 digest of the bytes `data`, keyed with the bytes
+    `key`.
+    """
+    return hashlib.blake2b(data, key=key, digest_size=DIGEST_SIZE).digest()
+
+
+def new_hash():
+    """
+    Return a hash object computing the (unkeyed) BLAKE2b-256 hashes that
+    identify repodata.json versions.
+    """
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def parse(body, iv=None):
+    """
+    Parse and verify the (tail of a) jlap file.
+
+    If `iv` is None, `body` must be the complete file, starting with the
+    initial value line. Otherwise `body` is the part of the file following
+    the line whose running checksum is the bytes `iv`.
+
+    Returns a tuple (patches, footer, pos, iv) where `patches` is the list of
+    patch objects, `footer` the footer object, `pos` the offset in `body` at
+    which the footer starts and `iv` the running checksum of the last patch
+    line. Use `pos` and `iv` to request and parse the next update.
+    """
+    if body.endswith(b"\n"):
+        body = body[:-1]
+    lines = body.split(b"\n")
+    pos = 0
+    if iv is None:
+        try:
+            iv = bytes.fromhex(lines[0].decode("ascii"))
+        except ValueError:
+            raise JlapError("invalid initial value")
+        pos = len(lines[0]) + 1
+        lines = lines[1:]
+    if len(lines) < 2:
+        raise JlapError("missing footer or checksum")
+
+    checksum = iv
+    for line in lines[:-2]:
+        checksum = keyed_hash(line, checksum)
+        pos += len(line) + 1
+    last_patch_iv = checksum
+    checksum = keyed_hash(lines[-2], checksum)
+    if checksum.hex() != lines[-1].decode("ascii", "replace"):
+        raise JlapError("checksum mismatch")
+
+    try:
+        patches = [json.loads(line) for line in lines[:-2]]
+        footer = json.loads(lines[-2])
+    except ValueError:
+        raise JlapError("invalid json line")
+    return patches, footer, pos, last_patch_iv
+
+
+def find_patches(patches, have, want):
+    """
+    Return the patches that need to be applied, in order, to turn the
+    repodata.json with hash `have` into the one with hash `want`.
+    """
+    by_target = {p["to"]: p for p in patches}
+    chain = []
+    current = want
+    while current != have:
+        try:
+            patch = by_target[current]
+        except KeyError:
+            raise JlapError("no patches from %s to %s" % (have, want))
+        chain.append(patch)
+        current = patch["from"]
+    return chain[::-1]
+
+
+def _split_pointer(pointer):
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise JlapError("invalid JSON pointer %r" % pointer)
+    return [p.replace("~1", "/").replace("~0", "~") for p in pointer[1:].split("/")]
+
+
+def _resolve(doc, parts):
+    for part in parts:
+        if isinstance(doc, list):
+            doc = doc[int(part)]
+        else:
+            doc = doc[part]
+    return doc
+
+
+def _add(doc, parts, value):
+    if not parts:
+        return value
+    parent = _resolve(doc, parts[:-1])
+    key = parts[-1]
+    if isinstance(parent, list):
+        parent.insert(len(parent) if key == "-" else int(key), value)
+    else:
+        parent[key] = value
+    return doc
+
+
+def _remove(doc, parts):
+    parent = _resolve(doc, parts[:-1])
+    key = parts[-1]
+    if isinstance(parent, list):
+        return parent.pop(int(key))
+    return parent.pop(key)
+
+
+def apply_patch(doc, patch):
+    """
+    Apply the RFC 6902 JSON patch `patch` (a list of operations) to `doc` and
+    return the result. `doc` is modified in place where possible.
+    """
+    for operation in patch:
+        op = operation["op"]
+        parts = _split_pointer(operation["path"])
+        try:
+            if op == "add":
+                doc = _add(doc, parts, operation["value"])
+            elif op == "remove":
+                _remove(doc, parts)
+            elif op == "replace":
+                if parts:
+                    _remove(doc, parts)
+                doc = _add(doc, parts, operation["value"])
+            elif op == "move":
+                value = _remove(doc, _split_pointer(operation["from"]))
+                doc = _add(doc, parts, value)
+            elif op == "copy":
+                value = copy.deepcopy(_resolve(doc, _split_pointer(operation["from"])))
+                doc = _add(doc, parts, value)
+            elif op == "test":
+                if _resolve(doc, parts) != operation["value"]:
+                    raise JlapError("test failed at %s" % operation["path"])
+            else:
+                raise JlapError("unknown operation %r" % op)
+        except JlapError:
+            raise
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise JlapError("cannot apply %s to %s" % (op, operation["path"]))
+    return doc
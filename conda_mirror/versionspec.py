@@ -9,9 +9,11 @@
 # not part of the officially supported public API nor is it available in a package
 # that can be installed safely outside of the base environment.
 
+from collections import OrderedDict, namedtuple
 from logging import getLogger
 import operator as op
 import re
+import threading
 
 from itertools import zip_longest
 
@@ -40,21 +42,108 @@ class InvalidVersionSpec(ValueError):
         super().__init__(f"Invalid version '{invalid_spec}s': {details}s")
 
 
+# Default number of instances each of VersionOrder, VersionSpec and
+# BuildNumberMatch keeps for the most recently used strings.
+DEFAULT_CACHE_SIZE = 65536
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class LRUCache(object):
+    """Thread-safe mapping that keeps at most `maxsize` of its most recently
+    used items, or all of them if `maxsize` is None, and counts hits and
+    misses."""
+
+    _missing = object()
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, self._missing)
+            if value is self._missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._trim()
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self._trim()
+
+    def _trim(self):
+        if self.maxsize is not None:
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+
 class SingleStrArgCachingType(type):
+    """Metaclass caching the instances created from a single string in the
+    `LRUCache` `_cache_` of the class."""
+
     def __call__(cls, arg):
         if isinstance(arg, cls):
             return arg
         elif isinstance(arg, str):
-            try:
-                return cls._cache_[arg]
-            except KeyError:
-                val = cls._cache_[arg] = super(SingleStrArgCachingType, cls).__call__(
-                    arg
-                )
-                return val
+            val = cls._cache_.get(arg)
+            if val is None:
+                # created outside of the lock of the cache, as creating e.g. a
+                # VersionSpec creates other cached instances
+                val = super(SingleStrArgCachingType, cls).__call__(arg)
+                cls._cache_.put(arg, val)
+            return val
         else:
             return super(SingleStrArgCachingType, cls).__call__(arg)
 
+    def cache_info(cls):
+        """Return the hits, misses, maximum and current size of the cache."""
+        return cls._cache_.info()
+
+    def cache_clear(cls):
+        """Empty the cache and reset its statistics."""
+        cls._cache_.clear()
+
+    def cache_resize(cls, maxsize):
+        """Keep at most `maxsize` instances, or all of them if None."""
+        cls._cache_.resize(maxsize)
+
+
+def set_cache_size(maxsize):
+    """Bound the caches of VersionOrder, VersionSpec and BuildNumberMatch to
+    `maxsize` instances each, or make them unbounded if None."""
+    for cls in (VersionOrder, VersionSpec, BuildNumberMatch):
+        cls.cache_resize(maxsize)
+
+
+def cache_info():
+    """Return the `CacheInfo` of the caches of VersionOrder, VersionSpec and
+    BuildNumberMatch, keyed on class name."""
+    return {
+        cls.__name__: cls.cache_info()
+        for cls in (VersionOrder, VersionSpec, BuildNumberMatch)
+    }
+
 
 class VersionOrder(metaclass=SingleStrArgCachingType):
     """
@@ -167,7 +256,7 @@ class VersionOrder(metaclass=SingleStrArgCachingType):
       1.0.1_ < 1.0.1a =>  True   # ensure correct ordering for openssl
     """
 
-    _cache_ = {}
+    _cache_ = LRUCache()
 
     def __init__(self, vstr):
         # version comparison is case-insensitive
@@ -248,12 +337,18 @@ class VersionOrder(metaclass=SingleStrArgCachingType):
                     # strings in phase => prepend fillvalue
                     v[k] = [self.fillvalue] + c
 
+        # comparisons only compare these keys
+        self._key = (_sequence_key(self.version), _sequence_key(self.local))
+
     def __str__(self):
         return self.norm_version
 
     def __repr__(self):
         return '%s("%s")' % (self.__class__.__name__, self)
 
+    def __hash__(self):
+        return hash(self._key)
+
     def _eq(self, t1, t2):
         for v1, v2 in zip_longest(t1, t2, fillvalue=[]):
             for c1, c2 in zip_longest(v1, v2, fillvalue=self.fillvalue):
@@ -262,9 +357,7 @@ class VersionOrder(metaclass=SingleStrArgCachingType):
         return True
 
     def __eq__(self, other):
-        return self._eq(self.version, other.version) and self._eq(
-            self.local, other.local
-        )
+        return self._key == other._key
 
     def startswith(self, other):
         # Tests if the version lists match up to the last element in "other".
@@ -294,31 +387,66 @@ class VersionOrder(metaclass=SingleStrArgCachingType):
         return not (self == other)
 
     def __lt__(self, other):
-        for t1, t2 in zip([self.version, self.local], [other.version, other.local]):
-            for v1, v2 in zip_longest(t1, t2, fillvalue=[]):
-                for c1, c2 in zip_longest(v1, v2, fillvalue=self.fillvalue):
-                    if c1 == c2:
-                        continue
-                    elif isinstance(c1, str):
-                        if not isinstance(c2, str):
-                            # str < int
-                            return True
-                    elif isinstance(c2, str):
-                        # not (int < str)
-                        return False
-                    # c1 and c2 have the same type
-                    return c1 < c2
-        # self == other
-        return False
+        return self._key < other._key
 
     def __gt__(self, other):
-        return other < self
+        return self._key > other._key
 
     def __le__(self, other):
-        return not (other < self)
+        return self._key <= other._key
 
     def __ge__(self, other):
-        return not (self < other)
+        return self._key >= other._key
+
+
+# Tokens of the sort keys of VersionOrder. The version and local version are
+# sequences of components, which are sequences of elements: strings, numbers
+# and inf ('post'). Both kinds of sequences are compared as if padded with
+# zeros (empty components), and strings are smaller than numbers.
+#
+# Trailing zeros are dropped and the end of a sequence is marked with a
+# terminator that sorts like the padding. A zero in the middle sorts before
+# the terminator if the next non-zero item of its sequence is smaller than
+# zero, and after it otherwise. That way plain tuple comparison of the keys
+# gives the same order as comparing the padded sequences item by item.
+_STR, _ZERO_BEFORE_STR, _END, _ZERO_BEFORE_NUMBER, _NUMBER = range(5)
+_TERMINATOR = (_END, 0)
+_EMPTY_COMPONENT = (_TERMINATOR,)
+
+
+def _component_key(component):
+    """Sort key of a list of version elements."""
+    elements = list(component)
+    while elements and not isinstance(elements[-1], str) and elements[-1] == 0:
+        elements.pop()
+    tokens = [_TERMINATOR]
+    before_str = False
+    for element in reversed(elements):
+        if isinstance(element, str):
+            tokens.append((_STR, element))
+            before_str = True
+        elif element:
+            tokens.append((_NUMBER, element))
+            before_str = False
+        else:
+            tokens.append((_ZERO_BEFORE_STR,) if before_str else (_ZERO_BEFORE_NUMBER,))
+    return tuple(reversed(tokens))
+
+
+def _sequence_key(components):
+    """Sort key of a list of version components."""
+    keys = [_component_key(component) for component in components]
+    while keys and keys[-1] == _EMPTY_COMPONENT:
+        keys.pop()
+    result = [_EMPTY_COMPONENT]
+    greater = False
+    for key in reversed(keys):
+        if key == _EMPTY_COMPONENT:
+            result.append(((_END, 1 if greater else -1),))
+        else:
+            result.append(key)
+            greater = key > _EMPTY_COMPONENT
+    return tuple(reversed(result))
 
 
 # each token slurps up leading whitespace, which we strip out.
@@ -515,7 +643,7 @@ class BaseSpec(object):
 class VersionSpec(
     BaseSpec, metaclass=SingleStrArgCachingType
 ):  # lgtm [py/missing-equals]
-    _cache_ = {}
+    _cache_ = LRUCache()
 
     def __init__(self, vspec):
         vspec_str, matcher, is_exact = self.get_matcher(vspec)
@@ -629,7 +757,7 @@ class VersionSpec(
 class BuildNumberMatch(
     BaseSpec, metaclass=SingleStrArgCachingType
 ):  # lgtm [py/missing-equals]
-    _cache_ = {}
+    _cache_ = LRUCache()
 
     def __init__(self, vspec):
         vspec_str, matcher, is_exact = self.get_matcher(vspec)
@@ -1,5 +1,215 @@
+import bz2
+import hashlib
+import http.server
+import io
+import json
 import logging
+import os
+import re
+import tarfile
+import threading
+import zipfile
+from functools import partial
+
+import pytest
 
 from conda_mirror import conda_mirror
 
 conda_mirror.logger = logging.getLogger("conda_mirror-test")
+
+
+LOCAL_CHANNEL_NAME = "local-channel"
+
+# (subdir, name, version, build, build_number, depends)
+LOCAL_CHANNEL_PACKAGES = [
+    ("linux-64", "alpha", "1.0", "0", 0, []),
+    ("linux-64", "alpha", "1.1", "0", 0, ["beta >=2"]),
+    ("linux-64", "beta", "1.0", "0", 0, []),
+    ("linux-64", "beta", "2.0", "0", 0, ["gamma"]),
+    ("linux-64", "gamma", "0.1", "0", 0, []),
+    ("linux-64", "delta", "3.0", "py37_0", 0, []),
+    ("noarch", "epsilon", "1.0", "0", 0, []),
+]
+
+
+def make_package(
+    directory, name, version, build="0", build_number=0, extension=".tar.bz2", **extra
+):
+    """Write a minimal conda package into `directory` and return its record.
+
+    With `extension` '.conda', the package is written in the .conda format,
+    which requires zstandard.
+    """
+    subdir = os.path.basename(directory)
+    index = dict(
+        name=name,
+        version=version,
+        build=build,
+        build_number=build_number,
+        subdir=subdir,
+        license="BSD",
+        **extra,
+    )
+    data = json.dumps(index).encode("utf-8")
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as t:
+        tarinfo = tarfile.TarInfo("info/index.json")
+        tarinfo.size = len(data)
+        t.addfile(tarinfo, io.BytesIO(data))
+    stem = "%s-%s-%s" % (name, version, build)
+    filename = stem + extension
+    if extension == ".conda":
+        import zstandard
+
+        compress = zstandard.ZstdCompressor().compress
+        pkg_buf = io.BytesIO()
+        tarfile.open(fileobj=pkg_buf, mode="w").close()
+        zip_buf = io.BytesIO()
+        with zipfile.ZipFile(zip_buf, "w") as z:
+            z.writestr("metadata.json", json.dumps({"conda_pkg_format_version": 2}))
+            z.writestr("pkg-%s.tar.zst" % stem, compress(pkg_buf.getvalue()))
+            z.writestr("info-%s.tar.zst" % stem, compress(buf.getvalue()))
+        contents = zip_buf.getvalue()
+    else:
+        contents = bz2.compress(buf.getvalue())
+    with open(os.path.join(directory, filename), "wb") as f:
+        f.write(contents)
+    index.update(
+        md5=hashlib.md5(contents).hexdigest(),
+        sha256=hashlib.sha256(contents).hexdigest(),
+        size=len(contents),
+    )
+    return filename, index
+
+
+def write_channel_repodata(directory, packages, info=None):
+    """Write repodata.json for the subdir at `directory`."""
+    subdir = os.path.basename(directory)
+    repodata = {"info": info or {"subdir": subdir}, "packages": {}}
+    for filename, record in packages.items():
+        section = "packages.conda" if filename.endswith(".conda") else "packages"
+        repodata.setdefault(section, {})[filename] = record
+    with open(os.path.join(directory, "repodata.json"), "w") as f:
+        json.dump(repodata, f, indent=2, sort_keys=True)
+    return repodata
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """Serve files quietly, record requests, honour ``Range: bytes=N-`` with
+    ``If-Range`` and drop connections mid-body or answer with an error when
+    told to."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        failures = self.server.failures.get(self.path)
+        if failures:
+            self.send_error(failures.pop(0))
+            return None
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+        drops = self.server.drops.get(self.path)
+        if (match is None and not drops) or not os.path.isfile(path):
+            return super().send_head()
+        with open(path, "rb") as f:
+            data = f.read()
+        stat = os.stat(path)
+        etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+        last_modified = self.date_time_string(stat.st_mtime)
+        start = 0
+        if match is not None and self.headers.get("If-Range", etag) in (
+            etag,
+            last_modified,
+        ):
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_error(416)
+                return None
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes %d-%d/%d" % (start, len(data) - 1, len(data))
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(len(data) - start))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        body = data[start:]
+        if drops:
+            # send only part of the body and hang up
+            body = body[: drops.pop(0)]
+            self.close_connection = True
+        return io.BytesIO(body)
+
+
+class LocalChannel:
+    """A conda channel served over HTTP from a temporary directory."""
+
+    def __init__(self, root, name=LOCAL_CHANNEL_NAME):
+        self.root = root
+        self.name = name
+        self.packages = {}
+        for subdir, *spec, depends in LOCAL_CHANNEL_PACKAGES:
+            directory = os.path.join(root, self.name, subdir)
+            os.makedirs(directory, exist_ok=True)
+            filename, record = make_package(directory, *spec, depends=depends)
+            self.packages.setdefault(subdir, {})[filename] = record
+        for subdir, packages in self.packages.items():
+            write_channel_repodata(os.path.join(root, self.name, subdir), packages)
+        handler = partial(_QuietHandler, directory=root)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.requests = []
+        self.server.drops = {}
+        self.server.failures = {}
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return "http://%s:%s/%s" % (host, port, self.name)
+
+    @property
+    def requests(self):
+        """The (path, headers) of every request the server has received."""
+        return self.server.requests
+
+    def drop_connections(self, path, *num_bytes):
+        """Hang up on the next requests for `path` (relative to the channel)
+        after sending `num_bytes` bytes of the body of each."""
+        self.server.drops["/%s/%s" % (self.name, path)] = list(num_bytes)
+
+    def fail_requests(self, path, *statuses):
+        """Answer the next requests for `path` (relative to the channel) with
+        the error `statuses`, one each."""
+        self.server.failures["/%s/%s" % (self.name, path)] = list(statuses)
+
+    def path(self, *parts):
+        return os.path.join(self.root, self.name, *parts)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def local_channel(tmpdir):
+    """An upstream channel served from localhost with a handful of packages."""
+    with LocalChannel(tmpdir.mkdir("upstream").strpath) as channel:
+        yield channel
+
+
+@pytest.fixture
+def other_channel(tmpdir):
+    """A second upstream channel, served from another port of localhost."""
+    with LocalChannel(
+        tmpdir.mkdir("other-upstream").strpath, "other-channel"
+    ) as channel:
+        yield channel
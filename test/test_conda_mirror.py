@@ -1,15 +1,18 @@
+import asyncio
 import bz2
 import copy
 import itertools
 import json
 import os
 import sys
+import zipfile
 
 from os.path import join
 
 from conda_mirror import conda_mirror
 
 import pytest
+import requests
 
 
 anaconda_channel = "https://repo.continuum.io/pkgs/free"
@@ -230,3 +233,1174 @@ def test_dry_run_dumb(tmpdir):
     assert (
         len(ret["to-mirror"]) > 1
     ), "We should have a great deal of packages slated to download"
+
+
+@pytest.mark.parametrize("num_downloads", [1, 4])
+def test_main_concurrent_downloads(tmpdir, local_channel, num_downloads):
+    platform = "linux-64"
+    target_directory = tmpdir.mkdir("mirror")
+    temp_directory = tmpdir.mkdir("temp")
+    packages = local_channel.packages[platform]
+
+    ret = conda_mirror.main(
+        upstream_channel=local_channel.url,
+        target_directory=target_directory.strpath,
+        temp_directory=temp_directory.strpath,
+        platform=platform,
+        num_downloads=num_downloads,
+        show_progress=False,
+    )
+
+    assert len(ret["downloaded"]) == len(packages)
+    assert len(ret["validating-new"]) == len(packages)
+    assert all(reason is None for _, reason in ret["validating-new"])
+    mirrored = conda_mirror._list_conda_packages(target_directory.join(platform))
+    assert sorted(mirrored) == sorted(packages)
+
+
+@pytest.mark.parametrize("num_downloads", [0, -1])
+def test_main_rejects_no_downloads(tmpdir, local_channel, num_downloads):
+    with pytest.raises(ValueError, match="num_downloads"):
+        conda_mirror.main(
+            upstream_channel=local_channel.url,
+            target_directory=tmpdir.mkdir("mirror").strpath,
+            temp_directory=tmpdir.mkdir("temp").strpath,
+            platform="linux-64",
+            num_downloads=num_downloads,
+            show_progress=False,
+        )
+    assert local_channel.requests == []
+
+
+def test_main_asyncio_downloads(tmpdir, local_channel):
+    pytest.importorskip("aiohttp")
+    platform = "linux-64"
+    target_directory = tmpdir.mkdir("mirror")
+    temp_directory = tmpdir.mkdir("temp")
+    packages = local_channel.packages[platform]
+
+    ret = conda_mirror.main(
+        upstream_channel=local_channel.url,
+        target_directory=target_directory.strpath,
+        temp_directory=temp_directory.strpath,
+        platform=platform,
+        num_downloads=3,
+        download_backend="asyncio",
+        show_progress=False,
+    )
+
+    assert len(ret["downloaded"]) == len(packages)
+    assert all(reason is None for _, reason in ret["validating-new"])
+    mirrored = conda_mirror._list_conda_packages(target_directory.join(platform))
+    assert sorted(mirrored) == sorted(packages)
+
+
+@pytest.mark.parametrize("backend", ["requests", "asyncio"])
+def test_main_verifies_while_downloading(tmpdir, local_channel, monkeypatch, backend):
+    from conftest import write_channel_repodata
+
+    if backend == "asyncio":
+        pytest.importorskip("aiohttp")
+    platform = "linux-64"
+    packages = local_channel.packages[platform]
+    bad_package, missing_package = sorted(packages)[:2]
+    packages[bad_package]["md5"] = "0" * 32
+    write_channel_repodata(local_channel.path(platform), packages)
+    # still listed upstream, but no longer served
+    os.remove(local_channel.path(platform, missing_package))
+
+    validated = []
+    validate = conda_mirror._validate
+    monkeypatch.setattr(
+        conda_mirror,
+        "_validate",
+        lambda filename, **kw: validated.append(filename) or validate(filename, **kw),
+    )
+
+    target_directory = tmpdir.mkdir("mirror")
+    ret = conda_mirror.main(
+        upstream_channel=local_channel.url,
+        target_directory=target_directory.strpath,
+        temp_directory=tmpdir.mkdir("temp").strpath,
+        platform=platform,
+        download_backend=backend,
+        show_progress=False,
+    )
+
+    # packages are not read back after they were hashed in-stream
+    assert validated == []
+    rejected = [path for path, reason in ret["validating-new"] if reason]
+    assert sorted(os.path.basename(path) for path in rejected) == [
+        bad_package,
+        missing_package,
+    ]
+    # neither is retried, and the other packages are still mirrored
+    for package in (bad_package, missing_package):
+        paths = [path for path, _ in local_channel.requests if path.endswith(package)]
+        assert len(paths) == 1
+    mirrored = conda_mirror._list_conda_packages(target_directory.join(platform))
+    assert sorted(mirrored) == sorted(set(packages) - {bad_package, missing_package})
+
+
+def test_validation_cache(tmpdir, monkeypatch):
+    from conftest import make_package
+
+    package_directory = tmpdir.mkdir("linux-64")
+    repodata = dict(
+        make_package(package_directory.strpath, name, "1.0") for name in "abc"
+    )
+    cache_directory = tmpdir.join("state").strpath
+    validated = []
+    validate = conda_mirror._validate
+    monkeypatch.setattr(
+        conda_mirror,
+        "_validate",
+        lambda filename, **kw: validated.append(filename) or validate(filename, **kw),
+    )
+
+    def run(**kwargs):
+        del validated[:]
+        results = conda_mirror._validate_packages(
+            repodata,
+            package_directory.strpath,
+            cache_directory=cache_directory,
+            **kwargs,
+        )
+        assert all(reason is None for _, reason in results)
+        assert len(results) == len(repodata)
+        return sorted(os.path.basename(path) for path in validated)
+
+    assert run() == sorted(repodata)
+    # nothing changed, nothing needs to be hashed
+    assert run() == []
+
+    # a changed file and a changed upstream md5 are validated again
+    a, b, c = sorted(repodata)
+    os.utime(package_directory.join(a).strpath, ns=(0, 0))
+    repodata[b] = dict(repodata[b], md5=None)
+    assert run() == [a, b]
+    assert run() == []
+
+    # entries expire after cache_max_age seconds
+    assert run(cache_max_age=0) == sorted(repodata)
+
+
+@pytest.mark.parametrize(
+    "num_threads,validation_executor",
+    [(1, None), (2, None), (2, "thread"), (0, "thread"), (2, "serial")],
+)
+def test_validate_packages(tmpdir, num_threads, validation_executor):
+    from conftest import make_package
+
+    package_directory = tmpdir.mkdir("linux-64")
+    repodata = dict(
+        make_package(package_directory.strpath, name, "1.0") for name in "abcd"
+    )
+    bad_md5, _, _, good = sorted(repodata)
+    repodata[bad_md5] = dict(repodata[bad_md5], md5="0" * 32)
+    _write_bad_package(tmpdir.strpath, "linux-64", "unindexed-1-0.tar.bz2")
+
+    results = conda_mirror._validate_packages(
+        repodata,
+        package_directory.strpath,
+        num_threads=num_threads,
+        validation_executor=validation_executor,
+    )
+
+    reasons = {os.path.basename(path): reason for path, reason in results}
+    assert set(reasons) == set(repodata) | {"unindexed-1-0.tar.bz2"}
+    assert reasons[good] is None
+    assert "Failed md5 validation" in reasons[bad_md5]
+    assert "not in the repodata index" in reasons["unindexed-1-0.tar.bz2"]
+    remaining = conda_mirror._list_conda_packages(package_directory.strpath)
+    assert sorted(remaining) == sorted(set(repodata) - {bad_md5})
+
+
+def test_main_skips_unchanged_upstream(tmpdir, local_channel, monkeypatch):
+    from conftest import write_channel_repodata
+
+    platform = "linux-64"
+    packages = local_channel.packages[platform]
+    target_directory = tmpdir.mkdir("mirror")
+    kwargs = dict(
+        upstream_channel=local_channel.url,
+        target_directory=target_directory.strpath,
+        temp_directory=tmpdir.mkdir("temp").strpath,
+        platform=platform,
+        blacklist=[{"name": "*"}],
+        whitelist=[{"name": "alpha"}],
+        show_progress=False,
+    )
+
+    ret = conda_mirror.main(**kwargs)
+    assert len(ret["downloaded"]) == 2
+
+    # upstream answers 304 and the config did not change: nothing is done
+    load_repodata = conda_mirror._load_repodata
+    loaded = []
+    monkeypatch.setattr(
+        conda_mirror,
+        "_load_repodata",
+        lambda *args: loaded.append(args) or load_repodata(*args),
+    )
+    ret = conda_mirror.main(**kwargs)
+    assert loaded == []
+    assert not any(ret.values())
+
+    # a changed configuration triggers a full run
+    kwargs["whitelist"] = [{"name": "beta"}]
+    ret = conda_mirror.main(**kwargs)
+    assert len(loaded) == 1
+    assert len(ret["downloaded"]) == 2
+
+    # and so does a change upstream
+    del packages[sorted(packages)[0]]
+    write_channel_repodata(local_channel.path(platform), packages)
+    future = os.stat(local_channel.path(platform, "repodata.json")).st_mtime + 10
+    os.utime(local_channel.path(platform, "repodata.json"), (future, future))
+    ret = conda_mirror.main(**kwargs)
+    assert len(loaded) == 2
+    assert len(ret["validating-existing"]) == 2
+
+
+def test_fetch_compressed_repodata(tmpdir, local_channel):
+    platform = "linux-64"
+    session = conda_mirror._make_session()
+    url = "%s/%s/repodata.json" % (local_channel.url, platform)
+    with open(local_channel.path(platform, "repodata.json"), "rb") as f:
+        expected = f.read()
+    # write the bz2 variant as two concatenated streams
+    with open(local_channel.path(platform, "repodata.json.bz2"), "wb") as f:
+        f.write(bz2.compress(expected[:100]) + bz2.compress(expected[100:]))
+
+    cache_dir = tmpdir.join("bz2").strpath
+    path, state, not_modified = conda_mirror._fetch_repodata(url, session, cache_dir)
+    assert state["url"] == url + ".bz2"
+    assert not not_modified
+    with open(path, "rb") as f:
+        assert f.read() == expected
+
+    # the cached variant is revalidated rather than switching formats
+    path, state, not_modified = conda_mirror._fetch_repodata(url, session, cache_dir)
+    assert state["url"] == url + ".bz2"
+    assert not_modified
+
+    zstandard = pytest.importorskip("zstandard")
+    with open(local_channel.path(platform, "repodata.json.zst"), "wb") as f:
+        f.write(zstandard.ZstdCompressor().compress(expected))
+    cache_dir = tmpdir.join("zst").strpath
+    path, state, _ = conda_mirror._fetch_repodata(url, session, cache_dir)
+    assert state["url"] == url + ".zst"
+    with open(path, "rb") as f:
+        assert f.read() == expected
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_iter_repodata(tmpdir, monkeypatch, chunk_size):
+    repodata = {
+        "info": {"subdir": "linux-64", "nested": {"a": [1, 2.5, None, True]}},
+        "packages": {
+            "a-1.0-0.tar.bz2": {"name": "a", "size": 123456, "depends": ["b >=1"]},
+            "b-1.0-0.tar.bz2": {"name": "b", "size": 7, "license": "café"},
+        },
+        "packages.conda": {"a-1.0-0.conda": {"name": "a", "size": 98765}},
+        "removed": [],
+        "repodata_version": 1,
+    }
+    path = tmpdir.join("repodata.json")
+    path.write(json.dumps(repodata, indent=2))
+
+    entries = list(conda_mirror._iter_repodata(path.strpath, chunk_size=chunk_size))
+    assert entries == [
+        (None, "info", repodata["info"]),
+        ("packages", "a-1.0-0.tar.bz2", repodata["packages"]["a-1.0-0.tar.bz2"]),
+        ("packages", "b-1.0-0.tar.bz2", repodata["packages"]["b-1.0-0.tar.bz2"]),
+        (
+            "packages.conda",
+            "a-1.0-0.conda",
+            repodata["packages.conda"]["a-1.0-0.conda"],
+        ),
+        (None, "removed", []),
+        (None, "repodata_version", 1),
+    ]
+
+    # a small file is read in one go, a large one streamed
+    for stream_size in (conda_mirror.REPODATA_STREAM_SIZE, 0):
+        monkeypatch.setattr(conda_mirror, "REPODATA_STREAM_SIZE", stream_size)
+        info, packages = conda_mirror._load_repodata(path.strpath, "linux-64")
+        assert info == repodata["info"]
+        # the .conda packages are loaded together with the .tar.bz2 ones
+        assert packages == {
+            name: dict(record, subdir="linux-64")
+            for section in ("packages", "packages.conda")
+            for name, record in repodata[section].items()
+        }
+        # repeated values are shared between the records
+        a, b, a_conda = packages.values()
+        assert a["subdir"] is b["subdir"] is a_conda["subdir"]
+
+    path.write('{"packages": {"a": 1,}}')
+    with pytest.raises(ValueError):
+        list(conda_mirror._iter_repodata(path.strpath, chunk_size=chunk_size))
+
+
+@pytest.mark.parametrize("block_size", [64, conda_mirror.BZ2_BLOCK_SIZE])
+def test_write_repodata(tmpdir, monkeypatch, block_size):
+    monkeypatch.setattr(conda_mirror, "BZ2_BLOCK_SIZE", block_size)
+    repodata = {
+        "info": {"subdir": "linux-64"},
+        "packages": {
+            "a-%s-0.tar.bz2" % i: {"name": "a", "version": str(i), "depends": []}
+            for i in range(50)
+        },
+    }
+    conda_mirror._write_repodata(tmpdir.strpath, repodata, num_threads=4)
+
+    expected = json.dumps(repodata, indent=2, sort_keys=True) + "\n"
+    assert tmpdir.join("repodata.json").read() == expected
+    with bz2.open(tmpdir.join("repodata.json.bz2").strpath, "rt") as f:
+        assert f.read() == expected
+    assert sorted(os.listdir(tmpdir.strpath)) == ["repodata.json", "repodata.json.bz2"]
+
+
+def test_write_repodata_zst_and_current(tmpdir):
+    zstandard = pytest.importorskip("zstandard")
+    packages = {
+        "a-1.9-0.tar.bz2": {"name": "a", "version": "1.9"},
+        "a-1.10-0.tar.bz2": {"name": "a", "version": "1.10"},
+        "a-1.10-1.tar.bz2": {"name": "a", "version": "1.10"},
+        "b-2.0a1-0.tar.bz2": {"name": "b", "version": "2.0a1"},
+        "b-2.0-0.tar.bz2": {"name": "b", "version": "2.0"},
+    }
+    repodata = {"info": {"subdir": "linux-64"}, "packages": packages}
+    conda_mirror._write_repodata(tmpdir.strpath, repodata, zst=True, current=True)
+
+    expected = json.dumps(repodata, indent=2, sort_keys=True) + "\n"
+    with open(tmpdir.join("repodata.json.zst").strpath, "rb") as f:
+        data = zstandard.ZstdDecompressor().stream_reader(f).read()
+    assert data.decode("utf-8") == expected
+    current = json.loads(tmpdir.join("current_repodata.json").read())
+    assert current["info"] == repodata["info"]
+    assert sorted(current["packages"]) == [
+        "a-1.10-0.tar.bz2",
+        "a-1.10-1.tar.bz2",
+        "b-2.0-0.tar.bz2",
+    ]
+
+    # indexes that are no longer requested are removed
+    conda_mirror._write_repodata(tmpdir.strpath, repodata)
+    assert sorted(os.listdir(tmpdir.strpath)) == ["repodata.json", "repodata.json.bz2"]
+
+
+def test_main_skips_unchanged_repodata(tmpdir, local_channel):
+    from conftest import write_channel_repodata
+
+    platform = "linux-64"
+    packages = local_channel.packages[platform]
+    upstream_repodata = local_channel.path(platform, "repodata.json")
+    target_directory = tmpdir.mkdir("mirror")
+    repodata_path = target_directory.join(platform, "repodata.json").strpath
+    kwargs = dict(
+        upstream_channel=local_channel.url,
+        target_directory=target_directory.strpath,
+        temp_directory=tmpdir.mkdir("temp").strpath,
+        platform=platform,
+        show_progress=False,
+    )
+
+    mtimes = itertools.count(os.stat(upstream_repodata).st_mtime + 10, 10)
+
+    def touch_upstream():
+        mtime = next(mtimes)
+        os.utime(upstream_repodata, (mtime, mtime))
+
+    conda_mirror.main(**kwargs)
+    written = os.stat(repodata_path).st_mtime_ns
+
+    # upstream is fetched again, but the index would be the same
+    touch_upstream()
+    conda_mirror.main(**kwargs)
+    assert os.stat(repodata_path).st_mtime_ns == written
+
+    # an index that was changed by someone else is rewritten
+    with open(repodata_path, "a") as f:
+        f.write(" ")
+    touch_upstream()
+    conda_mirror.main(**kwargs)
+    with open(repodata_path) as f:
+        assert f.read().endswith("}\n")
+    written = os.stat(repodata_path).st_mtime_ns
+
+    # so is one whose packages changed upstream
+    del packages[sorted(packages)[0]]
+    write_channel_repodata(local_channel.path(platform), packages)
+    touch_upstream()
+    conda_mirror.main(**kwargs)
+    assert os.stat(repodata_path).st_mtime_ns != written
+    with open(repodata_path) as f:
+        assert sorted(json.load(f)["packages"]) == sorted(packages)
+
+
+def _scan(packages, rule):
+    """Match `rule` against every package, as _match used to."""
+    matchers = conda_mirror._compile_rule(rule)
+    return {
+        pkg_name
+        for pkg_name, pkg_info in packages.items()
+        if all(
+            matcher(str(pkg_info.get(key, "")).lower())
+            for key, matcher in matchers.items()
+        )
+    }
+
+
+def test_filter_plan():
+    packages = {
+        "%s-%s-%s.tar.bz2"
+        % (name, version, build): {
+            "name": name,
+            "version": version,
+            "build": build,
+            "build_number": build_number,
+            "license": license,
+        }
+        for name, license in [("numpy", "BSD"), ("NumPy-Base", "bsd"), ("gcc", "GPL")]
+        for version in ["1.9", "1.10.1", "2.0"]
+        for build, build_number in [("py37_0", 0), ("py38_1", 1)]
+    }
+    blacklists = [
+        [{"name": "*"}],
+        [{"name": "numpy*"}, {"license": "GPL*"}],
+        [{"version": ">=1.10"}, {"name": "gcc", "build": "py37*"}],
+        [{"version": ">1.9 py38*"}, {"build": ">0"}],
+        [{"name": "gcc", "version": "1.1*"}],
+        [{"name": "num?y"}, {"name": "*base", "version": "2.0"}, {"name": "gcc-*"}],
+        [
+            {"name": "numpy", "version": ">=1.10,<2|1.9 py38*"},
+            {"name": "gcc", "version": "1.*"},
+        ],
+        [{}],
+        [],
+    ]
+    whitelists = [[], [{"name": "NUMPY"}], [{"version": "<2", "license": "bsd"}]]
+    for blacklist, whitelist in itertools.product(blacklists, whitelists):
+        excluded = set().union(*(_scan(packages, rule) for rule in blacklist))
+        required = set().union(*(_scan(packages, rule) for rule in whitelist))
+        excluded -= required
+
+        plan = conda_mirror._FilterPlan(blacklist, whitelist)
+        assert plan.evaluate(packages) == (excluded, required), (blacklist, whitelist)
+
+
+def test_version_index():
+    from conda_mirror.versionspec import VersionSpec
+
+    versions = ["0.9", "1.0a1", "1.0", "1.0.0", "1.0.1", "1.10", "1.9", "2.0.dev0"]
+    versions += ["2.0", "2.0+local", "1!0.1", "invalid@version"]
+    packages = {"pkg-%s-0.tar.bz2" % v: {"name": "pkg", "version": v} for v in versions}
+    index = conda_mirror._NameIndex(packages).versions("pkg")
+    specs = [
+        "*",
+        "1.0",
+        "==1.0.0",
+        ">=1.0",
+        ">1.0,<=1.10",
+        "<1.0|>=2.0",
+        ">=1.0a1,<1.0.1|==1.9",
+        ">2.0.dev0,<2.0",
+        "1.*",
+        "!=1.0",
+        "~=1.0",
+        "^1\\.1.*$",
+        "(>=1.9,<2)|0.9",
+    ]
+    for spec in specs:
+        expected = set()
+        for pkg_name, pkg_info in packages.items():
+            try:
+                if VersionSpec(spec).match(pkg_info["version"]):
+                    expected.add(pkg_name)
+            except ValueError:
+                pass
+        assert set(index.match(spec)) == expected, spec
+
+
+def test_restore_required_dependencies_local():
+    from conftest import LOCAL_CHANNEL_PACKAGES
+
+    packages = {
+        "%s-%s-%s.tar.bz2"
+        % (name, version, build): {
+            "name": name,
+            "version": version,
+            "build": build,
+            "depends": depends,
+        }
+        for _, name, version, build, _, depends in LOCAL_CHANNEL_PACKAGES
+    }
+    required = {"alpha-1.1-0.tar.bz2"}
+    excluded = set(packages) - required
+    assert conda_mirror._restore_required_dependencies(
+        packages, excluded, required
+    ) == excluded - {"beta-2.0-0.tar.bz2", "gamma-0.1-0.tar.bz2"}
+
+
+def _reference_restore(all_packages, excluded, required):
+    """_restore_required_dependencies as it was before the name index: every
+    excluded package is matched against the new dependencies of each
+    round."""
+    cur_required = set(required)
+    already_required = set(all_packages.get(r, {}).get("name") for r in required)
+    final_excluded = set(excluded)
+    while final_excluded and cur_required:
+        required_depend_specs = {}
+        for req in cur_required:
+            for dep in all_packages.get(req, {}).get("depends", ()):
+                try:
+                    pkg_name, version_spec = dep.split(maxsplit=1)
+                except ValueError:
+                    pkg_name, version_spec = dep, ""
+                if pkg_name not in already_required:
+                    required_depend_specs.setdefault(pkg_name, set()).add(version_spec)
+        cur_required.clear()
+        for k in list(final_excluded):
+            info = all_packages.get(k, {})
+            for version_spec in required_depend_specs.get(info.get("name"), ()):
+                if conda_mirror.DependsMatcher(version_spec)(info):
+                    final_excluded.remove(k)
+                    cur_required.add(k)
+                    break
+    return final_excluded
+
+
+def test_restore_required_dependencies_rounds():
+    def package(name, version, *depends):
+        return "%s-%s-0.tar.bz2" % (name, version), {
+            "name": name,
+            "version": version,
+            "build": "0",
+            "build_number": 0,
+            "depends": list(depends),
+        }
+
+    packages = dict(
+        [
+            package("app", "1.0", "lib >=2", "helper"),
+            package("lib", "1.0", "core ==1.0"),
+            package("lib", "2.0", "core >=1.5,<2"),
+            package("lib", "3.0", "core >=2.1"),
+            package("core", "1.0"),
+            package("core", "1.5"),
+            package("core", "2.0"),
+            package("core", "2.1", "tiny"),
+            package("tiny", "1.0"),
+            package("unrelated", "1.0", "core"),
+        ]
+    )
+    # a noarch dependency, merged in under a prefixed key as main does. Its
+    # own dependency on 'lib <2' only comes up in the second round.
+    key, record = package("helper", "0.1", "lib <2")
+    packages[conda_mirror.NOARCH_PREFIX + key] = record
+    required = {"app-1.0-0.tar.bz2"}
+    excluded = set(packages) - required
+
+    restored = excluded - conda_mirror._restore_required_dependencies(
+        packages, excluded, required
+    )
+    assert restored == excluded - _reference_restore(packages, excluded, required)
+    assert restored == {
+        "noarch/helper-0.1-0.tar.bz2",
+        "lib-1.0-0.tar.bz2",
+        "lib-2.0-0.tar.bz2",
+        "lib-3.0-0.tar.bz2",
+        "core-1.0-0.tar.bz2",
+        "core-1.5-0.tar.bz2",
+        "core-2.1-0.tar.bz2",
+        "tiny-1.0-0.tar.bz2",
+    }
+
+
+def test_restore_required_dependencies_case_sensitive():
+    packages = {
+        "app-1.0-0.tar.bz2": {"name": "app", "version": "1.0", "depends": ["numpy"]},
+        "numpy-1.0-0.tar.bz2": {"name": "numpy", "version": "1.0", "depends": []},
+        "NumPy-1.0-0.tar.bz2": {"name": "NumPy", "version": "1.0", "depends": []},
+    }
+    required = {"app-1.0-0.tar.bz2"}
+    excluded = set(packages) - required
+    # dependencies only match packages with exactly the same name
+    assert conda_mirror._restore_required_dependencies(
+        packages, excluded, required
+    ) == {"NumPy-1.0-0.tar.bz2"}
+
+
+@pytest.mark.parametrize("platform", ["linux-64", ["linux-64", "noarch"]])
+def test_main_noarch_dependencies(tmpdir, local_channel, platform):
+    from conftest import make_package, write_channel_repodata
+
+    # theta depends on the noarch zeta, which depends on beta in linux-64
+    for subdir, name, depends in [
+        ("linux-64", "theta", ["zeta >=1", "gamma"]),
+        ("noarch", "zeta", ["beta >=2"]),
+        ("noarch", "eta", []),
+    ]:
+        filename, record = make_package(
+            local_channel.path(subdir), name, "1.0", depends=depends
+        )
+        local_channel.packages[subdir][filename] = record
+        write_channel_repodata(
+            local_channel.path(subdir), local_channel.packages[subdir]
+        )
+
+    # a noarch package mirrored before is kept, unless the noarch platform is
+    # mirrored too and it is blacklisted there
+    target_directory = tmpdir.mkdir("mirror")
+    noarch_directory = target_directory.mkdir("noarch")
+    upstream_epsilon = local_channel.path("noarch", "epsilon-1.0-0.tar.bz2")
+    with open(upstream_epsilon, "rb") as f:
+        noarch_directory.join("epsilon-1.0-0.tar.bz2").write_binary(f.read())
+
+    summary = conda_mirror.main(
+        upstream_channel=local_channel.url,
+        target_directory=target_directory.strpath,
+        temp_directory=tmpdir.mkdir("temp").strpath,
+        platform=platform,
+        blacklist=[{"name": "*"}],
+        whitelist=[{"name": "theta"}],
+        include_depends=True,
+        show_progress=False,
+    )
+    prefix = "" if platform == "linux-64" else "linux-64/"
+    assert summary["to-mirror"] == {
+        prefix + "theta-1.0-0.tar.bz2",
+        prefix + "beta-2.0-0.tar.bz2",
+        prefix + "gamma-0.1-0.tar.bz2",
+        "noarch/zeta-1.0-0.tar.bz2",
+    }
+    assert sorted(os.listdir(target_directory.join("linux-64"))) == [
+        "beta-2.0-0.tar.bz2",
+        "gamma-0.1-0.tar.bz2",
+        "repodata.json",
+        "repodata.json.bz2",
+        "theta-1.0-0.tar.bz2",
+    ]
+    noarch = ["zeta-1.0-0.tar.bz2"]
+    if platform == "linux-64":
+        noarch.insert(0, "epsilon-1.0-0.tar.bz2")
+    assert sorted(conda_mirror._list_conda_packages(noarch_directory.strpath)) == noarch
+    with open(noarch_directory.join("repodata.json").strpath) as f:
+        assert sorted(json.load(f)["packages"]) == noarch
+
+
+@pytest.mark.parametrize("backend", ["requests", "asyncio"])
+def test_download_resumes(tmpdir, local_channel, backend):
+    from conftest import make_package
+
+    filename, record = make_package(
+        local_channel.path("linux-64"), "large", "1.0", blob=os.urandom(20000).hex()
+    )
+    url = "%s/linux-64/%s" % (local_channel.url, filename)
+    expected = {key: record[key] for key in ("md5", "sha256", "size")}
+    target_directory = tmpdir.mkdir("download").strpath
+
+    def download(max_retries):
+        del local_channel.requests[:]
+        if backend == "requests":
+            return conda_mirror._download_backoff_retry(
+                url,
+                target_directory,
+                conda_mirror._make_session(),
+                chunk_size=1024,
+                max_retries=max_retries,
+                show_progress=False,
+                **expected,
+            )
+
+        aiohttp = pytest.importorskip("aiohttp")
+
+        async def download_async():
+            async with aiohttp.ClientSession() as session:
+                return await conda_mirror._download_backoff_retry_async(
+                    url,
+                    target_directory,
+                    session,
+                    chunk_size=1024,
+                    max_retries=max_retries,
+                    **expected,
+                )
+
+        return asyncio.run(download_async())
+
+    # the connection drops twice (after whole chunks, as requests does not
+    # hand out the last partial chunk), each attempt continues where the last
+    # stopped
+    local_channel.drop_connections("linux-64/" + filename, 4096, 5120)
+    assert download(max_retries=3) == record["size"]
+    ranges = [headers.get("Range") for _, headers in local_channel.requests]
+    assert ranges == [None, "bytes=4096-", "bytes=9216-"]
+    if_range = {headers.get("If-Range") for _, headers in local_channel.requests[1:]}
+    assert len(if_range) == 1 and if_range.pop().startswith('"')
+    assert os.listdir(target_directory) == [filename]
+    assert conda_mirror._validate(
+        os.path.join(target_directory, filename), md5=record["md5"]
+    ) == (os.path.join(target_directory, filename), None)
+
+    # a transient error while resuming keeps what was downloaded, and the
+    # next attempt resumes from there
+    os.remove(os.path.join(target_directory, filename))
+    local_channel.drop_connections("linux-64/" + filename, 4096)
+    with pytest.raises(Exception):
+        download(max_retries=1)
+    local_channel.fail_requests("linux-64/" + filename, 503)
+    with pytest.raises(requests.HTTPError):
+        download(max_retries=1)
+    partial = os.path.join(target_directory, filename + conda_mirror.PARTIAL_SUFFIX)
+    assert os.path.getsize(partial) == 4096
+    assert os.path.exists(partial + conda_mirror.RESUME_STATE_SUFFIX)
+    local_channel.fail_requests("linux-64/" + filename, 503)
+    assert download(max_retries=2) == record["size"]
+    ranges = [headers.get("Range") for _, headers in local_channel.requests]
+    assert ranges == ["bytes=4096-", "bytes=4096-"]
+    assert os.listdir(target_directory) == [filename]
+
+    # a package that changes upstream after the connection dropped is
+    # downloaded again from the start
+    os.remove(os.path.join(target_directory, filename))
+    local_channel.drop_connections("linux-64/" + filename, 4096)
+    with pytest.raises(Exception):
+        download(max_retries=1)
+    assert (
+        os.path.getsize(
+            os.path.join(target_directory, filename + conda_mirror.PARTIAL_SUFFIX)
+        )
+        == 4096
+    )
+    stat = os.stat(local_channel.path("linux-64", filename))
+    os.utime(
+        local_channel.path("linux-64", filename), (stat.st_atime, stat.st_mtime + 5)
+    )
+    assert download(max_retries=1) == record["size"]
+    ((_, headers),) = local_channel.requests
+    assert headers["Range"] == "bytes=4096-"
+    assert os.listdir(target_directory) == [filename]
+
+
+def test_main_resumes_interrupted_run(tmpdir, local_channel, monkeypatch):
+    platform = "linux-64"
+    packages = sorted(local_channel.packages[platform])
+    target_directory = tmpdir.mkdir("mirror")
+    temp_directory = tmpdir.mkdir("temp")
+    kwargs = dict(
+        upstream_channel=local_channel.url,
+        target_directory=target_directory.strpath,
+        temp_directory=temp_directory.strpath,
+        platform=platform,
+        show_progress=False,
+    )
+
+    # the run is killed while it downloads the third package
+    download = conda_mirror._download_backoff_retry
+
+    def interrupted_download(url, *args, **kw):
+        if url.endswith(packages[2]):
+            raise KeyboardInterrupt
+        return download(url, *args, **kw)
+
+    monkeypatch.setattr(conda_mirror, "_download_backoff_retry", interrupted_download)
+    with pytest.raises(KeyboardInterrupt):
+        conda_mirror.main(**kwargs)
+    assert conda_mirror._list_conda_packages(target_directory.join(platform)) == []
+    staging_dir = conda_mirror._staging_directory(
+        temp_directory.strpath, target_directory.join(platform).strpath
+    )
+    assert sorted(conda_mirror._list_conda_packages(staging_dir)) == packages[:2]
+
+    # the next run only downloads the rest
+    monkeypatch.setattr(conda_mirror, "_download_backoff_retry", download)
+    del local_channel.requests[:]
+    ret = conda_mirror.main(**kwargs)
+    requested = {
+        path.split("/")[-1]
+        for path, _ in local_channel.requests
+        if path.endswith(".tar.bz2")
+    }
+    assert requested == set(packages[2:])
+    assert len(ret["downloaded"]) == len(packages)
+    mirrored = conda_mirror._list_conda_packages(target_directory.join(platform))
+    assert sorted(mirrored) == packages
+    assert not os.path.exists(staging_dir)
+
+
+def test_resume_staging_removes_orphan_states(tmpdir):
+    staging_dir = tmpdir.mkdir("staging")
+    for filename in [
+        "wanted-1.0-0.tar.bz2.partial",
+        "wanted-1.0-0.tar.bz2.partial.json",
+        "unwanted-1.0-0.tar.bz2.partial",
+        "unwanted-1.0-0.tar.bz2.partial.json",
+        # resume states whose partial download is gone
+        "orphan-1.0-0.tar.bz2.partial.json",
+        "orphan-1.0-0.conda.partial.json",
+    ]:
+        staging_dir.join(filename).write("{}")
+
+    staged = conda_mirror._resume_staging(
+        staging_dir.strpath,
+        {},
+        ["wanted-1.0-0.tar.bz2", "orphan-1.0-0.tar.bz2", "orphan-1.0-0.conda"],
+    )
+    assert staged == set()
+    assert sorted(os.listdir(staging_dir.strpath)) == [
+        "wanted-1.0-0.tar.bz2.partial",
+        "wanted-1.0-0.tar.bz2.partial.json",
+    ]
+
+
+def test_main_multiple_platforms(tmpdir, local_channel, monkeypatch):
+    sessions = []
+    make_session = conda_mirror._make_session
+    monkeypatch.setattr(
+        conda_mirror,
+        "_make_session",
+        lambda *args: sessions.append(make_session(*args)) or sessions[-1],
+    )
+    target_directory = tmpdir.mkdir("mirror")
+    kwargs = dict(
+        upstream_channel=local_channel.url,
+        target_directory=target_directory.strpath,
+        temp_directory=tmpdir.mkdir("temp").strpath,
+        platform=["linux-64", "noarch"],
+        num_downloads=2,
+        show_progress=False,
+    )
+    expected = {
+        "%s/%s" % (subdir, name)
+        for subdir, packages in local_channel.packages.items()
+        for name in packages
+    }
+
+    ret = conda_mirror.main(**kwargs)
+    assert len(sessions) == 1
+    assert ret["to-mirror"] == expected
+    assert len(ret["downloaded"]) == len(expected)
+    for subdir, packages in local_channel.packages.items():
+        mirrored = conda_mirror._list_conda_packages(target_directory.join(subdir))
+        assert sorted(mirrored) == sorted(packages)
+        with open(target_directory.join(subdir, "repodata.json").strpath) as f:
+            assert sorted(json.load(f)["packages"]) == sorted(packages)
+
+    # neither platform changed
+    del local_channel.requests[:]
+    ret = conda_mirror.main(**kwargs)
+    assert ret["to-mirror"] == set()
+    assert sorted(path for path, _ in local_channel.requests) == [
+        "/local-channel/linux-64/repodata.json",
+        "/local-channel/noarch/repodata.json",
+    ]
+
+
+def test_main_state_directory(tmpdir, local_channel):
+    platform = "linux-64"
+    # only the target directory itself is writable, e.g. a mount point
+    site = tmpdir.mkdir("site")
+    target_directory = site.mkdir("mirror")
+    temp_directory = tmpdir.mkdir("temp")
+    kwargs = dict(
+        upstream_channel=local_channel.url,
+        target_directory=target_directory.strpath,
+        temp_directory=temp_directory.strpath,
+        platform=platform,
+        show_progress=False,
+    )
+
+    site.chmod(0o555)
+    try:
+        conda_mirror.main(**kwargs)
+    finally:
+        site.chmod(0o755)
+    assert site.listdir() == [target_directory]
+    # nothing but packages and indexes is published
+    published = {
+        os.path.relpath(os.path.join(root, filename), target_directory.strpath)
+        for root, _, filenames in os.walk(target_directory.strpath)
+        for filename in filenames
+    }
+    assert published == {
+        os.path.join(subdir, filename)
+        for subdir, filenames in [
+            (platform, local_channel.packages[platform]),
+            ("noarch", []),
+        ]
+        for filename in list(filenames) + ["repodata.json", "repodata.json.bz2"]
+    }
+    # the state is kept in the temp directory
+    state_dir = os.path.join(
+        conda_mirror._default_state_directory(
+            temp_directory.strpath, target_directory.strpath
+        ),
+        platform,
+    )
+    assert os.path.isfile(os.path.join(state_dir, conda_mirror.LAST_SYNC_FILENAME))
+    assert os.path.isfile(
+        os.path.join(state_dir, conda_mirror.UPSTREAM_REPODATA_FILENAME)
+    )
+
+    # or where it is asked to be. Without the state of the last run, the
+    # packages are validated again, but none is downloaded.
+    state_directory = tmpdir.join("state")
+    ret = conda_mirror.main(state_directory=state_directory.strpath, **kwargs)
+    assert ret["downloaded"] == set()
+    assert len(ret["validating-existing"]) == len(local_channel.packages[platform])
+    assert state_directory.join(platform, conda_mirror.LAST_SYNC_FILENAME).check()
+
+    # a state directory that cannot be created is reported up front
+    with pytest.raises(OSError, match="--state-directory"):
+        conda_mirror.main(
+            state_directory=state_directory.join(
+                platform, "last-sync.json", "x"
+            ).strpath,
+            **kwargs,
+        )
+
+
+def test_main_nothing_to_fetch(tmpdir, local_channel):
+    kwargs = dict(
+        target_directory=tmpdir.mkdir("mirror").strpath,
+        temp_directory=tmpdir.mkdir("temp").strpath,
+        platform=[],
+        num_downloads=4,
+        show_progress=False,
+    )
+    ret = conda_mirror.main(upstream_channel=local_channel.url, **kwargs)
+    assert ret["to-mirror"] == set()
+    ret = conda_mirror.mirror_channels(channels=[], **kwargs)
+    assert ret["to-mirror"] == set()
+    assert local_channel.requests == []
+
+
+def test_mirror_channels(tmpdir, local_channel, other_channel, monkeypatch):
+    sessions = []
+    make_session = conda_mirror._make_session
+    monkeypatch.setattr(
+        conda_mirror,
+        "_make_session",
+        lambda *args: sessions.append((args, make_session(*args))) or sessions[-1][1],
+    )
+    target_directory = tmpdir.mkdir("mirror")
+    channels = [
+        {"upstream_channel": local_channel.url},
+        {
+            "upstream_channel": other_channel.url,
+            "target_directory": "other",
+            "platform": "linux-64",
+            "blacklist": [{"name": "*"}],
+            "whitelist": [{"name": "alpha", "version": ">=1.1"}],
+            "include_depends": True,
+        },
+    ]
+    kwargs = dict(
+        channels=channels,
+        target_directory=target_directory.strpath,
+        temp_directory=tmpdir.mkdir("temp").strpath,
+        platform=["linux-64", "noarch"],
+        num_downloads=2,
+        num_threads=2,
+        validation_executor="thread",
+        show_progress=False,
+    )
+    expected = {
+        "local-channel/%s/%s" % (subdir, name)
+        for subdir, packages in local_channel.packages.items()
+        for name in packages
+    }
+    expected.update(
+        "other/linux-64/%s" % name
+        for name, record in other_channel.packages["linux-64"].items()
+        if record["name"] != "delta" and record["version"] != "1.0"
+    )
+
+    ret = conda_mirror.mirror_channels(**kwargs)
+    # one session, which keeps a connection pool for both upstream hosts
+    assert [args for args, _ in sessions] == [(2, 2)]
+    assert ret["to-mirror"] == expected
+    assert len(ret["downloaded"]) == len(expected)
+    for label in expected:
+        assert target_directory.join(label).check(file=True)
+    with open(target_directory.join("other", "linux-64", "repodata.json").strpath) as f:
+        assert len(json.load(f)["packages"]) == 3
+    assert target_directory.join("other", "noarch", "repodata.json").check()
+    # the state of each channel is kept out of the tree
+    state_directory = conda_mirror._default_state_directory(
+        kwargs["temp_directory"], target_directory.strpath
+    )
+    assert os.path.isfile(
+        os.path.join(state_directory, "other", "linux-64", "last-sync.json")
+    )
+
+    # neither channel changed
+    del local_channel.requests[:]
+    del other_channel.requests[:]
+    ret = conda_mirror.mirror_channels(**kwargs)
+    assert ret["to-mirror"] == set()
+    assert sorted(path for path, _ in local_channel.requests) == [
+        "/local-channel/linux-64/repodata.json",
+        "/local-channel/noarch/repodata.json",
+    ]
+    assert sorted(path for path, _ in other_channel.requests) == [
+        "/other-channel/linux-64/repodata.json",
+        "/other-channel/noarch/repodata.json",
+    ]
+
+    channels[1]["target_directory"] = "local-channel"
+    with pytest.raises(ValueError):
+        conda_mirror.mirror_channels(**kwargs)
+
+
+def test_parse_channels_config(tmpdir, monkeypatch):
+    config = tmpdir.join("conf.yaml")
+    config.write("""
+channels:
+    - upstream_channel: conda-forge
+    - upstream_channel: bioconda
+      platform: noarch
+""")
+    argv = ["conda-mirror", "--config", config.strpath, "--target-directory", "m"]
+    monkeypatch.setattr(sys, "argv", argv + ["--platform", "linux-64"])
+    kwargs = conda_mirror._parse_and_format_args()
+    assert "upstream_channel" not in kwargs
+    assert kwargs["platform"] == ["linux-64"]
+    assert [c["upstream_channel"] for c in kwargs["channels"]] == [
+        "conda-forge",
+        "bioconda",
+    ]
+
+    monkeypatch.setattr(sys, "argv", argv + ["--upstream-channel", "conda-forge"])
+    with pytest.raises(ValueError, match="not both"):
+        conda_mirror._parse_and_format_args()
+
+
+def test_validate_conda_package(tmpdir):
+    pytest.importorskip("zstandard")
+    from conftest import make_package
+
+    package_directory = tmpdir.mkdir("linux-64")
+    packages = dict(
+        make_package(package_directory.strpath, name, "1.0", extension=".conda")
+        for name in "abcd"
+    )
+    good, truncated, no_info, bad_info = sorted(packages)
+    path = package_directory.join(truncated)
+    path.write_binary(path.read_binary()[:-100])
+    with zipfile.ZipFile(package_directory.join(no_info).strpath, "w") as z:
+        z.writestr("metadata.json", "{}")
+    with zipfile.ZipFile(package_directory.join(bad_info).strpath, "w") as z:
+        z.writestr("info-d-1.0-0.tar.zst", b"not zstd")
+    assert sorted(conda_mirror._list_conda_packages(package_directory.strpath)) == [
+        good,
+        truncated,
+        no_info,
+        bad_info,
+    ]
+
+    reasons = {
+        name: conda_mirror._validate(package_directory.join(name).strpath)[1]
+        for name in packages
+    }
+    assert reasons[good] is None
+    for name in (truncated, no_info, bad_info):
+        assert "Zipfile read failure" in reasons[name]
+    assert conda_mirror._list_conda_packages(package_directory.strpath) == [good]
+
+
+def test_main_conda_packages(tmpdir, local_channel):
+    pytest.importorskip("zstandard")
+    from conftest import make_package, write_channel_repodata
+
+    platform = "linux-64"
+    packages = local_channel.packages[platform]
+    for name, version in [("alpha", "1.1"), ("gamma", "0.1")]:
+        filename, record = make_package(
+            local_channel.path(platform), name, version, extension=".conda"
+        )
+        packages[filename] = record
+    write_channel_repodata(local_channel.path(platform), packages)
+    target_directory = tmpdir.mkdir("mirror")
+    kwargs = dict(
+        upstream_channel=local_channel.url,
+        target_directory=target_directory.strpath,
+        temp_directory=tmpdir.mkdir("temp").strpath,
+        platform=platform,
+        current_repodata=True,
+        show_progress=False,
+    )
+
+    def load(filename):
+        with open(target_directory.join(platform, filename).strpath) as f:
+            return json.load(f)
+
+    ret = conda_mirror.main(**kwargs)
+    assert ret["to-mirror"] == set(packages)
+    mirrored = conda_mirror._list_conda_packages(target_directory.join(platform))
+    assert sorted(mirrored) == sorted(packages)
+    repodata = load("repodata.json")
+    assert sorted(repodata["packages.conda"]) == [
+        "alpha-1.1-0.conda",
+        "gamma-0.1-0.conda",
+    ]
+    assert set(repodata["packages"]) == {
+        name for name in packages if name.endswith(".tar.bz2")
+    }
+    current = load("current_repodata.json")
+    assert "alpha-1.1-0.conda" in current["packages.conda"]
+    assert "alpha-1.1-0.tar.bz2" in current["packages"]
+    assert "alpha-1.0-0.tar.bz2" not in current["packages"]
+
+    # only the .conda package of the builds that are published in both formats
+    superseded = {"alpha-1.1-0.tar.bz2", "gamma-0.1-0.tar.bz2"}
+    ret = conda_mirror.main(prefer_conda=True, **kwargs)
+    assert ret["to-mirror"] == set()
+    assert ret["blacklisted"] == superseded
+    mirrored = conda_mirror._list_conda_packages(target_directory.join(platform))
+    assert sorted(mirrored) == sorted(set(packages) - superseded)
+    repodata = load("repodata.json")
+    assert len(repodata["packages.conda"]) == 2
+    assert not superseded.intersection(repodata["packages"])
+
+
+def test_asyncio_downloads_write_off_the_event_loop(tmpdir, local_channel, monkeypatch):
+    pytest.importorskip("aiohttp")
+    import threading
+    import time
+
+    lock = threading.Lock()
+    writing = []
+    overlap = []
+    write_chunk = conda_mirror._write_chunk
+
+    def slow_write_chunk(f, data, hashers):
+        # a slow disk: if the writes ran on the event loop, only one download
+        # could be writing at any time
+        with lock:
+            writing.append(f.name)
+            overlap.append(len(set(writing)))
+        time.sleep(0.05)
+        write_chunk(f, data, hashers)
+        with lock:
+            writing.remove(f.name)
+
+    monkeypatch.setattr(conda_mirror, "_write_chunk", slow_write_chunk)
+    platform = "linux-64"
+    packages = local_channel.packages[platform]
+    download_dir = tmpdir.mkdir("download").strpath
+    downloaded, rejected = conda_mirror._download_packages_async(
+        ["%s/%s/%s" % (local_channel.url, platform, name) for name in packages],
+        download_dir,
+        download_dir,
+        package_repodata=packages,
+        num_downloads=4,
+        chunk_size=64,
+        show_progress=False,
+    )
+    assert len(downloaded) == len(packages) and rejected == []
+    assert sorted(os.listdir(download_dir)) == sorted(packages)
+    assert max(overlap) > 1
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+from conda_mirror import conda_mirror, jlap
+
+
+def _hash(data):
+    return hashlib.blake2b(data, digest_size=jlap.DIGEST_SIZE).hexdigest()
+
+
+def _write_jlap(path, patches, latest):
+    """Write a repodata.jlap with `patches`, whose footer points to `latest`."""
+    iv = bytes(jlap.DIGEST_SIZE)
+    lines = [json.dumps(p).encode() for p in patches]
+    lines.append(json.dumps({"url": "repodata.json", "latest": latest}).encode())
+    checksum = iv
+    for line in lines:
+        checksum = jlap.keyed_hash(line, checksum)
+    with open(path, "wb") as f:
+        f.write(b"\n".join([iv.hex().encode()] + lines + [checksum.hex().encode()]))
+
+
+def test_parse_verifies_checksum():
+    iv = bytes(jlap.DIGEST_SIZE)
+    patch = json.dumps({"from": "a", "to": "b", "patch": []}).encode()
+    footer = json.dumps({"url": "repodata.json", "latest": "b"}).encode()
+    checksum = jlap.keyed_hash(footer, jlap.keyed_hash(patch, iv))
+    body = b"\n".join([iv.hex().encode(), patch, footer, checksum.hex().encode()])
+
+    patches, parsed_footer, pos, last_iv = jlap.parse(body)
+    assert patches == [{"from": "a", "to": "b", "patch": []}]
+    assert parsed_footer["latest"] == "b"
+    assert body[pos:].startswith(footer)
+    assert last_iv == jlap.keyed_hash(patch, iv)
+    # the tail of the file can be verified from the running checksum
+    assert jlap.parse(body[pos:], last_iv)[1] == parsed_footer
+
+    with pytest.raises(jlap.JlapError):
+        jlap.parse(body.replace(b'"to": "b"', b'"to": "c"'))
+
+
+def test_find_patches():
+    patches = [
+        {"from": "a", "to": "b", "patch": []},
+        {"from": "b", "to": "c", "patch": []},
+        {"from": "c", "to": "d", "patch": []},
+    ]
+    assert [p["to"] for p in jlap.find_patches(patches, "b", "d")] == ["c", "d"]
+    assert jlap.find_patches(patches, "d", "d") == []
+    with pytest.raises(jlap.JlapError):
+        jlap.find_patches(patches, "x", "d")
+
+
+def test_apply_patch():
+    doc = {"packages": {"a": {"depends": ["x"]}}, "removed": []}
+    patch = [
+        {"op": "add", "path": "/packages/b~1c", "value": {"depends": []}},
+        {"op": "add", "path": "/packages/a/depends/-", "value": "y"},
+        {"op": "replace", "path": "/packages/a/depends/0", "value": "z"},
+        {"op": "copy", "from": "/packages/a", "path": "/packages/d"},
+        {"op": "move", "from": "/packages/d", "path": "/packages/e"},
+        {"op": "test", "path": "/packages/e/depends/1", "value": "y"},
+        {"op": "remove", "path": "/packages/a"},
+        {"op": "add", "path": "/removed/0", "value": "a"},
+    ]
+    assert jlap.apply_patch(doc, patch) == {
+        "packages": {"b/c": {"depends": []}, "e": {"depends": ["z", "y"]}},
+        "removed": ["a"],
+    }
+    with pytest.raises(jlap.JlapError):
+        jlap.apply_patch(doc, [{"op": "remove", "path": "/packages/a"}])
+    with pytest.raises(jlap.JlapError):
+        jlap.apply_patch(doc, [{"op": "test", "path": "/removed/0", "value": "b"}])
+
+
+def test_fetch_repodata_jlap(local_channel, tmpdir):
+    subdir = local_channel.path("linux-64")
+    url = local_channel.url + "/linux-64/repodata.json"
+    cache_dir = tmpdir.mkdir("cache").strpath
+    session = conda_mirror._make_session()
+
+    def fetch():
+        del local_channel.requests[:]
+        return conda_mirror._fetch_repodata(url, session, cache_dir, use_jlap=True)
+
+    def read(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    # the first fetch downloads the full repodata
+    repodata_path, state, _ = fetch()
+    original = read(os.path.join(subdir, "repodata.json"))
+    assert state["blake2_256"] == _hash(original)
+
+    # upstream drops a package and publishes the patch
+    repodata = json.loads(original)
+    removed = sorted(repodata["packages"])[0]
+    del repodata["packages"][removed]
+    updated = json.dumps(repodata, indent=2, sort_keys=True).encode()
+    patches = [
+        {
+            "from": _hash(original),
+            "to": _hash(updated),
+            "patch": [{"op": "remove", "path": "/packages/" + removed}],
+        }
+    ]
+    with open(os.path.join(subdir, "repodata.json"), "wb") as f:
+        f.write(updated)
+    _write_jlap(os.path.join(subdir, "repodata.jlap"), patches, _hash(updated))
+
+    repodata_path, state, not_modified = fetch()
+    assert not not_modified
+    assert state["blake2_256"] == _hash(updated)
+    with open(repodata_path) as f:
+        assert json.load(f) == repodata
+    assert [path for path, _ in local_channel.requests] == [
+        "/local-channel/linux-64/repodata.jlap"
+    ]
+
+    # nothing changed: only the tail of repodata.jlap is requested again
+    _, _, not_modified = fetch()
+    assert not_modified
+    ((path, headers),) = local_channel.requests
+    assert headers["Range"].startswith("bytes=")
+
+    # another patch is appended
+    repodata["info"]["note"] = "patched twice"
+    latest = json.dumps(repodata, indent=2, sort_keys=True).encode()
+    patches.append(
+        {
+            "from": _hash(updated),
+            "to": _hash(latest),
+            "patch": [{"op": "add", "path": "/info/note", "value": "patched twice"}],
+        }
+    )
+    _write_jlap(os.path.join(subdir, "repodata.jlap"), patches, _hash(latest))
+    repodata_path, state, not_modified = fetch()
+    assert not not_modified
+    with open(repodata_path) as f:
+        assert json.load(f) == repodata
+    assert "Range" in local_channel.requests[0][1]
+
+    # a broken patch stream falls back to downloading repodata.json
+    with open(os.path.join(subdir, "repodata.jlap"), "ab") as f:
+        f.write(b"garbage")
+    with open(os.path.join(subdir, "repodata.json"), "wb") as f:
+        f.write(original)
+    repodata_path, state, not_modified = fetch()
+    assert not not_modified
+    assert read(repodata_path) == original
+    assert state["blake2_256"] == _hash(original)
@@ -0,0 +1,183 @@
+import functools
+import random
+from itertools import zip_longest
+
+import pytest
+
+from conda_mirror import versionspec
+from conda_mirror.versionspec import BuildNumberMatch, VersionOrder, VersionSpec
+
+
+@pytest.fixture
+def small_caches():
+    versionspec.set_cache_size(2)
+    for cls in (VersionOrder, VersionSpec, BuildNumberMatch):
+        cls.cache_clear()
+    yield
+    versionspec.set_cache_size(versionspec.DEFAULT_CACHE_SIZE)
+
+
+def test_cache_is_bounded(small_caches):
+    one = VersionOrder("1.0")
+    assert VersionOrder("1.0") is one
+    VersionOrder("2.0")
+    assert VersionOrder.cache_info() == (1, 2, 2, 2)
+
+    # 1.0 was used more recently than 2.0, which is evicted first
+    assert VersionOrder("1.0") is one
+    VersionOrder("3.0")
+    assert VersionOrder("1.0") is one
+    assert VersionOrder.cache_info().currsize == 2
+    hits, misses, _, _ = VersionOrder.cache_info()
+    VersionOrder("2.0")
+    assert VersionOrder.cache_info().misses == misses + 1
+
+    # instances are equal, whether they come from the cache or not
+    assert VersionOrder("2.0") == VersionOrder("2.0.0")
+    assert VersionSpec(">=1.0,<2").match("1.5")
+    assert BuildNumberMatch(">=2").match(3)
+
+    info = versionspec.cache_info()
+    assert set(info) == {"VersionOrder", "VersionSpec", "BuildNumberMatch"}
+    assert all(i.currsize <= 2 for i in info.values())
+
+
+def test_cache_unbounded(small_caches):
+    versionspec.set_cache_size(None)
+    versions = [VersionOrder("1.%s" % i) for i in range(10)]
+    assert VersionOrder.cache_info().currsize == 10
+    assert all(VersionOrder("1.%s" % i) is v for i, v in enumerate(versions))
+
+    VersionOrder.cache_clear()
+    assert VersionOrder.cache_info() == (0, 0, None, 0)
+
+
+# version strings as they appear on conda-forge, including the odd ones
+VERSION_CORPUS = [
+    "0",
+    "0.0",
+    "0.0.0",
+    "0.1",
+    "0.1.0.dev0",
+    "0.9.8",
+    "1",
+    "1.0",
+    "1.0.0",
+    "1.0.0.0.1",
+    "1.0.0.0",
+    "1.0-1",
+    "1.0_1",
+    "1.0.1a",
+    "1.0.1_",
+    "1.0a1",
+    "1.0b2",
+    "1.0rc1",
+    "1.0dev",
+    "1.0.dev1",
+    "1.0.post1",
+    "1.0post",
+    "1.0a",
+    "1.0+local",
+    "1.0+local.1",
+    "1.0+1",
+    "1.0+0",
+    "1.1",
+    "1.1.1",
+    "1.1.1g",
+    "1.1.1k",
+    "1.2.3_4",
+    "1.10",
+    "1.9",
+    "1!1.0",
+    "1!2.0",
+    "2!0.1",
+    "2.7.18",
+    "3.10.0rc1",
+    "3.10.0",
+    "3.9.7",
+    "9e",
+    "9d",
+    "20200101",
+    "2021.10.8",
+    "2021a",
+    "1.0.0.1.0",
+    "1.0.0a0",
+    "0.0.0a",
+    "1.0.0_0",
+    "1.0.0.dev0",
+    "1.0.0.post0",
+    "4.0.0beta",
+    "1.0.alpha",
+    "1.0.x",
+    "1.0.0.x.1",
+]
+
+
+def _reference_eq(t1, t2):
+    for v1, v2 in zip_longest(t1, t2, fillvalue=[]):
+        for c1, c2 in zip_longest(v1, v2, fillvalue=0):
+            if c1 != c2:
+                return False
+    return True
+
+
+def _reference_lt(v1, v2):
+    """The element-wise comparison VersionOrder used before sort keys."""
+    for t1, t2 in zip([v1.version, v1.local], [v2.version, v2.local]):
+        for p1, p2 in zip_longest(t1, t2, fillvalue=[]):
+            for c1, c2 in zip_longest(p1, p2, fillvalue=0):
+                if c1 == c2:
+                    continue
+                elif isinstance(c1, str):
+                    if not isinstance(c2, str):
+                        return True
+                elif isinstance(c2, str):
+                    return False
+                return c1 < c2
+    return False
+
+
+def _random_version(rng):
+    elements = ["0", "1", "2", "10", "a", "b", "rc", "dev", "post", "_"]
+    separators = [".", ".", ".", "_", ""]
+
+    def part():
+        parts = [rng.choice(elements[:4])]
+        for _ in range(rng.randrange(5)):
+            parts.append(rng.choice(separators) + rng.choice(elements))
+        return "".join(parts).strip("_") or "0"
+
+    version = part()
+    if rng.random() < 0.1:
+        version = "%d!%s" % (rng.randrange(3), version)
+    if rng.random() < 0.2:
+        version += "+" + part()
+    return version
+
+
+def test_version_order_keys():
+    rng = random.Random(42)
+    versions = [VersionOrder(v) for v in VERSION_CORPUS]
+    while len(versions) < 400:
+        try:
+            versions.append(VersionOrder(_random_version(rng)))
+        except versionspec.InvalidVersionSpec:
+            pass
+    for v1 in versions:
+        for v2 in versions:
+            lt = _reference_lt(v1, v2)
+            eq = _reference_eq(v1.version, v2.version) and _reference_eq(
+                v1.local, v2.local
+            )
+            assert (v1 < v2) == lt, (v1, v2)
+            assert (v1 == v2) == eq, (v1, v2)
+            assert (v1 <= v2) == (lt or eq), (v1, v2)
+            assert (v1 > v2) == _reference_lt(v2, v1), (v1, v2)
+            if eq:
+                assert hash(v1) == hash(v2)
+
+    def reference_cmp(v1, v2):
+        return -1 if _reference_lt(v1, v2) else int(_reference_lt(v2, v1))
+
+    expected = sorted(versions, key=functools.cmp_to_key(reference_cmp))
+    assert [v._key for v in sorted(versions)] == [v._key for v in expected]